@@ -1,43 +1,46 @@
-from PIL import Image
 import argparse
 import os
 
-def transform_intensities(input_image_path, output_image_path):
+from nnunet_scripts.postprocessing import COLORMAPS, MASK_EXTENSIONS, PostProcessor, postprocess_files
 
-    img = Image.open(input_image_path)
-    img = img.convert('L')
-    pixels = list(img.getdata())
-    pixels = [255 if pixel == 1 else pixel for pixel in pixels]
-    img.putdata(pixels)
+def transform_intensities(input_image_path, output_image_path, postprocessor=None):
+
+    postprocessor = postprocessor or PostProcessor()
     if os.path.isdir(output_image_path):
         filename = os.path.basename(input_image_path).replace('_0000', '_final')
         output_image_path = os.path.join(output_image_path, filename)
-    else:
-        output_image_path = output_image_path
 
-    os.makedirs(os.path.dirname(output_image_path), exist_ok=True)
-    img.save(output_image_path, 'PNG')
+    postprocess_files([input_image_path], [output_image_path], postprocessor)
 
-def transform_intensities_in_folder(input_folder_path, output_folder_path):
+def transform_intensities_in_folder(input_folder_path, output_folder_path, postprocessor=None, workers=1):
 
     if not os.path.exists(output_folder_path):
         os.makedirs(output_folder_path)
-    
-    for filename in os.listdir(input_folder_path):
-        file_path = os.path.join(input_folder_path, filename)
-        
-        output_image_path = os.path.join(output_folder_path, filename)
-        
-        if os.path.isfile(file_path) and filename.lower().endswith(('.png', '.jpg', '.jpeg', '.tif', '.bmp')):
-            transform_intensities(file_path, output_image_path)
+
+    filenames = sorted(filename for filename in os.listdir(input_folder_path)
+                       if os.path.isfile(os.path.join(input_folder_path, filename))
+                       and filename.lower().endswith(MASK_EXTENSIONS))
+    postprocess_files([os.path.join(input_folder_path, filename) for filename in filenames],
+                      [os.path.join(output_folder_path, filename) for filename in filenames],
+                      postprocessor or PostProcessor(), workers)
 def get_args():
     parser = argparse.ArgumentParser(description="Transform image pixel intensities for an entire folder.")
     parser.add_argument("--input_folder_path", type=str, help="Path to the input folder containing images.")
     parser.add_argument("--output_folder_path", type=str, help="Path to the output folder where transformed images will be saved.")
+    parser.add_argument("--colormap", type=str, default="binary", choices=list(COLORMAPS),
+                        help="'binary' maps 1 to 255, 'classes' gives each class an RGB colour. Default: binary")
+    parser.add_argument("--min_component_size", type=int, default=0,
+                        help="Remove the connected components smaller than this number of pixels. Default: 0 (keep all)")
+    parser.add_argument("--fill_holes", action="store_true", help="Fill the holes enclosed by each class.")
+    parser.add_argument("--max_hole_size", type=int, default=None,
+                        help="Only fill the holes up to this number of pixels. Default: no limit")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes transforming the images. Default: number of CPUs")
     return parser.parse_args()
 
 def main():
     args = get_args()
-    transform_intensities_in_folder(args.input_folder_path, args.output_folder_path)
+    postprocessor = PostProcessor(args.colormap, args.min_component_size, args.fill_holes, args.max_hole_size)
+    transform_intensities_in_folder(args.input_folder_path, args.output_folder_path, postprocessor, args.workers)
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,344 @@
+"""
+This script benchmarks the throughput, latency and memory use of the nnUNetv2 inference pipeline.
+
+Synthetic brightfield-like nerve images are generated at several sizes, and the inference is run for every
+combination of the requested settings (tile step size, mirroring, number of folds, number of preprocessing and
+export processes). Each combination runs in a fresh process so that its peak memory can be measured.
+
+By default, a tiny randomly initialized 2D model is created so that the benchmark runs offline on CPU. Use
+--path-model to benchmark a trained model instead.
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+TINY_MODEL_PLANS = {
+    "dataset_name": "Dataset999_Benchmark",
+    "plans_name": "nnUNetPlans",
+    "original_median_spacing_after_transp": [999.0, 1.0, 1.0],
+    "original_median_shape_after_transp": [1, 512, 512],
+    "image_reader_writer": "NaturalImage2DIO",
+    "transpose_forward": [0, 1, 2],
+    "transpose_backward": [0, 1, 2],
+    "configurations": {
+        "2d": {
+            "data_identifier": "nnUNetPlans_2d",
+            "preprocessor_name": "DefaultPreprocessor",
+            "batch_size": 2,
+            "patch_size": [256, 256],
+            "median_image_size_in_voxels": [512.0, 512.0],
+            "spacing": [1.0, 1.0],
+            "normalization_schemes": ["ZScoreNormalization"],
+            "use_mask_for_norm": [False],
+            "resampling_fn_data": "resample_data_or_seg_to_shape",
+            "resampling_fn_seg": "resample_data_or_seg_to_shape",
+            "resampling_fn_data_kwargs": {"is_seg": False, "order": 3, "order_z": 0, "force_separate_z": None},
+            "resampling_fn_seg_kwargs": {"is_seg": True, "order": 1, "order_z": 0, "force_separate_z": None},
+            "resampling_fn_probabilities": "resample_data_or_seg_to_shape",
+            "resampling_fn_probabilities_kwargs": {"is_seg": False, "order": 1, "order_z": 0, "force_separate_z": None},
+            "architecture": {
+                "network_class_name": "dynamic_network_architectures.architectures.unet.PlainConvUNet",
+                "arch_kwargs": {
+                    "n_stages": 4,
+                    "features_per_stage": [8, 16, 32, 64],
+                    "conv_op": "torch.nn.modules.conv.Conv2d",
+                    "kernel_sizes": [[3, 3], [3, 3], [3, 3], [3, 3]],
+                    "strides": [[1, 1], [2, 2], [2, 2], [2, 2]],
+                    "n_conv_per_stage": [2, 2, 2, 2],
+                    "n_conv_per_stage_decoder": [2, 2, 2],
+                    "conv_bias": True,
+                    "norm_op": "torch.nn.modules.instancenorm.InstanceNorm2d",
+                    "norm_op_kwargs": {"eps": 1e-05, "affine": True},
+                    "dropout_op": None,
+                    "dropout_op_kwargs": None,
+                    "nonlin": "torch.nn.LeakyReLU",
+                    "nonlin_kwargs": {"inplace": True}
+                },
+                "_kw_requires_import": ["conv_op", "norm_op", "dropout_op", "nonlin"]
+            },
+            "batch_dice": True
+        }
+    },
+    "experiment_planner_used": "ExperimentPlanner",
+    "label_manager": "LabelManager",
+    "foreground_intensity_properties_per_channel": {
+        "0": {"max": 255.0, "mean": 120.0, "median": 120.0, "min": 0.0,
+              "percentile_00_5": 10.0, "percentile_99_5": 250.0, "std": 50.0}
+    }
+}
+
+TINY_MODEL_DATASET = {
+    "channel_names": {"0": "L"},
+    "labels": {"background": 0, "axons": 1},
+    "numTraining": 1,
+    "file_ending": ".png"
+}
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """
+    Parse command line arguments.
+
+    Returns:
+        argparse.ArgumentParser: Argument parser.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark nnUNet inference on synthetic nerve images')
+    parser.add_argument('--path-out', required=True,
+                        help='Path to the output JSON report.')
+    parser.add_argument('--path-model', default=None,
+                        help='Path to a trained model directory. If not specified, a tiny randomly initialized '
+                        'model is created. Default: None')
+    parser.add_argument('--use-best-checkpoint', action='store_true', default=False,
+                        help='Use the best checkpoint of --path-model instead of the final one. Default: False')
+    parser.add_argument('--use-gpu', action='store_true', default=False,
+                        help='Use GPU for inference. Default: False')
+    parser.add_argument('--image-sizes', nargs='+', type=int, default=[512, 1024, 2048],
+                        help='Sides of the square synthetic images. Default: 512 1024 2048')
+    parser.add_argument('--num-images', default=4, type=int,
+                        help='Number of synthetic images per size. Default: 4')
+    parser.add_argument('--tile-step-sizes', nargs='+', type=float, default=[0.5],
+                        help='Tile step sizes to benchmark. Default: 0.5')
+    parser.add_argument('--mirroring', nargs='+', type=int, choices=[0, 1], default=[1],
+                        help='Mirroring settings to benchmark (0: off, 1: on). Default: 1')
+    parser.add_argument('--num-folds', nargs='+', type=int, default=[1],
+                        help='Numbers of folds to ensemble. Default: 1')
+    parser.add_argument('--num-processes-preprocessing', nargs='+', type=int, default=[2],
+                        help='Numbers of preprocessing processes to benchmark. Default: 2')
+    parser.add_argument('--num-processes-segmentation-export', nargs='+', type=int, default=[2],
+                        help='Numbers of segmentation export processes to benchmark. Default: 2')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='Seed of the synthetic images and of the tiny model weights. Default: 0')
+
+    return parser
+
+
+def generate_synthetic_image(size: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Generate a brightfield-like grayscale image of a nerve cross-section: a dark fascicle on a bright, unevenly
+    lit background, filled with myelinated axons (dark rings around light cores).
+
+    Args:
+        size (int): Side of the square image.
+        rng (np.random.Generator): Random generator.
+
+    Returns:
+        np.ndarray: uint8 image of shape (size, size).
+    """
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    phase = rng.uniform(0, 2 * np.pi, 2)
+    image = 205 + 12 * np.sin(2 * np.pi * xx + phase[0]) * np.cos(2 * np.pi * yy + phase[1])
+
+    center = rng.uniform(0.4, 0.6, 2)
+    radii = rng.uniform(0.25, 0.4, 2)
+    fascicle = ((yy - center[0]) / radii[0]) ** 2 + ((xx - center[1]) / radii[1]) ** 2 <= 1
+    image[fascicle] = 150
+
+    num_axons = int(fascicle.sum() / 400)
+    candidates = np.argwhere(fascicle)
+    for cy, cx in candidates[rng.choice(len(candidates), size=min(num_axons, len(candidates)), replace=False)]:
+        radius = rng.uniform(3, 8)
+        y0, y1 = max(0, int(cy - radius - 3)), min(size, int(cy + radius + 4))
+        x0, x1 = max(0, int(cx - radius - 3)), min(size, int(cx + radius + 4))
+        distance = np.hypot(*np.mgrid[y0 - cy:y1 - cy, x0 - cx:x1 - cx])
+        patch = image[y0:y1, x0:x1]
+        patch[distance <= radius + 2] = 60
+        patch[distance <= radius] = 190
+
+    image += rng.normal(0, 8, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def create_tiny_model(path_model: str, num_folds: int, seed: int = 0):
+    """
+    Create a model directory holding a tiny randomly initialized 2D nnUNet, readable by nnUNetPredictor.
+
+    Args:
+        path_model (str): Path to the model directory to create.
+        num_folds (int): Number of folds (each with its own random weights).
+        seed (int): Seed of the weights.
+    """
+    import torch
+    from nnunetv2.utilities.get_network_from_plans import get_network_from_plans
+
+    os.makedirs(path_model, exist_ok=True)
+    with open(os.path.join(path_model, 'plans.json'), 'w') as f:
+        json.dump(TINY_MODEL_PLANS, f, indent=2)
+    with open(os.path.join(path_model, 'dataset.json'), 'w') as f:
+        json.dump(TINY_MODEL_DATASET, f, indent=2)
+
+    architecture = TINY_MODEL_PLANS['configurations']['2d']['architecture']
+    for fold in range(num_folds):
+        torch.manual_seed(seed + fold)
+        network = get_network_from_plans(architecture['network_class_name'], architecture['arch_kwargs'],
+                                         architecture['_kw_requires_import'], 1, len(TINY_MODEL_DATASET['labels']),
+                                         allow_init=True, deep_supervision=False)
+        os.makedirs(os.path.join(path_model, f'fold_{fold}'), exist_ok=True)
+        torch.save({
+            'network_weights': network.state_dict(),
+            'trainer_name': 'nnUNetTrainer',
+            'init_args': {'configuration': '2d'},
+            'inference_allowed_mirroring_axes': (0, 1),
+        }, os.path.join(path_model, f'fold_{fold}', 'checkpoint_final.pth'))
+
+
+def percentiles(values: list) -> dict:
+    """
+    Summarize latencies in milliseconds.
+
+    Args:
+        values (list): Latencies in seconds.
+
+    Returns:
+        dict: Mean, p50, p90, p99 and max latencies in milliseconds.
+    """
+    values = np.asarray(values) * 1000
+    return {'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+            'p90': float(np.percentile(values, 90)), 'p99': float(np.percentile(values, 99)),
+            'max': float(values.max())}
+
+
+def run_configuration(config: dict, path_model: str, path_images: list, path_tmp: str) -> dict:
+    """
+    Benchmark one configuration. Meant to run in a fresh process, so that the peak memory is its own.
+
+    Args:
+        config (dict): Settings of the run.
+        path_model (str): Path to the model directory.
+        path_images (list): Paths to the images to segment.
+        path_tmp (str): Folder for the predictions.
+
+    Returns:
+        dict: Settings and measures of the run.
+    """
+    import torch
+    from instrumentation import peak_rss_mb
+    from nnunet_inference import get_available_folds, load_predictor
+
+    torch.manual_seed(config['seed'])
+    folds = sorted(get_available_folds(path_model))[:config['num_folds']]
+    start = time.perf_counter()
+    predictor = load_predictor(path_model, folds, config['use_gpu'], config['use_best_checkpoint'])
+    predictor.tile_step_size = config['tile_step_size']
+    predictor.use_mirroring = bool(config['mirroring'])
+    predictor.allow_tqdm = False
+    model_loading = time.perf_counter() - start
+
+    # Throughput: all images through nnUNet's batch pipeline
+    path_out = os.path.join(path_tmp, 'predictions')
+    start = time.perf_counter()
+    predictor.predict_from_files(
+        [[f] for f in path_images],
+        [os.path.join(path_out, os.path.basename(f)[:-len('.png')]) for f in path_images],
+        save_probabilities=False,
+        overwrite=True,
+        num_processes_preprocessing=config['num_processes_preprocessing'],
+        num_processes_segmentation_export=config['num_processes_segmentation_export'],
+        folder_with_segs_from_prev_stage=None,
+        num_parts=1,
+        part_id=0
+    )
+    batch_time = time.perf_counter() - start
+
+    # Latency: one image at a time, from file to segmentation
+    reader_writer = predictor.plans_manager.image_reader_writer_class()
+    latencies = []
+    for f in path_images:
+        start = time.perf_counter()
+        image, properties = reader_writer.read_images([f])
+        predictor.predict_single_npy_array(image, properties)
+        latencies.append(time.perf_counter() - start)
+
+    shutil.rmtree(path_out, ignore_errors=True)
+    return dict(config, **{
+        'num_images': len(path_images),
+        'model_loading_s': model_loading,
+        'batch_time_s': batch_time,
+        'images_per_second': len(path_images) / batch_time,
+        'latency_ms': percentiles(latencies),
+        'peak_rss_mb': peak_rss_mb(resource.RUSAGE_SELF),
+        'peak_rss_children_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+        'torch_threads': torch.get_num_threads(),
+    })
+
+
+def main():
+    """
+    Main function to run the script.
+    """
+    parser = get_parser()
+    args = parser.parse_args()
+
+    path_tmp = tempfile.mkdtemp(prefix='nnunet_benchmark_')
+    try:
+        path_model = args.path_model
+        if path_model is None:
+            path_model = os.path.join(path_tmp, 'model')
+            print('Creating a tiny randomly initialized model in {}'.format(path_model))
+            create_tiny_model(path_model, max(args.num_folds), args.seed)
+
+        rng = np.random.default_rng(args.seed)
+        images_by_size = {}
+        for size in args.image_sizes:
+            images_by_size[size] = []
+            for i in range(args.num_images):
+                path_image = os.path.join(path_tmp, 'images', f'synthetic_{size}_{i:03d}.png')
+                os.makedirs(os.path.dirname(path_image), exist_ok=True)
+                Image.fromarray(generate_synthetic_image(size, rng)).save(path_image)
+                images_by_size[size].append(path_image)
+
+        results = []
+        # A fresh spawned process per configuration, so that peak memory and torch state are not shared
+        context = multiprocessing.get_context('spawn')
+        for size, tile_step_size, mirroring, num_folds, num_preprocessing, num_export in itertools.product(
+                args.image_sizes, args.tile_step_sizes, args.mirroring, args.num_folds,
+                args.num_processes_preprocessing, args.num_processes_segmentation_export):
+            config = {
+                'image_size': size,
+                'tile_step_size': tile_step_size,
+                'mirroring': mirroring,
+                'num_folds': num_folds,
+                'num_processes_preprocessing': num_preprocessing,
+                'num_processes_segmentation_export': num_export,
+                'use_gpu': args.use_gpu,
+                'use_best_checkpoint': args.use_best_checkpoint,
+                'seed': args.seed,
+            }
+            print('Benchmarking {}'.format(config))
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(run_configuration, config, path_model, images_by_size[size], path_tmp).result()
+            print('  {:.2f} images/s, p50 latency {:.0f} ms, peak RSS {:.0f} MB'.format(
+                result['images_per_second'], result['latency_ms']['p50'], result['peak_rss_mb']))
+            results.append(result)
+    finally:
+        shutil.rmtree(path_tmp, ignore_errors=True)
+
+    import torch
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'model': args.path_model or 'tiny random model',
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.path_out)), exist_ok=True)
+    with open(args.path_out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Benchmark report written to {}'.format(args.path_out))
+
+if __name__ == '__main__':
+    main()
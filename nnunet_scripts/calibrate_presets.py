@@ -0,0 +1,177 @@
+"""
+This script calibrates the speed/accuracy presets of nnunet_inference.py on a held-out labelled set.
+
+Each preset segments the same images, and its mean Dice is reported next to its wall time, so that a preset can be
+chosen from measured numbers. The images and labels follow the nnUNet naming: '<case>_0000<ext>' in the images
+folder and '<case><ext>' in the labels folder (e.g. imagesTs/labelsTs of a converted dataset).
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+from nnunet_inference import PRESETS, load_predictor
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """
+    Parse command line arguments.
+
+    Returns:
+        argparse.ArgumentParser: Argument parser.
+    """
+    parser = argparse.ArgumentParser(description='Report the Dice and wall time of the nnUNet inference presets')
+    parser.add_argument('--path-images', required=True,
+                        help='Path to the folder of held-out images, named <case>_0000<ext>.')
+    parser.add_argument('--path-labels', required=True,
+                        help='Path to the folder of the corresponding labels, named <case><ext>.')
+    parser.add_argument('--path-model', required=True,
+                        help='Path to the model directory. This folder should contain individual folders '
+                        'like fold_0, fold_1, etc.',)
+    parser.add_argument('--presets', nargs='+', default=list(PRESETS), choices=list(PRESETS),
+                        help='Presets to calibrate. Default: all presets')
+    parser.add_argument('--use-gpu', action='store_true', default=False,
+                        help='Use GPU for inference. Default: False')
+    parser.add_argument('--use-best-checkpoint', action='store_true', default=False,
+                        help='Use the best checkpoint (instead of the final checkpoint) for prediction. Default: False')
+    parser.add_argument('--path-out', default=None,
+                        help='Path to a JSON file in which the report is saved. Default: None')
+
+    return parser
+
+
+def list_labelled_cases(path_images: str, path_labels: str, file_ending: str) -> list:
+    """
+    Pair the held-out images with their labels.
+
+    Args:
+        path_images (str): Folder of the images, named <case>_0000<file_ending>.
+        path_labels (str): Folder of the labels, named <case><file_ending>.
+        file_ending (str): File ending of the dataset.
+
+    Returns:
+        list: Sorted (case, image path, label path) tuples.
+    """
+    cases = []
+    for f in sorted(os.listdir(path_images)):
+        if not f.endswith('_0000' + file_ending):
+            continue
+        case = f[:-len('_0000' + file_ending)]
+        path_label = os.path.join(path_labels, case + file_ending)
+        if not os.path.isfile(path_label):
+            raise FileNotFoundError('No label found for image {} (expected {})'.format(f, path_label))
+        cases.append((case, os.path.join(path_images, f), path_label))
+    if not cases:
+        raise ValueError('No image named <case>_0000{} found in {}'.format(file_ending, path_images))
+    return cases
+
+
+def dice_score(prediction: np.ndarray, reference: np.ndarray, label: int) -> float:
+    """
+    Compute the Dice score of a label. Like nnUNet's evaluation, the score is NaN when the label is absent from
+    both masks.
+
+    Args:
+        prediction (np.ndarray): Predicted mask.
+        reference (np.ndarray): Reference mask.
+        label (int): Label to score.
+
+    Returns:
+        float: Dice score.
+    """
+    predicted, expected = prediction == label, reference == label
+    total = predicted.sum() + expected.sum()
+    if total == 0:
+        return float('nan')
+    return float(2 * np.logical_and(predicted, expected).sum() / total)
+
+
+def calibrate_preset(preset: str, cases: list, args) -> dict:
+    """
+    Segment the held-out cases with a preset and score them.
+
+    Args:
+        preset (str): Preset to calibrate.
+        cases (list): (case, image path, label path) tuples.
+        args (argparse.Namespace): Command line arguments.
+
+    Returns:
+        dict: Wall times and Dice scores of the preset.
+    """
+    start = time.perf_counter()
+    predictor = load_predictor(args.path_model, None, args.use_gpu, args.use_best_checkpoint, preset)
+    predictor.allow_tqdm = False
+    model_loading = time.perf_counter() - start
+    reader_writer = predictor.plans_manager.image_reader_writer_class()
+    labels = [int(label) for label in predictor.label_manager.foreground_labels]
+
+    # Warm up the network on a single patch, so that one-off initializations are not counted in the first preset.
+    # nnUNet only moves the network to its device and to eval mode when predicting, so this is done here first.
+    num_channels = len(predictor.dataset_json['channel_names'])
+    predictor.network.to(predictor.device).eval()
+    with torch.no_grad():
+        predictor.network(torch.zeros((1, num_channels, *predictor.configuration_manager.patch_size),
+                                      device=predictor.device))
+
+    dice = {label: [] for label in labels}
+    inference_time = 0.0
+    for case, path_image, path_label in cases:
+        start = time.perf_counter()
+        image, properties = reader_writer.read_images([path_image])
+        segmentation = predictor.predict_single_npy_array(image, properties)
+        inference_time += time.perf_counter() - start
+
+        reference, _ = reader_writer.read_seg(path_label)
+        segmentation, reference = np.asarray(segmentation).reshape(-1), np.asarray(reference).reshape(-1)
+        for label in labels:
+            dice[label].append(dice_score(segmentation, reference, label))
+
+    dice_per_label = {str(label): float(np.nanmean(scores)) if not np.all(np.isnan(scores)) else float('nan')
+                      for label, scores in dice.items()}
+    return {
+        'preset': preset,
+        'settings': PRESETS[preset],
+        'num_cases': len(cases),
+        'model_loading_s': model_loading,
+        'inference_s': inference_time,
+        'seconds_per_case': inference_time / len(cases),
+        'dice_per_label': dice_per_label,
+        'mean_dice': float(np.nanmean(list(dice_per_label.values()))),
+    }
+
+
+def main():
+    """
+    Main function to run the script.
+    """
+    parser = get_parser()
+    args = parser.parse_args()
+
+    with open(os.path.join(args.path_model, 'dataset.json')) as f:
+        file_ending = json.load(f)['file_ending']
+    cases = list_labelled_cases(args.path_images, args.path_labels, file_ending)
+    print('Calibrating the presets {} on {} labelled cases...'.format(', '.join(args.presets), len(cases)))
+
+    results = [calibrate_preset(preset, cases, args) for preset in args.presets]
+
+    slowest = max(r['inference_s'] for r in results)
+    print('----------------------------------------------------')
+    print('{:<10} {:>10} {:>12} {:>10} {:>8}'.format('Preset', 'Mean Dice', 'Time (s)', 's/case', 'Speedup'))
+    for r in results:
+        r['speedup'] = slowest / r['inference_s']
+        print('{:<10} {:>10.4f} {:>12.2f} {:>10.2f} {:>7.1f}x'.format(
+            r['preset'], r['mean_dice'], r['inference_s'], r['seconds_per_case'], r['speedup']))
+    print('----------------------------------------------------')
+
+    if args.path_out is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.path_out)), exist_ok=True)
+        with open(args.path_out, 'w') as f:
+            json.dump({'path_model': os.path.abspath(args.path_model), 'results': results}, f, indent=2)
+        print('Calibration report written to {}'.format(args.path_out))
+
+if __name__ == '__main__':
+    main()
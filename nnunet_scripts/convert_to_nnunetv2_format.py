@@ -1,12 +1,27 @@
 import os
-import shutil
 import argparse
 import json
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from PIL import Image
 import numpy as np
+from inference_utils import hash_file
+from tiled_io import SlideReader, PNGStreamWriter, open_slide, crop_windows, is_tiff, slide_shape
+from dataset_fingerprint import COMPATIBLE_READER_WRITERS, CaseStatistics, case_statistics, dataset_fingerprint, save_fingerprint
 Image.MAX_IMAGE_PIXELS = 100_000_000
+MANIFEST_FILENAME = "conversion_manifest.json"
+MANIFEST_VERSION = 1
+OUTPUT_FORMATS = ("png", "nnpk")
+SPLIT_FOLDERS = ("imagesTr", "labelsTr", "imagesTs")
+# nnUNet copies the training labels to gt_segmentations as files, so only the images are packed into containers
+PACKED_FOLDERS = ("imagesTr", "imagesTs")
+STAGING_FOLDER = ".nnpk_staging"
+# Extension of the NNPack containers. The nnpack module imports nnunetv2 (and torch), so it is only imported by the
+# functions handling containers, and the .png conversion does not depend on nnunetv2
+PACK_EXTENSION = ".nnpk"
 
-def create_dataset_json (dataset_folder, channel_names, labels, num_training, file_ending, overwrite_image_reader_writer=None):
+def create_dataset_json (dataset_folder, channel_names, labels, num_training, file_ending, overwrite_image_reader_writer=None, dataset=None):
     """
     Creates the dataset.json file for nnUNetv2 configuration.
     :param dataset_folder: Path to the folder where dataset.json will be stored.
@@ -15,6 +30,7 @@ def create_dataset_json (dataset_folder, channel_names, labels, num_training, fi
     :param num_training: Number of training images.
     :param file_ending: File extension for the images.
     :param overwrite_image_reader_writer: Optional configuration for image reader/writer.
+    :param dataset: Optional dictionary listing the 'images' and 'label' paths of each training case, used instead of the imagesTr and labelsTr folders.
     """
     dataset_json_path = os.path.join(dataset_folder, "dataset.json")
     dataset_json_content = {
@@ -25,118 +41,379 @@ def create_dataset_json (dataset_folder, channel_names, labels, num_training, fi
     }
     if overwrite_image_reader_writer:
         dataset_json_content["overwrite_image_reader_writer"] = overwrite_image_reader_writer
+    if dataset is not None:
+        dataset_json_content["dataset"] = dataset
 
     with open(dataset_json_path, 'w') as json_file:
         json.dump(dataset_json_content, json_file, indent=2)
 
     print("Successfully created dataset.json file.")
 
-def rename_labels(directory_path, training_case="axones"):
+def list_sample_pairs(images_folder, labels_folder):
     """
-    Renames label images in a directory to a consistent naming convention.
-    :param directory_path: Path to the directory containing label images.
-    :param training_case: Prefix for the new file names.
+    Pairs training images with their annotations.
+    Annotations are matched by name ('<image>.<ext>' or '<image>_annotee.<ext>'); images without an annotation of
+    matching name are skipped with a warning.
+    :param images_folder: Path to the folder containing the training images.
+    :param labels_folder: Path to the folder containing the annotations.
+    :return: List of (image_path, label_path) tuples, in nnUNet case order.
     """
-    for count, filename in enumerate(sorted(os.listdir(directory_path))):
-        new_filename = f"{training_case}_{count + 1:03}.png"
-        source = os.path.join(directory_path, filename)
-        destination = os.path.join(directory_path, new_filename)
-        os.rename(source, destination)
-    print("Labels have been successfully renamed.")
+    def png_name(filename):
+        return os.path.splitext(filename)[0] + '.png'
+
+    images = sorted(os.listdir(images_folder), key=png_name)
+    labels_by_stem = {os.path.splitext(label)[0]: label for label in os.listdir(labels_folder)}
+    pairs = []
+    for image in images:
+        stem = os.path.splitext(image)[0]
+        label = labels_by_stem.get(stem, labels_by_stem.get(f"{stem}_annotee"))
+        if label is None:
+            print(f"Warning: no annotation named {stem}.<ext> or {stem}_annotee.<ext> for {image}, the image is skipped.")
+            continue
+        pairs.append((os.path.join(images_folder, image), os.path.join(labels_folder, label)))
+    return pairs
 
-def binarize_and_save_label_images(directory_path):
+def describe_image(path, read_shape=False):
     """
-    Binarizes label images and saves them back to the directory.
-    :param directory_path: Path to the directory containing label images.
+    Hashes a source image and, for TIFF slides, reads its size from the file header.
+    :param path: Path to the image.
+    :param read_shape: Whether to read the (height, width) of TIFF slides.
+    :return: Tuple (digest, shape), shape being None when it was not read.
     """
-    for filename in os.listdir(directory_path):
-        if filename.endswith('.png'):
-            source_path = os.path.join(directory_path, filename)
-            image = Image.open(source_path).convert('L')
-            image_array = np.array(image)
+    return hash_file(path), slide_shape(path) if read_shape and is_tiff(path) else None
 
-            binarized_array = np.where(image_array == 255, 1, 0).astype(np.uint8)
-            binarized_image = Image.fromarray(binarized_array)
-            binarized_image.save(source_path, format='PNG')
-    print("Binarization of labels completed.")
+def run_parallel(function, jobs, workers=1):
+    """
+    Applies a function to a list of argument tuples, in a process pool when more than one worker is requested.
+    :param function: Picklable function to apply.
+    :param jobs: List of argument tuples.
+    :param workers: Number of worker processes.
+    :return: List of results, in the order of the jobs.
+    """
+    if workers <= 1 or len(jobs) <= 1:
+        return [function(*job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(function, *zip(*jobs), chunksize=max(1, len(jobs) // (workers * 8))))
 
-def verify_binary_labels(directory_path):
+def load_manifest(dataset_folder, parameters):
     """
-    Verifies that label images in a directory are binary (i.e., contain only 0s and 1s).
-    :param directory_path: Path to the directory containing label images.
+    Loads the conversion manifest of a dataset folder.
+    If the manifest was written with other conversion parameters, the outputs it lists are removed and an empty manifest is returned.
+    :param dataset_folder: Path to the nnUNet dataset folder.
+    :param parameters: Dictionary of the current conversion parameters.
+    :return: Manifest dictionary with 'parameters' and 'cases' keys.
     """
-    for filename in os.listdir(directory_path):
-        if filename.endswith('.png'):
-            source_path = os.path.join(directory_path, filename)
-            image = Image.open(source_path)
-            image_array = np.array(image)
+    manifest_path = os.path.join(dataset_folder, MANIFEST_FILENAME)
+    empty_manifest = {"parameters": parameters, "cases": {}}
+    if not os.path.exists(manifest_path):
+        return empty_manifest
 
-            unique_values = np.unique(image_array)
-            if not set(unique_values).issubset({0, 1}):  
-                print(f"Binarization error detected in {filename}: unique values {unique_values}")
+    with open(manifest_path) as json_file:
+        manifest = json.load(json_file)
+    if manifest.get("parameters") != parameters:
+        print("Conversion parameters changed since the last run, all samples will be converted again.")
+        remove_case_outputs(dataset_folder, manifest.get("cases", {}).values())
+        for folder in PACKED_FOLDERS:
+            if os.path.isfile(os.path.join(dataset_folder, folder + PACK_EXTENSION)):
+                os.remove(os.path.join(dataset_folder, folder + PACK_EXTENSION))
+        return empty_manifest
+    return manifest
+
+def save_manifest(dataset_folder, manifest):
+    """
+    Atomically writes the conversion manifest into the dataset folder.
+    :param dataset_folder: Path to the nnUNet dataset folder.
+    :param manifest: Manifest dictionary.
+    """
+    manifest_path = os.path.join(dataset_folder, MANIFEST_FILENAME)
+    with open(manifest_path + '.tmp', 'w') as json_file:
+        json.dump(manifest, json_file, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def output_exists(dataset_folder, output):
+    """
+    Checks whether a converted output exists, either as a file or as a case of an NNPack container.
+    :param dataset_folder: Path to the nnUNet dataset folder.
+    :param output: Path of the output relative to the dataset folder.
+    :return: True if the output exists.
+    """
+    path = os.path.join(dataset_folder, output)
+    if not path.endswith(PACK_EXTENSION):
+        return os.path.exists(path)
+    from nnpack import contains_case
+    return contains_case(path)
+
+def remove_case_outputs(dataset_folder, cases):
+    """
+    Removes the converted files of manifest cases.
+    Cases packed in NNPack containers are not files: they are dropped when the containers are assembled again.
+    :param dataset_folder: Path to the nnUNet dataset folder.
+    :param cases: Iterable of manifest case entries.
+    """
+    for case in cases:
+        for output in (case.get("image_output"), case.get("label_output")):
+            if output is not None and os.path.exists(os.path.join(dataset_folder, output)):
+                os.remove(os.path.join(dataset_folder, output))
 
-def rename_images(directory_path, file_ending, training_case="axones"):
+def plan_conversion(samples, manifest, dataset_folder, training_case="axones", workers=1, tile_size=None, crop_size=None, crop_overlap=0, output_format="png"):
     """
-    Renames training images in a directory to a consistent naming convention.
-    :param directory_path: Path to the directory containing training images.
-    :param file_ending: File extension of the images to be renamed.
+    Compares the source samples with the manifest and lists the cases that need to be converted.
+    Known cases keep their index, new cases are appended after the highest index ever assigned,
+    and the very first sample of a dataset is kept for testing in imagesTs.
+    In tiled mode with a crop size, each TIFF slide is split into overlapping crops, each crop being its own case.
+    :param samples: List of (image_path, label_path) tuples.
+    :param manifest: Manifest dictionary of the previous run.
+    :param dataset_folder: Path to the nnUNet dataset folder.
     :param training_case: Prefix for the new file names.
+    :param workers: Number of worker processes used to hash the sources.
+    :param tile_size: Number of rows read at once from TIFF slides, None to load images fully with PIL.
+    :param crop_size: Side of the training crops cut from TIFF slides in tiled mode, None to keep whole slides.
+    :param crop_overlap: Number of pixels shared by neighbouring crops.
+    :param output_format: 'png' to write one file per case, 'nnpk' to pack the images of imagesTr and imagesTs into NNPack containers and
+        write each label as a single-case container. The nnpk jobs write the images into a staging folder, see assemble_packs.
+    :return: Tuple (jobs, job_keys, cases) with the convert_sample argument tuples, the manifest key of each job and the updated manifest cases.
     """
-    image_index = 1
-    filenames = sorted(os.listdir(directory_path))
-    
-    for filename in filenames:
-        source_path = os.path.join(directory_path, filename)
-        if filename.endswith(file_ending):
-            new_filename = f"{training_case}_{image_index:03d}_0000{file_ending}"
-            destination_path = os.path.join(directory_path, new_filename)
-            os.rename(source_path, destination_path)
-            image_index += 1        
-    print("Training image renaming complete.")
-
-def convert_images_to_png(source_folder, dest_folder):
-    """
-    Converts images from a source folder to PNG format and saves them in a destination folder.
-    :param source_folder: Path to the source folder containing images to convert.
-    :param dest_folder: Path to the destination folder where PNG images will be saved.
-    """
-    for filename in os.listdir(source_folder):
-        source_path = os.path.join(source_folder, filename)
-        dest_path = os.path.join(dest_folder, os.path.splitext(filename)[0] + '.png')
-        image = Image.open(source_path)
-        image = image.convert('L')
-        image.save(dest_path, format='PNG')
-
-def move_one_image_for_testing_and_remove_corresponding_label(images_tr_folder, labels_tr_folder, images_ts_folder):
-    """
-    Moves one training image to the testing folder and removes its corresponding label image.
-    :param images_tr_folder: Path to the training images folder.
-    :param labels_tr_folder: Path to the training labels folder.
-    :param images_ts_folder: Path to the testing images folder.
-    """
-    images = sorted(os.listdir(images_tr_folder))
-    if not images:
-        print("No images found in the training folder.")
-        return
-    
-    test_image = images[0]
-    test_image_path = os.path.join(images_tr_folder, test_image)
-    test_label = test_image.replace("_0000.png", ".png")
-    test_label_path = os.path.join(labels_tr_folder, test_label)
-
-    if not os.path.exists(images_ts_folder):
-        os.makedirs(images_ts_folder)
-    shutil.move(test_image_path, images_ts_folder)
-    print(f"Test image {test_image} moved to {images_ts_folder}.")
-
-    if os.path.exists(test_label_path):
-        os.remove(test_label_path)
-        print(f"Corresponding label {test_label} removed from {labels_tr_folder}.")
+    read_shape = tile_size is not None and crop_size is not None
+    image_descriptions = run_parallel(describe_image, [(image_path, read_shape) for image_path, _ in samples], workers)
+    label_digests = run_parallel(hash_file, [(label_path,) for _, label_path in samples], workers)
+    previous_cases = manifest["cases"]
+    next_index = max((case["index"] for case in previous_cases.values()), default=0) + 1
+    packed = output_format == "nnpk"
+    extension = PACK_EXTENSION if packed else ".png"
+    image_folder = os.path.join(dataset_folder, STAGING_FOLDER) if packed else dataset_folder
+
+    def split_folder(folder):
+        return folder + PACK_EXTENSION if packed and folder in PACKED_FOLDERS else folder
+
+    jobs = []
+    job_keys = []
+    cases = {}
+    for (image_path, label_path), (image_hash, shape), label_hash in zip(samples, image_descriptions, label_digests):
+        image_name = os.path.basename(image_path)
+        tiled = tile_size is not None and is_tiff(image_path)
+        windows = crop_windows(*shape, crop_size, crop_overlap) if tiled and shape is not None else [None]
+        keys = [image_name if window is None else f"{image_name}#{window[0]}_{window[1]}" for window in windows]
+        known_cases = [previous_cases[key] for key in keys if key in previous_cases]
+        is_test = known_cases[0]["label_output"] is None if known_cases else next_index == 1
+
+        for key, window in zip(keys, windows):
+            previous = previous_cases.get(key)
+            if previous is None:
+                index = next_index
+                next_index += 1
+            else:
+                index = previous["index"]
+
+            case_name = f"{training_case}_{index:03d}"
+            case = {
+                "label": os.path.basename(label_path),
+                "image_hash": image_hash,
+                "label_hash": label_hash,
+                "index": index,
+                "image_output": os.path.join(split_folder("imagesTs" if is_test else "imagesTr"), f"{case_name}_0000{extension}"),
+                "label_output": None if is_test else os.path.join(split_folder("labelsTr"), f"{case_name}{extension}"),
+            }
+            if window is not None:
+                case["window"] = list(window)
+            cases[key] = case
+
+            outputs = [case["image_output"]] + ([] if is_test else [case["label_output"]])
+            if previous is not None and "fingerprint" in previous:
+                case["fingerprint"] = previous["fingerprint"]
+            # Training cases converted before the fingerprint statistics were recorded are converted again
+            measured = is_test or "fingerprint" in case
+            if case == previous and measured and all(output_exists(dataset_folder, output) for output in outputs):
+                continue
+            case.pop("fingerprint", None)
+            job_keys.append(key)
+            jobs.append((image_path, label_path, os.path.join(image_folder, case["image_output"]),
+                         None if is_test else os.path.join(dataset_folder, case["label_output"]),
+                         window, tile_size if tiled else None))
+
+    removed_cases = [case for key, case in previous_cases.items() if key not in cases]
+    if removed_cases:
+        print(f"Removing {len(removed_cases)} case(s) whose source image no longer exists.")
+        remove_case_outputs(dataset_folder, removed_cases)
+    return jobs, job_keys, cases
+
+def unexpected_label_values(label_array):
+    """
+    Lists the values of a decoded grayscale annotation other than 0 (background) and 255 (foreground).
+    :param label_array: uint8 array of the annotation.
+    :return: Sorted array of the unexpected values, empty for a binary annotation.
+    """
+    return np.unique(label_array[(label_array != 0) & (label_array != 255)])
+
+def label_warning(label_path, values):
+    """
+    Formats the warning of an annotation that is not binary.
+    :param label_path: Path to the source annotation.
+    :param values: Unexpected values of the annotation.
+    :return: Warning message, None if there is no unexpected value.
+    """
+    if len(values) == 0:
+        return None
+    return f"Binarization warning for {os.path.basename(label_path)}: unexpected values {values} were converted to background (only 255 is foreground)"
+
+def binarize_label(label_array):
+    """
+    Binarizes a grayscale annotation: pixels at 255 become 1, all others 0.
+    :param label_array: uint8 array of the annotation.
+    :return: Binarized uint8 array.
+    """
+    return (label_array == 255).astype(np.uint8)
+
+def save_array(array, dest):
+    """
+    Writes a uint8 array as a .png image, or as a single-case NNPack container if the destination ends with .nnpk.
+    :param array: uint8 array.
+    :param dest: Destination path.
+    """
+    if dest.endswith(PACK_EXTENSION):
+        from nnpack import NNPackWriter, case_key
+        with NNPackWriter(dest) as writer:
+            writer.write_array(case_key(dest), array)
     else:
-        print(f"Corresponding label {test_label} not found in {labels_tr_folder}.")
+        Image.fromarray(array).save(dest, format='PNG')
 
+def stream_writer(dest, width, height):
+    """
+    Opens a band-by-band writer for a .png image, or for a single-case NNPack container if the destination ends with .nnpk.
+    :param dest: Destination path.
+    :param width: Width of the image.
+    :param height: Height of the image.
+    :return: Writer with a write_rows method, used as a context manager.
+    """
+    if not dest.endswith(PACK_EXTENSION):
+        return PNGStreamWriter(dest, width, height)
+    from nnpack import NNPackStreamWriter
+    return NNPackStreamWriter(dest, width, height)
 
-def convert_to_nnunet(input_folder, output_folder, channel_names, labels, num_training, file_ending, dataset_id="030", training_case="axones", overwrite_image_reader_writer=None):
+def convert_sample(image_path, label_path, image_dest, label_dest, window=None, tile_size=None):
+    """
+    Converts one image/label pair in a single pass: decode, grayscale, binarize, verify, measure the fingerprint statistics and write under the final nnUNet name.
+    In tiled mode the TIFF sources are read lazily, either one crop window or one band of tile_size rows at a time,
+    so that memory stays bounded by the crop or band size instead of the slide size.
+    :param image_path: Path to the source image.
+    :param label_path: Path to the source annotation.
+    :param image_dest: Destination path of the grayscale .png image (or single-case .nnpk container).
+    :param label_dest: Destination path of the binarized .png label (or single-case .nnpk container), or None to skip the label (test case).
+    :param window: Optional (y, x, height, width) crop window of the source slide.
+    :param tile_size: Number of rows read at once in tiled mode, None to load the images fully with PIL.
+    :return: Tuple (warning, statistics): warning message if the source annotation is not binary (None otherwise), and fingerprint statistics of the case (None for the test case).
+    """
+    for dest in (image_dest, label_dest):
+        if dest is not None:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if tile_size is None:
+        image_array = np.array(Image.open(image_path).convert('L'))
+        save_array(image_array, image_dest)
+        if label_dest is None:
+            return None, None
+        label_array = np.array(Image.open(label_path).convert('L'))
+        binarized_array = binarize_label(label_array)
+        save_array(binarized_array, label_dest)
+        return label_warning(label_path, unexpected_label_values(label_array)), case_statistics(image_array, binarized_array)
+
+    with SlideReader(image_path) as image_reader, (open_slide(label_path) if label_dest is not None else nullcontext()) as label_reader:
+        if label_reader is not None and label_reader.shape != image_reader.shape:
+            return f"Size mismatch between {os.path.basename(image_path)} {image_reader.shape} and {os.path.basename(label_path)} {label_reader.shape}", None
+        if window is not None:
+            image_array = image_reader.read_region(*window)
+            save_array(image_array, image_dest)
+            if label_reader is None:
+                return None, None
+            label_array = label_reader.read_region(*window)
+            binarized_array = binarize_label(label_array)
+            save_array(binarized_array, label_dest)
+            return label_warning(label_path, unexpected_label_values(label_array)), case_statistics(image_array, binarized_array)
+
+        # The image and label bands are read together, so that the statistics are measured in the same pass
+        height, width = image_reader.shape
+        statistics = CaseStatistics() if label_reader is not None else None
+        label_bands = label_reader.iter_bands(tile_size) if label_reader is not None else None
+        unexpected_values = set()
+        with stream_writer(image_dest, width, height) as image_writer, (stream_writer(label_dest, width, height) if label_reader is not None else nullcontext()) as label_writer:
+            for _, band in image_reader.iter_bands(tile_size):
+                image_writer.write_rows(band)
+                if label_writer is not None:
+                    _, label_band = next(label_bands)
+                    unexpected_values.update(unexpected_label_values(label_band).tolist())
+                    label_band = binarize_label(label_band)
+                    label_writer.write_rows(label_band)
+                    statistics.update(band, label_band)
+    if statistics is None:
+        return None, None
+    return label_warning(label_path, np.array(sorted(unexpected_values), dtype=np.uint8)), statistics.result()
+
+def convert_samples(jobs, workers=1):
+    """
+    Converts image/label pairs, in parallel when more than one worker is requested.
+    :param jobs: List of convert_sample argument tuples.
+    :param workers: Number of worker processes.
+    :return: List of the fingerprint statistics of each job, None for test cases.
+    """
+    statistics = []
+    for error, sample_statistics in run_parallel(convert_sample, jobs, workers):
+        if error is not None:
+            print(error)
+        statistics.append(sample_statistics)
+    return statistics
+
+def assemble_packs(dataset_folder, cases):
+    """
+    Assembles the NNPack container of each image folder (imagesTr.nnpk, imagesTs.nnpk) in case index order.
+    Converted cases are taken from their single-case containers in the staging folder, unchanged cases are copied from the
+    previous containers without decompressing them, and cases that are no longer listed are dropped.
+    :param dataset_folder: Path to the nnUNet dataset folder.
+    :param cases: Manifest cases of the conversion.
+    """
+    from nnpack import build_pack, case_key
+    staging_folder = os.path.join(dataset_folder, STAGING_FOLDER)
+    for folder in PACKED_FOLDERS:
+        container = os.path.join(dataset_folder, folder + PACK_EXTENSION)
+        entries = []
+        for case in sorted(cases.values(), key=lambda case: case["index"]):
+            output = case["image_output"]
+            if os.path.dirname(output) == folder + PACK_EXTENSION:
+                staged = os.path.join(staging_folder, output)
+                entries.append((staged if os.path.isfile(staged) else os.path.join(dataset_folder, output), case_key(output)))
+        if entries:
+            build_pack(container, entries)
+        elif os.path.isfile(container):
+            os.remove(container)
+    shutil.rmtree(staging_folder, ignore_errors=True)
+
+def packed_dataset(cases):
+    """
+    Lists the training cases of packed outputs for the 'dataset' entry of dataset.json, nnUNet cannot list the cases of a container.
+    :param cases: Manifest cases of the conversion.
+    :return: Dictionary mapping case identifiers to their 'images' and 'label' virtual paths.
+    """
+    from nnpack import case_key
+    return {case_key(case["label_output"]): {"images": [case["image_output"]], "label": case["label_output"]}
+            for case in sorted(cases.values(), key=lambda case: case["index"]) if case["label_output"] is not None}
+
+def write_fingerprint(dataset_folder, dataset_folder_name, cases):
+    """
+    Writes the nnUNet dataset fingerprint of the training cases into the dataset folder, and into the nnUNet_preprocessed folder
+    of the dataset when the environment variable is set, where nnUNetv2_plan_and_preprocess reuses it instead of reading the dataset again.
+    :param dataset_folder: Path to the nnUNet dataset folder.
+    :param dataset_folder_name: Name of the dataset folder, e.g. 'Dataset030_axones'.
+    :param cases: Manifest cases of the conversion.
+    """
+    statistics = [case.get("fingerprint") for case in sorted(cases.values(), key=lambda case: case["index"]) if case["label_output"] is not None]
+    fingerprint = dataset_fingerprint(statistics) if all(case is not None for case in statistics) else None
+    if fingerprint is None:
+        print("No dataset fingerprint written: some training labels are missing or no label has foreground pixels.")
+        return
+    folders = [dataset_folder]
+    if os.environ.get("nnUNet_preprocessed"):
+        folders.append(os.path.join(os.environ["nnUNet_preprocessed"], dataset_folder_name))
+    for path in save_fingerprint(fingerprint, folders):
+        print(f"Dataset fingerprint written to {path}")
+
+def convert_to_nnunet(input_folder, output_folder, channel_names, labels, num_training, file_ending, dataset_id="030", training_case="axones", overwrite_image_reader_writer=None, workers=1, tile_size=None, crop_size=None, crop_overlap=0, output_format="png"):
     """
     Converts datasets to the nnUNet format, including image renaming and binarization.
     :param input_folder: Path to the input dataset folder containing images and masks.
@@ -148,16 +425,19 @@ def convert_to_nnunet(input_folder, output_folder, channel_names, labels, num_tr
     :param dataset_id: Identifier for the dataset.
     :param training_case: Name for the training case.
     :param overwrite_image_reader_writer: Optional reader/writer configuration.
+    :param workers: Number of worker processes used for the conversion.
+    :param tile_size: Number of rows read at once from TIFF slides (tiled mode), None to load images fully with PIL.
+    :param crop_size: Side of the training crops cut from TIFF slides in tiled mode, None to keep whole slides.
+    :param crop_overlap: Number of pixels shared by neighbouring crops.
+    :param output_format: 'png' to write one file per case, 'nnpk' to pack the images into NNPack containers read with NNPackIO.
     """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {output_format}, expected one of {OUTPUT_FORMATS}.")
     dataset_folder_name = f"Dataset{dataset_id}_{training_case}"
     dataset_folder = os.path.join(output_folder, dataset_folder_name)
     os.makedirs(dataset_folder, exist_ok=True)
-    images_tr_folder = os.path.join(dataset_folder, "imagesTr")
-    labels_tr_folder = os.path.join(dataset_folder, "labelsTr")
-    images_ts_folder = os.path.join(dataset_folder, "imagesTs")
-    os.makedirs(images_tr_folder, exist_ok=True)
-    os.makedirs(labels_tr_folder, exist_ok=True)
-    os.makedirs(images_ts_folder, exist_ok=True)
+    for folder in SPLIT_FOLDERS if output_format == "png" else ("labelsTr",):
+        os.makedirs(os.path.join(dataset_folder, folder), exist_ok=True)
     images_folder = os.path.join(input_folder, "Images_entrainement")
     labels_folder = os.path.join(input_folder, "Images_annotees")
 
@@ -168,26 +448,31 @@ def convert_to_nnunet(input_folder, output_folder, channel_names, labels, num_tr
         print(f"The directory {labels_folder} does not exist or is empty.")
         return
 
-    print("Converting images and masks to .png format...")
-    convert_images_to_png(images_folder, images_tr_folder)
-    convert_images_to_png(labels_folder, labels_tr_folder)
-    
-    print("Binarizing labels...")
-    binarize_and_save_label_images(labels_tr_folder)
-
-    print("Verifying binary labels...")
-    verify_binary_labels(labels_tr_folder)
-
-    print("Renaming training images...")
-    rename_images(images_tr_folder,'.png', training_case)
+    parameters = {"version": MANIFEST_VERSION, "training_case": training_case, "label_foreground_value": 255}
+    if tile_size is not None and crop_size is not None:
+        parameters.update({"crop_size": crop_size, "crop_overlap": crop_overlap})
+    if output_format != "png":
+        parameters["output_format"] = output_format
+    manifest = load_manifest(dataset_folder, parameters)
+    samples = list_sample_pairs(images_folder, labels_folder)
+    jobs, job_keys, cases = plan_conversion(samples, manifest, dataset_folder, training_case, workers, tile_size, crop_size, crop_overlap, output_format)
+    print(f"Converting {len(jobs)} new or modified case(s) from {len(samples)} sample(s) with {workers} worker(s)...")
+    for key, statistics in zip(job_keys, convert_samples(jobs, workers)):
+        if statistics is not None:
+            cases[key]["fingerprint"] = statistics
+    dataset = None
+    if output_format == "nnpk":
+        assemble_packs(dataset_folder, cases)
+        dataset = packed_dataset(cases)
+        file_ending = PACK_EXTENSION
+        overwrite_image_reader_writer = "NNPackIO"
+    save_manifest(dataset_folder, {"parameters": parameters, "cases": cases})
 
-    print("Renaming label files...")
-    rename_labels(labels_tr_folder, training_case)
-
-    print("Moving a test image to 'imagesTs' and removing the corresponding mask...")
-    move_one_image_for_testing_and_remove_corresponding_label(images_tr_folder, labels_tr_folder, images_ts_folder)
-
-    create_dataset_json(dataset_folder, channel_names, labels, num_training, file_ending, overwrite_image_reader_writer)
+    create_dataset_json(dataset_folder, channel_names, labels, num_training, file_ending, overwrite_image_reader_writer, dataset)
+    if file_ending in (".png", PACK_EXTENSION) and overwrite_image_reader_writer in COMPATIBLE_READER_WRITERS:
+        write_fingerprint(dataset_folder, dataset_folder_name, cases)
+    else:
+        print(f"No dataset fingerprint written: the statistics of the converted images may not match the {file_ending} reader of nnUNet.")
     print("Conversion completed successfully!")
 
 def main():
@@ -203,8 +488,14 @@ def main():
     parser.add_argument("--overwrite_image_reader_writer", help="ReaderWriter optionnel", default=None)
     parser.add_argument("--dataset_id", help="Dataset identifier, default is '030'", default=default_dataset_id)
     parser.add_argument("--training_case", help="Training case name, default is 'axones'", default=default_training_case_name)
+    parser.add_argument("--workers", type=int, help="Number of worker processes, default is the number of CPUs", default=os.cpu_count())
+    parser.add_argument("--tile_size", type=int, help="Enable the tiled mode for TIFF slides, reading them lazily by bands of this many rows. Default: disabled", default=None)
+    parser.add_argument("--crop_size", type=int, help="In tiled mode, cut TIFF slides into square training crops of this size. Default: whole slides", default=None)
+    parser.add_argument("--crop_overlap", type=int, help="Overlap in pixels between neighbouring crops, default is 0", default=0)
+    parser.add_argument("--output_format", choices=OUTPUT_FORMATS, help="'png' writes one file per case, 'nnpk' packs the images into chunked NNPack containers (one per folder) and writes the labels as single-case containers, read with the NNPackIO reader/writer. Default is png", default="png")
     args = parser.parse_args()
-    convert_to_nnunet(args.input_folder, args.output_folder, channel_names, labels, args.num_training, args.file_ending, args.dataset_id, args.training_case, args.overwrite_image_reader_writer)
+    convert_to_nnunet(args.input_folder, args.output_folder, channel_names, labels, args.num_training, args.file_ending, args.dataset_id, args.training_case, args.overwrite_image_reader_writer, args.workers,
+                      args.tile_size, args.crop_size, args.crop_overlap, args.output_format)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,186 @@
+"""
+nnUNet dataset fingerprint computed while the dataset is converted.
+
+nnUNet's planning starts by reading every training case again to extract the dataset fingerprint: the spacing and
+the shape of each case once cropped to its nonzero bounding box, and the intensity statistics of the foreground
+pixels. The converter already decodes each image and label, so it accumulates the same statistics in the same pass,
+band by band for whole slides, and keeps them per case in its manifest. The statistics of a case are its shapes and
+the 256-bin histogram of its foreground pixels (the images are 8-bit grayscale): histograms add up across bands,
+workers and conversion runs, and the moments and percentiles of the dataset are read from the merged histogram.
+
+The fingerprint is written as dataset_fingerprint.json, which nnUNetv2_plan_and_preprocess reuses (unless --clean
+is given) instead of extracting it again.
+"""
+
+import json
+import os
+
+import numpy as np
+
+FINGERPRINT_FILENAME = 'dataset_fingerprint.json'
+
+# Spacing given to 2D images by nnUNet's NaturalImage2DIO (and NNPackIO)
+NATURAL_IMAGE_SPACING = [999.0, 1.0, 1.0]
+
+# Reader/writers whose images match the statistics of the converter: grayscale, 2D, with the spacing above
+COMPATIBLE_READER_WRITERS = (None, 'NaturalImage2DIO', 'NNPackIO')
+
+PERCENTILES = (0.5, 50.0, 99.5)
+
+
+class CaseStatistics:
+    """
+    Statistics of one training case, accumulated over bands of rows of its image and binarized label.
+    """
+
+    def __init__(self):
+        self.height = 0
+        self.width = None
+        self.first_row = None
+        self.last_row = None
+        self.nonzero_columns = None
+        # Foreground pixels at 0 are kept per row, as they only count inside the nonzero bounding box
+        self.histogram = np.zeros(256, dtype=np.int64)
+        self.zero_foreground_rows = []
+
+    def update(self, image: np.ndarray, label: np.ndarray):
+        """
+        Add the next band of rows of the case.
+
+        Args:
+            image (np.ndarray): uint8 image band of shape (n, width).
+            label (np.ndarray): Binarized label band of shape (n, width).
+        """
+        nonzero = image != 0
+        rows = np.flatnonzero(nonzero.any(axis=1))
+        if rows.size:
+            self.first_row = self.height + rows[0] if self.first_row is None else self.first_row
+            self.last_row = self.height + rows[-1]
+        columns = nonzero.any(axis=0)
+        self.nonzero_columns = columns if self.nonzero_columns is None else self.nonzero_columns | columns
+        self.height += image.shape[0]
+        self.width = image.shape[1]
+
+        foreground = label > 0
+        self.histogram += np.bincount(image[foreground & nonzero], minlength=256)
+        self.zero_foreground_rows.append(np.count_nonzero(foreground & ~nonzero, axis=1))
+
+    def result(self) -> dict:
+        """
+        Summarize the case. Like nnUNet's crop_to_nonzero, a case without nonzero pixel is not cropped.
+
+        Returns:
+            dict: 'shape' and 'shape_after_crop' as [height, width], and 'foreground_histogram' as 256 counts.
+        """
+        histogram = self.histogram.copy()
+        shape_after_crop = [self.height, self.width]
+        if self.first_row is not None:
+            columns = np.flatnonzero(self.nonzero_columns)
+            shape_after_crop = [int(self.last_row - self.first_row + 1), int(columns[-1] - columns[0] + 1)]
+            # Foreground pixels at 0 left or right of the bounding box are still counted, which only matters for
+            # labelled columns of zeros on the border of a slide
+            zero_rows = np.concatenate(self.zero_foreground_rows)
+            histogram[0] += int(zero_rows[self.first_row:self.last_row + 1].sum())
+        else:
+            histogram[0] += int(sum(rows.sum() for rows in self.zero_foreground_rows))
+        return {'shape': [self.height, self.width], 'shape_after_crop': shape_after_crop,
+                'foreground_histogram': histogram.tolist()}
+
+
+def case_statistics(image: np.ndarray, label: np.ndarray) -> dict:
+    """
+    Compute the statistics of a case held in memory.
+
+    Args:
+        image (np.ndarray): uint8 image of shape (height, width).
+        label (np.ndarray): Binarized label of the same shape.
+
+    Returns:
+        dict: Statistics of the case, see CaseStatistics.result.
+    """
+    statistics = CaseStatistics()
+    statistics.update(image, label)
+    return statistics.result()
+
+
+def histogram_percentile(values: np.ndarray, weights: np.ndarray, percentile: float) -> float:
+    """
+    Compute a percentile of weighted values with the linear interpolation of np.percentile.
+
+    Args:
+        values (np.ndarray): Sorted values.
+        weights (np.ndarray): Number of occurrences of each value.
+        percentile (float): Percentile, between 0 and 100.
+
+    Returns:
+        float: Percentile.
+    """
+    cumulative = np.cumsum(weights)
+    position = percentile / 100 * (cumulative[-1] - 1)
+    lower = values[np.searchsorted(cumulative, np.floor(position), side='right')]
+    upper = values[np.searchsorted(cumulative, np.ceil(position), side='right')]
+    return float(lower + (upper - lower) * (position - np.floor(position)))
+
+
+def dataset_fingerprint(cases: list) -> dict:
+    """
+    Merge the statistics of the training cases into an nnUNet dataset fingerprint.
+
+    nnUNet samples the same number of foreground pixels from every case, so the histograms are normalized per case
+    before being added, and the intensity properties are those of that sample's expected distribution.
+
+    Args:
+        cases (list): Statistics of the training cases, see CaseStatistics.result.
+
+    Returns:
+        dict: Fingerprint, in the format of nnUNet's DatasetFingerprintExtractor. None if no case has foreground.
+    """
+    histograms = [np.asarray(case['foreground_histogram'], dtype=np.float64) for case in cases]
+    histograms = [histogram / histogram.sum() for histogram in histograms if histogram.sum() > 0]
+    if not histograms:
+        return None
+    # Integer weights for the percentiles, as if each case contributed the same number of samples
+    pooled = np.rint(np.sum(histograms, axis=0) * 10000).astype(np.int64)
+    values = np.flatnonzero(pooled)
+    weights = pooled[values]
+    mean = float(np.average(values, weights=weights))
+    percentile_00_5, median, percentile_99_5 = (histogram_percentile(values, weights, p) for p in PERCENTILES)
+    return {
+        'spacings': [NATURAL_IMAGE_SPACING for _ in cases],
+        'shapes_after_crop': [[1] + case['shape_after_crop'] for case in cases],
+        'foreground_intensity_properties_per_channel': {
+            '0': {
+                'mean': mean,
+                'median': median,
+                'std': float(np.sqrt(np.average((values - mean) ** 2, weights=weights))),
+                'min': float(values[0]),
+                'max': float(values[-1]),
+                'percentile_99_5': percentile_99_5,
+                'percentile_00_5': percentile_00_5,
+            }
+        },
+        'median_relative_size_after_cropping': float(np.median(
+            [np.prod(case['shape_after_crop']) / np.prod(case['shape']) for case in cases])),
+    }
+
+
+def save_fingerprint(fingerprint: dict, folders: list) -> list:
+    """
+    Write the fingerprint in each folder.
+
+    Args:
+        fingerprint (dict): Dataset fingerprint.
+        folders (list): Folders to write dataset_fingerprint.json into, created if needed.
+
+    Returns:
+        list: Paths to the written files.
+    """
+    paths = []
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, FINGERPRINT_FILENAME)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(fingerprint, f, indent=4)
+        os.replace(path + '.tmp', path)
+        paths.append(path)
+    return paths
@@ -0,0 +1,315 @@
+"""
+This script exports the folds of a trained nnUNetv2 model to optimized CPU inference backends, and checks their
+parity with the fp32 checkpoints.
+
+Each fold is exported next to its checkpoint as a traced TorchScript graph and/or an ONNX graph, optionally
+quantized to int8 with onnxruntime: dynamically (weights quantized ahead of time, activations at run time) or
+statically (activations calibrated on patches of real images). The artefacts are used by nnunet_inference.py with
+--backend. The parity check segments images with the fp32 checkpoints and with every exported backend, and reports
+the Dice between their masks (and against reference labels, if given) next to their inference times.
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+from calibrate_presets import dice_score, list_labelled_cases
+from inference_backends import BACKENDS, artefact_path, example_input, import_onnxruntime
+from nnunet_inference import PRESETS, get_preset_folds, load_predictor
+
+EXPORTED_BACKENDS = [backend for backend in BACKENDS if backend != 'pytorch']
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """
+    Parse command line arguments.
+
+    Returns:
+        argparse.ArgumentParser: Argument parser.
+    """
+    parser = argparse.ArgumentParser(description='Export nnUNet folds to TorchScript/ONNX and check their parity')
+    parser.add_argument('--path-model', required=True,
+                        help='Path to the model directory. This folder should contain individual folders '
+                        'like fold_0, fold_1, etc. The artefacts are written in the fold folders.')
+    parser.add_argument('--folds', nargs='+', type=int, default=None,
+                        help='Folds to export. If not specified, all available folds. Default: None')
+    parser.add_argument('--use-best-checkpoint', action='store_true', default=False,
+                        help='Export the best checkpoint (instead of the final checkpoint). Default: False')
+    parser.add_argument('--backends', nargs='+', default=['torchscript', 'onnx'], choices=EXPORTED_BACKENDS,
+                        help='Backends to export: "torchscript" (traced graph), "onnx", "onnx-int8-dynamic" and '
+                        '"onnx-int8-static" (int8 quantized with onnxruntime). Default: torchscript onnx')
+    parser.add_argument('--path-calibration', default=None,
+                        help='Folder of images (named <case>_0000<ext>) whose patches calibrate the activations of '
+                        'the statically quantized model. Required for onnx-int8-static.')
+    parser.add_argument('--num-calibration-patches', default=32, type=int,
+                        help='Number of patches used for the static calibration. Default: 32')
+    parser.add_argument('--path-parity-images', default=None,
+                        help='Folder of images (named <case>_0000<ext>) segmented with the fp32 checkpoints and every '
+                        'exported backend to check their parity. Default: None (no parity check)')
+    parser.add_argument('--path-parity-labels', default=None,
+                        help='Folder of the reference labels of the parity images (named <case><ext>), to also '
+                        'report the Dice of every backend against them. Default: None')
+    parser.add_argument('--preset', default='accurate', choices=list(PRESETS),
+                        help='Speed/accuracy preset of the parity check. Default: accurate')
+    parser.add_argument('--path-report', default=None,
+                        help='Path to a JSON file in which the parity report is saved. Default: None')
+
+    return parser
+
+
+def list_images(path_images: str, file_ending: str) -> list:
+    """
+    List the images of a folder, named <case>_0000<file_ending>.
+
+    Args:
+        path_images (str): Folder of the images.
+        file_ending (str): File ending of the dataset.
+
+    Returns:
+        list: Sorted (case, image path) tuples.
+    """
+    cases = [(f[:-len('_0000' + file_ending)], os.path.join(path_images, f)) for f in sorted(os.listdir(path_images))
+             if f.endswith('_0000' + file_ending)]
+    if not cases:
+        raise ValueError('No image named <case>_0000{} found in {}'.format(file_ending, path_images))
+    return cases
+
+
+def export_torchscript(network: torch.nn.Module, x: torch.Tensor, path: str):
+    """
+    Trace a network and save its TorchScript graph.
+
+    Args:
+        network (torch.nn.Module): Network in eval mode.
+        x (torch.Tensor): Example input patch.
+        path (str): Path to the graph.
+    """
+    with torch.no_grad():
+        traced = torch.jit.trace(network, x)
+    traced.save(path)
+
+
+def export_onnx(network: torch.nn.Module, x: torch.Tensor, path: str):
+    """
+    Export a network to an ONNX graph, with a dynamic batch size.
+
+    Args:
+        network (torch.nn.Module): Network in eval mode.
+        x (torch.Tensor): Example input patch.
+        path (str): Path to the graph.
+    """
+    with torch.no_grad():
+        torch.onnx.export(network, (x,), path, input_names=['input'], output_names=['logits'],
+                          dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}}, dynamo=False)
+
+
+def calibration_patches(predictor, path_images: str, num_patches: int, seed: int = 0) -> list:
+    """
+    Sample preprocessed patches of real images, to calibrate the activations of a statically quantized model.
+
+    Args:
+        predictor (nnUNetPredictor): Initialized predictor.
+        path_images (str): Folder of the images.
+        num_patches (int): Number of patches.
+        seed (int): Seed of the patch positions.
+
+    Returns:
+        list: float32 arrays of shape (1, channels, *patch_size).
+    """
+    rng = np.random.default_rng(seed)
+    reader_writer = predictor.plans_manager.image_reader_writer_class()
+    preprocessor = predictor.configuration_manager.preprocessor_class(verbose=False)
+    patch_size = list(predictor.configuration_manager.patch_size)
+    images = list_images(path_images, predictor.dataset_json['file_ending'])[:num_patches]
+    preprocessed = []
+    for _, path_image in images:
+        image, properties = reader_writer.read_images([path_image])
+        data, _, _ = preprocessor.run_case_npy(image, None, properties, predictor.plans_manager,
+                                               predictor.configuration_manager, predictor.dataset_json)
+        # 2D configurations are (channels, 1, H, W); images smaller than a patch are padded like nnUNet does
+        data = data[:, 0] if data.ndim == len(patch_size) + 2 else data
+        padding = [(0, 0)] + [(0, max(0, p - s)) for p, s in zip(patch_size, data.shape[1:])]
+        preprocessed.append(np.pad(data, padding))
+
+    patches = []
+    for n in range(num_patches):
+        data = preprocessed[n % len(preprocessed)]
+        start = [rng.integers(0, s - p + 1) for p, s in zip(patch_size, data.shape[1:])]
+        patch = data[(slice(None),) + tuple(slice(s, s + p) for s, p in zip(start, patch_size))]
+        patches.append(np.ascontiguousarray(patch[None], dtype=np.float32))
+    return patches
+
+
+def quantize_onnx(path_fp32: str, path_int8: str, mode: str, patches: list = None):
+    """
+    Quantize an ONNX graph to int8 with onnxruntime.
+
+    Args:
+        path_fp32 (str): Path to the fp32 graph.
+        path_int8 (str): Path to the quantized graph.
+        mode (str): 'dynamic' or 'static'.
+        patches (list): Calibration patches, required for static quantization.
+    """
+    import_onnxruntime()
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, \
+        quantize_static
+
+    if mode == 'dynamic':
+        # onnxruntime's ConvInteger kernel takes unsigned weights
+        quantize_dynamic(path_fp32, path_int8, weight_type=QuantType.QUInt8)
+        return
+
+    class PatchReader(CalibrationDataReader):
+        def __init__(self):
+            self.patches = iter(patches)
+
+        def get_next(self):
+            patch = next(self.patches, None)
+            return {'input': patch} if patch is not None else None
+
+    quantize_static(path_fp32, path_int8, PatchReader(), quant_format=QuantFormat.QDQ)
+
+
+def export_folds(args) -> list:
+    """
+    Export the folds of the model to the requested backends.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+
+    Returns:
+        list: Paths to the artefacts.
+    """
+    checkpoint_name = 'checkpoint_final.pth' if not args.use_best_checkpoint else 'checkpoint_best.pth'
+    folds = get_preset_folds(args.path_model, args.folds)
+    predictor = load_predictor(args.path_model, folds, use_best_checkpoint=args.use_best_checkpoint)
+    network = predictor.network.eval()
+    x = example_input(predictor)
+    patches = None
+    if 'onnx-int8-static' in args.backends:
+        if args.path_calibration is None:
+            raise ValueError('--path-calibration is required to export onnx-int8-static.')
+        patches = calibration_patches(predictor, args.path_calibration, args.num_calibration_patches)
+
+    written = []
+    for fold, params in zip(folds, predictor.list_of_parameters):
+        network.load_state_dict(params)
+        path_onnx = artefact_path(args.path_model, fold, checkpoint_name, 'onnx')
+        if 'torchscript' in args.backends:
+            export_torchscript(network, x, artefact_path(args.path_model, fold, checkpoint_name, 'torchscript'))
+            written.append(artefact_path(args.path_model, fold, checkpoint_name, 'torchscript'))
+        if any(backend.startswith('onnx') for backend in args.backends):
+            # The quantized graphs are derived from the fp32 graph
+            export_onnx(network, x, path_onnx)
+            if 'onnx' in args.backends:
+                written.append(path_onnx)
+        for backend, mode in [('onnx-int8-dynamic', 'dynamic'), ('onnx-int8-static', 'static')]:
+            if backend in args.backends:
+                quantize_onnx(path_onnx, artefact_path(args.path_model, fold, checkpoint_name, backend), mode,
+                              patches)
+                written.append(artefact_path(args.path_model, fold, checkpoint_name, backend))
+        if 'onnx' not in args.backends and os.path.isfile(path_onnx):
+            os.remove(path_onnx)
+    return written
+
+
+def check_parity(args) -> list:
+    """
+    Segment the parity images with the fp32 checkpoints and with every exported backend, and compare the masks.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+
+    Returns:
+        list: Report of each backend: inference time, Dice against the fp32 masks and, with labels, against the
+        reference.
+    """
+    with open(os.path.join(args.path_model, 'dataset.json')) as f:
+        file_ending = json.load(f)['file_ending']
+    if args.path_parity_labels is not None:
+        cases = list_labelled_cases(args.path_parity_images, args.path_parity_labels, file_ending)
+    else:
+        cases = [(case, path_image, None) for case, path_image in list_images(args.path_parity_images, file_ending)]
+
+    results, reference_masks = [], {}
+    for backend in ['pytorch'] + args.backends:
+        predictor = load_predictor(args.path_model, args.folds, use_best_checkpoint=args.use_best_checkpoint,
+                                   preset=args.preset, backend=backend)
+        predictor.allow_tqdm = False
+        reader_writer = predictor.plans_manager.image_reader_writer_class()
+        labels = [int(label) for label in predictor.label_manager.foreground_labels]
+        dice_fp32 = {label: [] for label in labels}
+        dice_reference = {label: [] for label in labels}
+        inference_time = 0.0
+        for case, path_image, path_label in cases:
+            image, properties = reader_writer.read_images([path_image])
+            start = time.perf_counter()
+            segmentation = np.asarray(predictor.predict_single_npy_array(image, properties)).reshape(-1)
+            inference_time += time.perf_counter() - start
+            if backend == 'pytorch':
+                reference_masks[case] = segmentation
+            if path_label is not None:
+                reference, _ = reader_writer.read_seg(path_label)
+                reference = np.asarray(reference).reshape(-1)
+            for label in labels:
+                dice_fp32[label].append(dice_score(segmentation, reference_masks[case], label))
+                if path_label is not None:
+                    dice_reference[label].append(dice_score(segmentation, reference, label))
+
+        def mean(scores):
+            return float(np.nanmean(scores)) if len(scores) and not np.all(np.isnan(scores)) else float('nan')
+
+        all_scores = [score for scores in dice_fp32.values() for score in scores]
+        results.append({
+            'backend': backend,
+            'num_cases': len(cases),
+            'seconds_per_case': inference_time / len(cases),
+            'dice_vs_fp32_per_label': {str(label): mean(scores) for label, scores in dice_fp32.items()},
+            'min_dice_vs_fp32': mean([]) if np.all(np.isnan(all_scores)) else float(np.nanmin(all_scores)),
+            'dice_vs_reference_per_label': {str(label): mean(scores) for label, scores in dice_reference.items()}
+            if args.path_parity_labels is not None else None,
+        })
+        if args.path_parity_labels is not None:
+            results[-1]['mean_dice_vs_reference'] = mean(list(results[-1]['dice_vs_reference_per_label'].values()))
+    return results
+
+
+def main():
+    """
+    Main function to run the script.
+    """
+    parser = get_parser()
+    args = parser.parse_args()
+
+    for path in export_folds(args):
+        print('Exported {}'.format(path))
+
+    if args.path_parity_images is None:
+        return
+    results = check_parity(args)
+    fp32 = results[0]
+    print('----------------------------------------------------')
+    print('{:<18} {:>10} {:>8} {:>14} {:>14} {:>12}'.format(
+        'Backend', 's/case', 'Speedup', 'Dice vs fp32', 'Min vs fp32', 'Dice delta'))
+    for r in results:
+        r['speedup'] = fp32['seconds_per_case'] / r['seconds_per_case']
+        r['dice_delta'] = r['mean_dice_vs_reference'] - fp32['mean_dice_vs_reference'] \
+            if args.path_parity_labels is not None else None
+        print('{:<18} {:>10.2f} {:>7.1f}x {:>14.4f} {:>14.4f} {:>12}'.format(
+            r['backend'], r['seconds_per_case'], r['speedup'],
+            float(np.nanmean(list(r['dice_vs_fp32_per_label'].values()))), r['min_dice_vs_fp32'],
+            '{:+.4f}'.format(r['dice_delta']) if r['dice_delta'] is not None else '-'))
+    print('----------------------------------------------------')
+
+    if args.path_report is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.path_report)), exist_ok=True)
+        with open(args.path_report, 'w') as f:
+            json.dump({'path_model': os.path.abspath(args.path_model), 'results': results}, f, indent=2)
+        print('Parity report written to {}'.format(args.path_report))
+
+if __name__ == '__main__':
+    main()
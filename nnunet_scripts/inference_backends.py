@@ -0,0 +1,151 @@
+"""
+Exported inference backends of the nnUNet network: TorchScript and ONNX graphs, and int8 quantized ONNX graphs.
+
+The artefacts are written by export_model.py next to the checkpoints of each fold, e.g.
+'fold_0/checkpoint_final.onnx'. A predictor switched to an exported backend keeps nnUNet's sliding-window logic
+(Gaussian weighting, mirroring, fold ensembling): only the forward pass of the network on each patch is replaced.
+The ONNX backends require onnxruntime.
+"""
+
+import os
+
+import numpy as np
+import torch
+
+# Suffix of the artefact of each backend, appended to the checkpoint name without its extension
+BACKENDS = {
+    'pytorch': None,
+    'torchscript': '.torchscript.pt',
+    'onnx': '.onnx',
+    'onnx-int8-dynamic': '.int8_dynamic.onnx',
+    'onnx-int8-static': '.int8_static.onnx',
+}
+
+# Key of the fake state dicts that select the fold of an ExportedNetwork
+FOLD_KEY = '_exported_fold'
+
+
+def artefact_path(path_model: str, fold: int, checkpoint_name: str, backend: str) -> str:
+    """
+    Get the path to the artefact of a fold for a backend.
+
+    Args:
+        path_model (str): Path to the model directory, containing fold_0, fold_1, etc.
+        fold (int): Fold number.
+        checkpoint_name (str): Name of the exported checkpoint, e.g. 'checkpoint_final.pth'.
+        backend (str): Exported backend, one of BACKENDS except 'pytorch'.
+
+    Returns:
+        str: Path to the artefact.
+    """
+    return os.path.join(path_model, f'fold_{fold}', os.path.splitext(checkpoint_name)[0] + BACKENDS[backend])
+
+
+def import_onnxruntime():
+    """
+    Import onnxruntime, with an explicit error if it is not installed.
+
+    Returns:
+        module: onnxruntime.
+    """
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError('The ONNX backends require onnxruntime (pip install onnxruntime).')
+    return onnxruntime
+
+
+class OnnxRunner:
+    """
+    Forward pass of an ONNX graph with onnxruntime. The session is created on the first call, so that it uses the
+    number of torch threads set for the prediction.
+
+    Args:
+        path (str): Path to the ONNX graph.
+        device (torch.device): Device of the predictor.
+    """
+
+    def __init__(self, path: str, device: torch.device):
+        self.path = path
+        self.device = device
+        self.session = None
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        if self.session is None:
+            onnxruntime = import_onnxruntime()
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = torch.get_num_threads()
+            providers = ['CPUExecutionProvider']
+            if self.device.type == 'cuda':
+                providers.insert(0, 'CUDAExecutionProvider')
+            self.session = onnxruntime.InferenceSession(self.path, options, providers=providers)
+        inputs = {self.session.get_inputs()[0].name: x.detach().float().cpu().numpy()}
+        return torch.from_numpy(self.session.run(None, inputs)[0]).to(x.device)
+
+
+class ExportedNetwork(torch.nn.Module):
+    """
+    Stand-in for the network of an nnUNetPredictor running exported artefacts. The predictor loads the weights of
+    each fold with network.load_state_dict(params) before predicting with it: its list of parameters is replaced by
+    dicts holding the index of the fold, which select the artefact.
+
+    Args:
+        runners (list): Callables running the forward pass of each fold.
+    """
+
+    def __init__(self, runners: list):
+        super().__init__()
+        # A plain list, so that moving the stand-in to a device leaves the artefacts alone
+        self.runners = list(runners)
+        self.fold_index = 0
+
+    def load_state_dict(self, state_dict: dict, strict: bool = True, assign: bool = False):
+        self.fold_index = state_dict[FOLD_KEY]
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.runners[self.fold_index](x)
+
+
+def use_exported_backend(predictor, path_model: str, folds: list, checkpoint_name: str, backend: str):
+    """
+    Switch an initialized predictor to the exported artefacts of its folds.
+
+    Args:
+        predictor (nnUNetPredictor): Predictor initialized with the same folds and checkpoint.
+        path_model (str): Path to the model directory.
+        folds (list): Folds of the predictor, in the order of its parameters.
+        checkpoint_name (str): Name of the exported checkpoint.
+        backend (str): Exported backend, one of BACKENDS except 'pytorch'.
+
+    Returns:
+        nnUNetPredictor: The predictor.
+    """
+    paths = [artefact_path(path_model, fold, checkpoint_name, backend) for fold in folds]
+    missing = [path for path in paths if not os.path.isfile(path)]
+    if missing:
+        raise FileNotFoundError('Missing {} artefacts: {}. Create them with export_model.py.'.format(
+            backend, ', '.join(missing)))
+    if backend == 'torchscript':
+        runners = [torch.jit.load(path, map_location=predictor.device).eval() for path in paths]
+    else:
+        import_onnxruntime()
+        runners = [OnnxRunner(path, predictor.device) for path in paths]
+    predictor.network = ExportedNetwork(runners)
+    predictor.list_of_parameters = [{FOLD_KEY: i} for i in range(len(folds))]
+    return predictor
+
+
+def example_input(predictor, batch_size: int = 1) -> torch.Tensor:
+    """
+    Build a random input patch of the network.
+
+    Args:
+        predictor (nnUNetPredictor): Initialized predictor.
+        batch_size (int): Number of patches.
+
+    Returns:
+        torch.Tensor: float32 tensor of shape (batch_size, channels, *patch_size).
+    """
+    num_channels = len(predictor.dataset_json['channel_names'])
+    return torch.from_numpy(np.random.default_rng(0).standard_normal(
+        (batch_size, num_channels, *predictor.configuration_manager.patch_size), dtype=np.float32))
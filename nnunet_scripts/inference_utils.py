@@ -0,0 +1,140 @@
+"""
+Lightweight helpers shared by the inference scripts and the converter. This module does not import torch or
+nnunetv2 and has no import side effect, so that thin clients can use it without paying their import cost.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+
+# Extension of the NNPack containers (nnpack.PACK_EXTENSION), whose cases are listed as virtual paths
+PACK_EXTENSION = '.nnpk'
+
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Compute the SHA-256 of a file, reading it by chunks.
+
+    Args:
+        path (str): Path to the file.
+        chunk_size (int): Number of bytes read at once.
+
+    Returns:
+        str: Hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def splitext(fname: str) -> tuple:
+    """
+    Split a fname (folder/file + ext) into a folder/file and extension.
+
+    Args:
+        fname (str): File name.
+
+    Returns:
+        tuple: Folder/file and extension.
+    """
+    dir, filename = os.path.split(fname)
+    for special_ext in ['.nii.gz', '.tar.gz','.png']:
+        if filename.endswith(special_ext):
+            stem, ext = filename[:-len(special_ext)], special_ext
+            return os.path.join(dir, stem), ext
+    stem, ext = os.path.splitext(filename)
+    return os.path.join(dir, stem), ext
+
+
+def add_suffix(fname: str, suffix: str) -> str:
+    """
+    Add suffix between end of file name and extension.
+
+    Args:
+        fname (str): File name.
+        suffix (str): Suffix.
+
+    Returns:
+        str: File name with suffix.
+    """
+    stem, ext = splitext(fname)
+    return os.path.join(stem + suffix + ext)
+
+
+def get_prediction_paths(path_images: list, path_out: str) -> list:
+    """
+    Get the truncated output file names (without extension) of individual images, as '<image>_pred'.
+
+    Args:
+        path_images (list): Paths to the images.
+        path_out (str): Path to the output directory.
+
+    Returns:
+        list: Truncated output file names.
+    """
+    path_preds = []
+    for f in path_images:
+        fname = Path(f).name
+        fname = fname.rstrip(''.join(Path(fname).suffixes))
+        path_preds.append(os.path.join(path_out, add_suffix(fname, '_pred')))
+    return path_preds
+
+
+def get_dataset_prediction_paths(path_images: list, path_out: str) -> list:
+    """
+    Get the truncated output file names (without extension) of dataset images, named after the images.
+
+    Args:
+        path_images (list): Paths to the images.
+        path_out (str): Path to the output directory.
+
+    Returns:
+        list: Truncated output file names.
+    """
+    return [os.path.join(path_out, os.path.basename(splitext(f)[0])) for f in path_images]
+
+
+def mask_file_ending(file_ending: str) -> str:
+    """
+    Get the file ending of the masks predicted by a model, from the file ending of its dataset. Containers only hold
+    training data: the masks of a model trained on a packed dataset are written as .png.
+
+    Args:
+        file_ending (str): File ending of the dataset.
+
+    Returns:
+        str: File ending of the masks.
+    """
+    return '.png' if file_ending == PACK_EXTENSION else file_ending
+
+
+def list_dataset_images(path_dataset: str, file_endings: tuple = ('.nii.gz', '.png')) -> list:
+    """
+    List the images of a dataset folder that can be segmented. If '.nnpk' is one of the file endings, the cases of
+    the NNPack containers of the folder are listed as virtual paths '<container>/<key>.nnpk', and the dataset may
+    also be a container itself (e.g. imagesTs.nnpk).
+
+    Args:
+        path_dataset (str): Path to the dataset folder, or to an NNPack container.
+        file_endings (tuple): File endings of the images to list.
+
+    Returns:
+        list: Paths to the images, sorted by file, then in container order.
+    """
+    if path_dataset.endswith(PACK_EXTENSION) and PACK_EXTENSION in file_endings and os.path.isfile(path_dataset):
+        from nnpack import list_cases
+        return list_cases(path_dataset)
+    images = []
+    for f in sorted(os.listdir(path_dataset)):
+        path = os.path.join(path_dataset, f)
+        if not f.endswith(file_endings):
+            continue
+        if f.endswith(PACK_EXTENSION) and os.path.isfile(path):
+            # nnpack imports nnunetv2, so it is only imported when a container is found
+            from nnpack import list_cases
+            images += list_cases(path)
+        else:
+            images.append(path)
+    return images
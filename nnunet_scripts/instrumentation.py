@@ -0,0 +1,277 @@
+"""
+Per-stage timing and memory instrumentation of the inference pipeline.
+
+The stages of each image (waiting for the preprocessing workers, sliding-window prediction, post-processing, writing,
+metrics, ...) are timed with their wall-clock and CPU time, the peak RSS of the process and the number of torch
+threads. Each stage is appended as one JSON line to a trace file, and a summary table per stage is printed at the end
+of the run. The prediction stage can optionally be captured with cProfile or torch.profiler.
+
+The nnUNet predictor is instrumented by wrapping the methods of the instance, so that nnUNet itself is not modified.
+When the instrumentation is disabled, stages are a shared no-op context manager and the predictor is left untouched.
+"""
+
+import contextlib
+import cProfile
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+
+from system_resources import available_cpus
+
+PROFILERS = ('cprofile', 'torch')
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def peak_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    """
+    Get the peak resident set size.
+
+    Args:
+        who (int): resource.RUSAGE_SELF for this process, resource.RUSAGE_CHILDREN for its terminated children.
+
+    Returns:
+        float: Peak RSS in MB.
+    """
+    max_rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return max_rss / 1024 ** 2 if sys.platform == 'darwin' else max_rss / 1024
+
+
+def cpu_time(who: int = resource.RUSAGE_SELF) -> float:
+    """
+    Get the user and system CPU time.
+
+    Args:
+        who (int): resource.RUSAGE_SELF or resource.RUSAGE_CHILDREN.
+
+    Returns:
+        float: CPU time in seconds.
+    """
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Instrumentation:
+    """
+    Timers of the stages of the inference, written to a JSON-lines trace and summarized at the end of the run.
+
+    Args:
+        trace_path (str): Path to the JSON-lines trace. None to only print the summary.
+        enabled (bool): Instrument the run even without trace or profiler, to print the summary. When the run is
+            not instrumented, every method is a no-op.
+        profiler (str): Profiler capturing the prediction stage, one of PROFILERS, or None. cProfile accumulates over
+            all the predictions; torch.profiler captures the first prediction only, as its traces are large.
+        profile_dir (str): Folder of the profiler outputs ('predict.prof' or 'predict_torch_trace.json').
+    """
+
+    def __init__(self, trace_path: str = None, enabled: bool = False, profiler: str = None, profile_dir: str = '.'):
+        self.enabled = enabled or trace_path is not None or profiler is not None
+        self.trace_path = trace_path
+        self.profiler = profiler
+        self.profile_dir = profile_dir
+        self.image = None
+        self._durations = {}
+        self._cpu = {}
+        self._trace = None
+        self._cprofile = None
+        self._torch_profiled = False
+        if not self.enabled:
+            return
+        if profiler is not None and profiler not in PROFILERS:
+            raise ValueError(f'Unknown profiler {profiler}, expected one of {PROFILERS}.')
+        if trace_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(trace_path)), exist_ok=True)
+            self._trace = open(trace_path, 'w')
+        if profiler == 'cprofile':
+            self._cprofile = cProfile.Profile()
+        self._start = time.perf_counter()
+        self._start_cpu = cpu_time()
+        self._write({'event': 'run', 'argv': sys.argv, 'platform': platform.platform(),
+                     'python': platform.python_version(), 'torch': torch.__version__,
+                     'cpu_count': os.cpu_count(), 'available_cpus': available_cpus(),
+                     'torch_threads': torch.get_num_threads(), 'torch_interop_threads': torch.get_num_interop_threads()})
+
+    def _write(self, record: dict):
+        if self._trace is not None:
+            self._trace.write(json.dumps(record) + '\n')
+            self._trace.flush()
+
+    def set_image(self, image: str):
+        """
+        Set the image the next stages are attributed to.
+
+        Args:
+            image (str): Path to the image, None for stages of the whole run.
+        """
+        if self.enabled:
+            self.image = image
+
+    @contextlib.contextmanager
+    def _stage(self, name: str, image: str):
+        start, start_cpu = time.perf_counter(), cpu_time()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, cpu_time() - start_cpu, image, start)
+
+    def stage(self, name: str, image: str = None):
+        """
+        Time a stage, as a context manager.
+
+        Args:
+            name (str): Name of the stage.
+            image (str): Path to the image the stage processes. If None, the image set by set_image.
+
+        Returns:
+            Context manager timing the stage.
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return self._stage(name, image if image is not None else self.image)
+
+    def record(self, name: str, duration: float, cpu: float = None, image: str = None, start: float = None):
+        """
+        Record a stage timed elsewhere.
+
+        Args:
+            name (str): Name of the stage.
+            duration (float): Wall-clock duration in seconds.
+            cpu (float): CPU time of the main process during the stage, in seconds.
+            image (str): Path to the image the stage processes.
+            start (float): time.perf_counter() at the start of the stage, None if it just ended.
+        """
+        if not self.enabled:
+            return
+        start = start if start is not None else time.perf_counter() - duration
+        self._durations.setdefault(name, []).append(duration)
+        self._cpu.setdefault(name, []).append(cpu if cpu is not None else np.nan)
+        self._write({'event': 'stage', 'stage': name, 'image': image, 'start_s': round(start - self._start, 6),
+                     'duration_s': round(duration, 6), 'cpu_s': round(cpu, 6) if cpu is not None else None,
+                     'peak_rss_mb': round(peak_rss_mb(), 1), 'torch_threads': torch.get_num_threads()})
+
+    def instrument_predictor(self, predictor):
+        """
+        Time the stages run inside an nnUNetPredictor: waiting for the preprocessed images ('preprocess'), the
+        sliding-window prediction and ensembling of each image ('predict'), and waiting for the export workers to
+        finish once all the images are predicted ('export'). Only this instance is modified.
+
+        Args:
+            predictor (nnUNetPredictor): Initialized predictor.
+
+        Returns:
+            nnUNetPredictor: The predictor.
+        """
+        if not self.enabled:
+            return predictor
+        instrumentation = self
+        get_data_iterator = predictor._internal_get_data_iterator_from_lists_of_filenames
+        predict_from_data_iterator = predictor.predict_from_data_iterator
+        predict_logits = predictor.predict_logits_from_preprocessed_data
+        last_predict_end = [None]
+
+        def timed_iterator(input_list_of_lists, *args, **kwargs):
+            # The preprocessing runs in background workers, in the order of the inputs: only the wait is visible here
+            iterator = iter(get_data_iterator(input_list_of_lists, *args, **kwargs))
+            images = iter(input_list_of_lists)
+            while True:
+                start, start_cpu = time.perf_counter(), cpu_time()
+                # The iterator is run to its end, so that it joins its workers
+                preprocessed = next(iterator, None)
+                if preprocessed is None:
+                    break
+                instrumentation.set_image(next(images, [None])[0])
+                instrumentation.record('preprocess', time.perf_counter() - start, cpu_time() - start_cpu,
+                                       instrumentation.image, start)
+                yield preprocessed
+
+        def timed_predict_from_data_iterator(*args, **kwargs):
+            last_predict_end[0] = time.perf_counter()
+            result = predict_from_data_iterator(*args, **kwargs)
+            # The exports run asynchronously while the next images are predicted: only the final wait is visible here
+            instrumentation.record('export', time.perf_counter() - last_predict_end[0])
+            instrumentation.set_image(None)
+            return result
+
+        def timed_predict_logits(data):
+            with instrumentation.stage('predict'), instrumentation._profile():
+                prediction = predict_logits(data)
+            last_predict_end[0] = time.perf_counter()
+            return prediction
+
+        predictor._internal_get_data_iterator_from_lists_of_filenames = timed_iterator
+        predictor.predict_from_data_iterator = timed_predict_from_data_iterator
+        predictor.predict_logits_from_preprocessed_data = timed_predict_logits
+        return predictor
+
+    @contextlib.contextmanager
+    def _profile(self):
+        if self._cprofile is not None:
+            self._cprofile.enable()
+            try:
+                yield
+            finally:
+                self._cprofile.disable()
+        elif self.profiler == 'torch' and not self._torch_profiled:
+            self._torch_profiled = True
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            with torch.profiler.profile(activities=activities) as profiler:
+                yield
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profiler.export_chrome_trace(os.path.join(self.profile_dir, 'predict_torch_trace.json'))
+        else:
+            yield
+
+    def summary(self) -> str:
+        """
+        Build the summary table of the stages.
+
+        Returns:
+            str: Table with the number of calls, total, mean and maximum duration, share of the run time and CPU
+            utilization of the main process (CPU time / wall-clock time / available CPUs) of each stage.
+        """
+        wall = time.perf_counter() - self._start
+        lines = ['{:<14} {:>7} {:>10} {:>9} {:>9} {:>7} {:>7}'.format(
+            'stage', 'calls', 'total (s)', 'mean (s)', 'max (s)', '% run', '% cpu')]
+        for name, durations in self._durations.items():
+            total, cpu = float(np.sum(durations)), float(np.nansum(self._cpu[name]))
+            lines.append('{:<14} {:>7} {:>10.2f} {:>9.3f} {:>9.3f} {:>7.1f} {:>7.1f}'.format(
+                name, len(durations), total, total / len(durations), max(durations), 100 * total / wall,
+                100 * cpu / total / available_cpus() if total > 0 else 0.0))
+        lines.append('Run: {:.2f} s, {:.1f}% CPU on {} available CPUs, {} torch threads, peak RSS {:.0f} MB '
+                     '(workers: {:.0f} MB)'.format(
+                         wall, 100 * (cpu_time() - self._start_cpu) / wall / available_cpus() if wall > 0 else 0.0,
+                         available_cpus(), torch.get_num_threads(), peak_rss_mb(),
+                         peak_rss_mb(resource.RUSAGE_CHILDREN)))
+        return '\n'.join(lines)
+
+    def close(self):
+        """
+        Print the summary, write it to the trace and save the cProfile capture.
+        """
+        if not self.enabled:
+            return
+        print(self.summary())
+        self._write({'event': 'summary', 'wall_s': round(time.perf_counter() - self._start, 6),
+                     'cpu_s': round(cpu_time() - self._start_cpu, 6),
+                     'workers_cpu_s': round(cpu_time(resource.RUSAGE_CHILDREN), 6),
+                     'peak_rss_mb': round(peak_rss_mb(), 1),
+                     'workers_peak_rss_mb': round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1),
+                     'stages': {name: {'calls': len(d), 'total_s': round(float(np.sum(d)), 6)}
+                                for name, d in self._durations.items()}})
+        if self._cprofile is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir, 'predict.prof')
+            self._cprofile.dump_stats(path)
+            print('cProfile capture of the prediction stage written to {} (python -m pstats {})'.format(path, path))
+        if self._trace is not None:
+            self._trace.close()
+            print('Trace written to {}'.format(self.trace_path))
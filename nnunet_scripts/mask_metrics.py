@@ -0,0 +1,310 @@
+"""
+Streaming morphometry of predicted masks, for nerve area and axon density estimation.
+
+A mask is consumed band by band, from top to bottom, so that whole slides are measured without holding them in
+memory. For each class, the foreground area, the connected components (labelled per band and merged across band
+borders with a union-find) and the convex hull of the foreground are accumulated. One report row per class and
+image is appended to a CSV or Parquet file as soon as the image is done.
+"""
+
+import csv
+import os
+
+import numpy as np
+from scipy import ndimage
+
+from postprocessing import read_mask
+from tiled_io import SlideReader, is_tiff
+
+# Components are 8-connected
+STRUCTURE = np.ones((3, 3), dtype=bool)
+
+REPORT_FIELDS = [
+    'image', 'output', 'label', 'label_value', 'height', 'width', 'pixel_size_um',
+    'area_px', 'area_um2', 'area_fraction',
+    'num_components', 'component_px_min', 'component_px_p10', 'component_px_median', 'component_px_mean',
+    'component_px_p90', 'component_px_max',
+    'hull_area_px', 'hull_area_um2', 'hull_fill_fraction', 'bbox_y0', 'bbox_x0', 'bbox_y1', 'bbox_x1',
+]
+
+
+def convex_hull(points: np.ndarray) -> np.ndarray:
+    """
+    Compute the convex hull of 2D points with Andrew's monotone chain.
+
+    Args:
+        points (np.ndarray): Points of shape (N, 2).
+
+    Returns:
+        np.ndarray: Vertices of the hull in counter-clockwise order, of shape (M, 2).
+    """
+    points = np.unique(points, axis=0)
+    if len(points) <= 2:
+        return points
+
+    def half_hull(sorted_points):
+        hull = []
+        for p in sorted_points:
+            while len(hull) >= 2 and ((hull[-1][0] - hull[-2][0]) * (p[1] - hull[-2][1])
+                                      - (hull[-1][1] - hull[-2][1]) * (p[0] - hull[-2][0])) <= 0:
+                hull.pop()
+            hull.append(tuple(p))
+        return hull
+
+    lower, upper = half_hull(points), half_hull(points[::-1])
+    return np.array(lower[:-1] + upper[:-1])
+
+
+def polygon_area(vertices: np.ndarray) -> float:
+    """
+    Compute the area of a simple polygon with the shoelace formula.
+
+    Args:
+        vertices (np.ndarray): Vertices of shape (M, 2), in order.
+
+    Returns:
+        float: Area.
+    """
+    if len(vertices) < 3:
+        return 0.0
+    y, x = vertices[:, 0].astype(np.float64), vertices[:, 1].astype(np.float64)
+    return float(abs(np.dot(y, np.roll(x, -1)) - np.dot(x, np.roll(y, -1))) / 2)
+
+
+class _ClassAccumulator:
+    """
+    Area, connected components and convex hull of one class, accumulated band by band.
+    """
+
+    def __init__(self):
+        self.area = 0
+        self.parent = []
+        self.sizes = []
+        self.previous_row = None
+        self.hull = np.zeros((0, 2), dtype=np.int64)
+
+    def _find(self, i: int) -> int:
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def update(self, y: int, band: np.ndarray):
+        self.area += int(band.sum())
+        labels, num_labels = ndimage.label(band, structure=STRUCTURE)
+        offset = len(self.parent)
+        self.parent.extend(range(offset, offset + num_labels))
+        self.sizes.extend(np.bincount(labels.ravel(), minlength=num_labels + 1)[1:].tolist())
+        global_labels = np.where(labels > 0, labels + offset - 1, -1)
+
+        # Merge the components touching the last row of the previous band, including diagonally
+        if self.previous_row is not None and num_labels:
+            first_row = global_labels[0]
+            pairs = []
+            for shift in (-1, 0, 1):
+                above = np.roll(self.previous_row, shift)
+                if shift == -1:
+                    above[-1] = -1
+                elif shift == 1:
+                    above[0] = -1
+                touching = (above >= 0) & (first_row >= 0)
+                pairs.append(np.stack([above[touching], first_row[touching]], axis=1))
+            for a, b in np.unique(np.concatenate(pairs), axis=0):
+                root_a, root_b = self._find(int(a)), self._find(int(b))
+                if root_a != root_b:
+                    self.parent[max(root_a, root_b)] = min(root_a, root_b)
+        self.previous_row = global_labels[-1]
+
+        # The hull of the pixel squares only depends on the extreme pixels of each row
+        rows = np.flatnonzero(band.any(axis=1))
+        if len(rows):
+            first = band[rows].argmax(axis=1)
+            last = band.shape[1] - band[rows, ::-1].argmax(axis=1)
+            rows = rows + y
+            corners = np.concatenate([np.stack([rows, first], 1), np.stack([rows, last], 1),
+                                      np.stack([rows + 1, first], 1), np.stack([rows + 1, last], 1)])
+            self.hull = convex_hull(np.concatenate([self.hull, corners]))
+
+    def component_sizes(self) -> np.ndarray:
+        roots = np.array([self._find(i) for i in range(len(self.parent))], dtype=np.int64)
+        sizes = np.bincount(roots, weights=self.sizes, minlength=len(self.parent)) if len(roots) else np.zeros(0)
+        return sizes[np.unique(roots)] if len(roots) else sizes
+
+
+class MaskMetrics:
+    """
+    Metrics of a mask of class indices, fed band by band from top to bottom.
+
+    Args:
+        labels (dict): Foreground classes to measure, as {name: value}.
+        pixel_size (float): Size of a pixel in micrometers, None if unknown.
+    """
+
+    def __init__(self, labels: dict, pixel_size: float = None):
+        self.labels = {name: value for name, value in labels.items() if value != 0}
+        self.pixel_size = pixel_size
+        self.height, self.width = 0, None
+        self._classes = {name: _ClassAccumulator() for name in self.labels}
+
+    def update(self, band: np.ndarray):
+        """
+        Add the next rows of the mask.
+
+        Args:
+            band (np.ndarray): Class indices of shape (rows, W).
+        """
+        for name, value in self.labels.items():
+            self._classes[name].update(self.height, band == value)
+        self.height += band.shape[0]
+        self.width = band.shape[1]
+
+    def rows(self, image: str, output: str) -> list:
+        """
+        Build the report rows of the mask, one per class.
+
+        Args:
+            image (str): Path to the image.
+            output (str): Path to the predicted mask.
+
+        Returns:
+            list: Report rows, as dicts with the REPORT_FIELDS keys.
+        """
+        um2 = self.pixel_size ** 2 if self.pixel_size is not None else None
+        rows = []
+        for name, value in self.labels.items():
+            accumulator = self._classes[name]
+            sizes = accumulator.component_sizes()
+            hull_area = polygon_area(accumulator.hull)
+            row = {
+                'image': image, 'output': output, 'label': name, 'label_value': value,
+                'height': self.height, 'width': self.width, 'pixel_size_um': self.pixel_size,
+                'area_px': accumulator.area, 'area_um2': accumulator.area * um2 if um2 else None,
+                'area_fraction': accumulator.area / (self.height * self.width) if self.height else 0.0,
+                'num_components': len(sizes),
+                'hull_area_px': hull_area, 'hull_area_um2': hull_area * um2 if um2 else None,
+                'hull_fill_fraction': accumulator.area / hull_area if hull_area else None,
+            }
+            for key, function in [('min', np.min), ('p10', lambda s: np.percentile(s, 10)), ('median', np.median),
+                                  ('mean', np.mean), ('p90', lambda s: np.percentile(s, 90)), ('max', np.max)]:
+                row[f'component_px_{key}'] = float(function(sizes)) if len(sizes) else None
+            if len(accumulator.hull):
+                (y0, x0), (y1, x1) = accumulator.hull.min(axis=0), accumulator.hull.max(axis=0)
+                row.update(bbox_y0=int(y0), bbox_x0=int(x0), bbox_y1=int(y1), bbox_x1=int(x1))
+            else:
+                row.update(bbox_y0=None, bbox_x0=None, bbox_y1=None, bbox_x1=None)
+            rows.append(row)
+        return rows
+
+
+def measure_mask(mask: np.ndarray, labels: dict, pixel_size: float = None, band_height: int = 1024) -> MaskMetrics:
+    """
+    Measure a mask held in memory, band by band.
+
+    Args:
+        mask (np.ndarray): 2D mask of class indices.
+        labels (dict): Foreground classes to measure, as {name: value}.
+        pixel_size (float): Size of a pixel in micrometers.
+        band_height (int): Number of rows labelled at once.
+
+    Returns:
+        MaskMetrics: Metrics of the mask.
+    """
+    metrics = MaskMetrics(labels, pixel_size)
+    for y in range(0, mask.shape[0], band_height):
+        metrics.update(mask[y:y + band_height])
+    return metrics
+
+
+def measure_mask_file(path: str, labels: dict, pixel_size: float = None, to_class_indices=None,
+                      band_height: int = 1024) -> MaskMetrics:
+    """
+    Measure a mask written on disk. TIFF masks are read band by band.
+
+    Args:
+        path (str): Path to the mask.
+        labels (dict): Foreground classes to measure, as {name: value}.
+        pixel_size (float): Size of a pixel in micrometers.
+        to_class_indices (callable): Function mapping the grayscale values of the file back to class indices,
+            None if the file holds class indices.
+        band_height (int): Number of rows read at once.
+
+    Returns:
+        MaskMetrics: Metrics of the mask.
+    """
+    to_class_indices = to_class_indices or (lambda band: band)
+    if is_tiff(path):
+        metrics = MaskMetrics(labels, pixel_size)
+        with SlideReader(path) as reader:
+            for _, band in reader.iter_bands(band_height):
+                metrics.update(to_class_indices(band))
+        return metrics
+    return measure_mask(to_class_indices(read_mask(path)), labels, pixel_size, band_height)
+
+
+class MetricsReport:
+    """
+    Report to which metric rows are appended as soon as they are computed. A CSV report is appended to across runs;
+    a Parquet report (requires pyarrow) is rewritten with its previous rows when reopened, and is only complete once
+    closed.
+
+    Args:
+        path (str): Path to the report, ending with .csv or .parquet.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if path.endswith('.parquet'):
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ImportError('Writing Parquet reports requires pyarrow (pip install pyarrow).')
+            self._pa = pa
+            schema = pa.schema([(f, pa.string() if f in ('image', 'output', 'label') else pa.float64())
+                                for f in REPORT_FIELDS])
+            previous = pq.read_table(path) if os.path.isfile(path) else None
+            self._writer = pq.ParquetWriter(path, schema)
+            self._schema = schema
+            if previous is not None:
+                self._writer.write_table(previous.cast(schema))
+            self._file = None
+        else:
+            is_new = not os.path.isfile(path) or os.path.getsize(path) == 0
+            self._file = open(path, 'a', newline='')
+            self._writer = csv.DictWriter(self._file, fieldnames=REPORT_FIELDS)
+            if is_new:
+                self._writer.writeheader()
+
+    def write(self, rows: list):
+        """
+        Append rows to the report.
+
+        Args:
+            rows (list): Report rows, as dicts with the REPORT_FIELDS keys.
+        """
+        if not rows:
+            return
+        if self._file is not None:
+            self._writer.writerows(rows)
+            self._file.flush()
+        else:
+            columns = {f: [row[f] for row in rows] for f in REPORT_FIELDS}
+            self._writer.write_table(self._pa.Table.from_pydict(columns, schema=self._schema))
+
+    def close(self):
+        """
+        Close the report.
+        """
+        if self._file is not None:
+            self._file.close()
+        else:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
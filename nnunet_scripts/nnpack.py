@@ -0,0 +1,612 @@
+"""
+NNPack: a packed, chunked and compressed container of 2D arrays, with an nnUNet reader/writer.
+
+A container ('.nnpk' file) holds named uint8 arrays, e.g. all the images of imagesTr. Each array is cut into chunks
+of rows and columns, compressed separately with zlib, and located through an index stored at the end of the file.
+The file is memory-mapped, so that one case, or one crop of a case, is read by decompressing only the chunks it
+overlaps, without touching the rest of the container:
+
+    header: b'NNPK', format version (uint32), offset and length of the index (uint64)
+    chunks: compressed chunks of all the arrays
+    index: JSON {'version', 'arrays': {key: {'shape', 'dtype', 'chunk_shape', 'compression', 'chunks'}}}, the chunks
+           being the (offset, length) of each chunk in row-major order
+
+nnUNet reads the cases through virtual paths '<container>.nnpk/<key>.nnpk' listed in the 'dataset' entry of
+dataset.json, or through single-case containers, with the NNPackIO reader/writer selected by
+'overwrite_image_reader_writer'. nnUNet only looks for
+reader/writers in its nnunetv2.imageio package, where this module must be installed with 'python nnpack.py --install'.
+This module therefore only depends on NumPy and nnUNet.
+"""
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import zlib
+from typing import List, Tuple, Union
+
+import numpy as np
+from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
+from nnunetv2.imageio.natural_image_reader_writer import NaturalImage2DIO
+
+PACK_EXTENSION = '.nnpk'
+MAGIC = b'NNPK'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sIQQ')
+DEFAULT_CHUNK_SHAPE = (256, 256)
+
+# Name of this module once installed in nnunetv2.imageio
+INSTALLED_MODULE_NAME = 'nnpack_reader_writer.py'
+
+
+class NNPack:
+    """
+    Read-only, memory-mapped access to a container.
+
+    Args:
+        path (str): Path to the container.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, index_offset, index_length = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not an NNPack container.')
+        if version > FORMAT_VERSION:
+            raise ValueError(f'{path} has format version {version}, this reader supports up to {FORMAT_VERSION}.')
+        self.index = json.loads(self._mmap[index_offset:index_offset + index_length].decode())
+        self.arrays = self.index['arrays']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.arrays
+
+    def keys(self) -> list:
+        """
+        List the arrays of the container.
+
+        Returns:
+            list: Keys of the arrays, in the order they were written.
+        """
+        return list(self.arrays)
+
+    def shape(self, key: str) -> tuple:
+        """
+        Get the shape of an array without reading it.
+
+        Args:
+            key (str): Key of the array.
+
+        Returns:
+            tuple: Shape of the array.
+        """
+        return tuple(self.arrays[key]['shape'])
+
+    def raw_chunk(self, key: str, index: int) -> memoryview:
+        """
+        Get the stored bytes of a chunk, without decompressing them.
+
+        Args:
+            key (str): Key of the array.
+            index (int): Index of the chunk, in row-major order.
+
+        Returns:
+            memoryview: Bytes of the chunk, in the memory-mapped file.
+        """
+        offset, length = self.arrays[key]['chunks'][index]
+        return memoryview(self._mmap)[offset:offset + length]
+
+    def _chunk(self, key: str, row: int, col: int) -> np.ndarray:
+        array = self.arrays[key]
+        height, width = array['shape'][:2]
+        chunk_height, chunk_width = array['chunk_shape']
+        num_cols = -(-width // chunk_width)
+        data = self.raw_chunk(key, row * num_cols + col)
+        if array['compression'] == 'zlib':
+            data = zlib.decompress(data)
+        shape = (min(chunk_height, height - row * chunk_height), min(chunk_width, width - col * chunk_width))
+        return np.frombuffer(data, dtype=array['dtype']).reshape(shape + tuple(array['shape'][2:]))
+
+    def read_region(self, key: str, y: int, x: int, height: int, width: int) -> np.ndarray:
+        """
+        Read a region of an array, decompressing only the chunks it overlaps.
+
+        Args:
+            key (str): Key of the array.
+            y (int): First row of the region.
+            x (int): First column of the region.
+            height (int): Number of rows of the region.
+            width (int): Number of columns of the region.
+
+        Returns:
+            np.ndarray: Region of shape (height, width, ...), clipped to the array.
+        """
+        array = self.arrays[key]
+        shape = array['shape']
+        chunk_height, chunk_width = array['chunk_shape']
+        y0, x0 = max(0, y), max(0, x)
+        y1, x1 = min(shape[0], y + height), min(shape[1], x + width)
+        region = np.empty((max(0, y1 - y0), max(0, x1 - x0)) + tuple(shape[2:]), dtype=array['dtype'])
+        for row in range(y0 // chunk_height, -(-y1 // chunk_height)):
+            for col in range(x0 // chunk_width, -(-x1 // chunk_width)):
+                chunk = self._chunk(key, row, col)
+                cy, cx = row * chunk_height, col * chunk_width
+                sy0, sx0 = max(y0, cy), max(x0, cx)
+                sy1, sx1 = min(y1, cy + chunk.shape[0]), min(x1, cx + chunk.shape[1])
+                region[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = chunk[sy0 - cy:sy1 - cy, sx0 - cx:sx1 - cx]
+        return region
+
+    def read(self, key: str) -> np.ndarray:
+        """
+        Read a whole array.
+
+        Args:
+            key (str): Key of the array.
+
+        Returns:
+            np.ndarray: Array.
+        """
+        height, width = self.arrays[key]['shape'][:2]
+        return self.read_region(key, 0, 0, height, width)
+
+    def close(self):
+        """
+        Close the container.
+        """
+        self._mmap.close()
+        self._file.close()
+
+
+class _ArrayStreamWriter:
+    # Rows are buffered until a row of chunks is complete, then compressed chunk by chunk
+
+    def __init__(self, pack, key: str, shape: tuple, dtype, chunk_shape: tuple):
+        self.pack = pack
+        self.key = key
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_shape = tuple(chunk_shape)
+        self.chunks = []
+        self._rows = []
+        self._num_buffered = 0
+        self._rows_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+
+    def _flush(self, rows: np.ndarray):
+        for x in range(0, self.shape[1], self.chunk_shape[1]):
+            self.chunks.append(self.pack._write_chunk(np.ascontiguousarray(rows[:, x:x + self.chunk_shape[1]])))
+
+    def write_rows(self, rows: np.ndarray):
+        """
+        Append rows to the array.
+
+        Args:
+            rows (np.ndarray): Array of shape (n, width, ...).
+        """
+        if rows.shape[1:] != self.shape[1:]:
+            raise ValueError(f'Expected rows of shape (n, {", ".join(map(str, self.shape[1:]))}), got {rows.shape}.')
+        self._rows.append(rows.astype(self.dtype, copy=False))
+        self._num_buffered += rows.shape[0]
+        if self._num_buffered < self.chunk_shape[0]:
+            return
+        buffered = np.concatenate(self._rows)
+        complete = self._num_buffered - self._num_buffered % self.chunk_shape[0]
+        for y in range(0, complete, self.chunk_shape[0]):
+            self._flush(buffered[y:y + self.chunk_shape[0]])
+        self._rows = [buffered[complete:]] if complete < self._num_buffered else []
+        self._num_buffered -= complete
+        self._rows_written += complete
+
+    def close(self):
+        """
+        Write the last rows and add the array to the index of the container.
+        """
+        if self._num_buffered:
+            self._flush(np.concatenate(self._rows))
+            self._rows_written += self._num_buffered
+        if self._rows_written != self.shape[0]:
+            raise ValueError(f'{self.key}: {self._rows_written} rows written, expected {self.shape[0]}.')
+        self.pack._add_index(self.key, self.shape, self.dtype, self.chunk_shape, self.chunks)
+
+
+class NNPackWriter:
+    """
+    Write a container. The container is written to a temporary file and moved to its path when closed, so that
+    readers never see a partial container.
+
+    Args:
+        path (str): Path to the container.
+        compression_level (int): zlib compression level, 0 to store the chunks uncompressed.
+    """
+
+    def __init__(self, path: str, compression_level: int = 6):
+        self.path = path
+        self.compression_level = compression_level
+        self._arrays = {}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._tmp_path = path + '.tmp'
+        self._file = open(self._tmp_path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self._tmp_path)
+
+    def _write_bytes(self, data) -> list:
+        offset = self._file.tell()
+        self._file.write(data)
+        return [offset, len(data)]
+
+    def _write_chunk(self, chunk: np.ndarray) -> list:
+        data = chunk.tobytes()
+        return self._write_bytes(zlib.compress(data, self.compression_level) if self.compression_level else data)
+
+    def _add_index(self, key: str, shape: tuple, dtype, chunk_shape: tuple, chunks: list, compression: str = None):
+        if key in self._arrays:
+            raise ValueError(f'The container already holds an array {key}.')
+        self._arrays[key] = {
+            'shape': list(shape), 'dtype': np.dtype(dtype).str, 'chunk_shape': list(chunk_shape),
+            'compression': compression or ('zlib' if self.compression_level else 'none'), 'chunks': chunks,
+        }
+
+    def array_writer(self, key: str, shape: tuple, dtype=np.uint8,
+                     chunk_shape: tuple = DEFAULT_CHUNK_SHAPE) -> _ArrayStreamWriter:
+        """
+        Start writing an array row band by row band, without holding it in memory. Only one array can be streamed at
+        a time.
+
+        Args:
+            key (str): Key of the array.
+            shape (tuple): Shape of the array, (height, width) or (height, width, channels).
+            dtype: Data type of the array.
+            chunk_shape (tuple): Number of rows and columns of the chunks.
+
+        Returns:
+            Writer with a write_rows method, to be closed (or used as a context manager) once all the rows are written.
+        """
+        return _ArrayStreamWriter(self, key, shape, dtype, chunk_shape)
+
+    def write_array(self, key: str, array: np.ndarray, chunk_shape: tuple = DEFAULT_CHUNK_SHAPE):
+        """
+        Write a whole array.
+
+        Args:
+            key (str): Key of the array.
+            array (np.ndarray): Array of shape (height, width) or (height, width, channels).
+            chunk_shape (tuple): Number of rows and columns of the chunks.
+        """
+        with self.array_writer(key, array.shape, array.dtype, chunk_shape) as writer:
+            writer.write_rows(array)
+
+    def copy_array(self, source: NNPack, key: str, new_key: str = None):
+        """
+        Copy an array from another container, without decompressing its chunks.
+
+        Args:
+            source (NNPack): Source container.
+            key (str): Key of the array in the source.
+            new_key (str): Key of the array in this container, None to keep the key.
+        """
+        array = source.arrays[key]
+        chunks = [self._write_bytes(source.raw_chunk(key, i)) for i in range(len(array['chunks']))]
+        self._add_index(new_key or key, array['shape'], array['dtype'], array['chunk_shape'], chunks,
+                        array['compression'])
+
+    def close(self):
+        """
+        Write the index and move the container to its path.
+        """
+        index = json.dumps({'version': FORMAT_VERSION, 'arrays': self._arrays}).encode()
+        index_offset, index_length = self._write_bytes(index)
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, FORMAT_VERSION, index_offset, index_length))
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+
+class NNPackStreamWriter:
+    """
+    Write a single 2D uint8 array as its own container, row band by row band, with the interface of
+    tiled_io.PNGStreamWriter.
+
+    Args:
+        path (str): Path to the container. The key of the array is the file name without its extension.
+        width (int): Width of the array.
+        height (int): Height of the array.
+        compression_level (int): zlib compression level.
+    """
+
+    def __init__(self, path: str, width: int, height: int, compression_level: int = 6):
+        self._pack = NNPackWriter(path, compression_level)
+        self._array = self._pack.array_writer(case_key(path), (height, width))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self._pack.__exit__(exc_type, *exc)
+
+    def write_rows(self, rows: np.ndarray):
+        """
+        Append rows to the array.
+
+        Args:
+            rows (np.ndarray): uint8 array of shape (n, width).
+        """
+        self._array.write_rows(rows)
+
+    def close(self):
+        """
+        Finish the array and the container.
+        """
+        self._array.close()
+        self._pack.close()
+
+
+def case_key(path: str) -> str:
+    """
+    Get the key of a case from its (possibly virtual) path.
+
+    Args:
+        path (str): Path ending with '<key>.nnpk'.
+
+    Returns:
+        str: Key.
+    """
+    name = os.path.basename(path)
+    return name[:-len(PACK_EXTENSION)] if name.endswith(PACK_EXTENSION) else name
+
+
+def virtual_path(container: str, key: str) -> str:
+    """
+    Build the virtual path of a case of a container, as listed in dataset.json.
+
+    Args:
+        container (str): Path to the container.
+        key (str): Key of the case.
+
+    Returns:
+        str: '<container>/<key>.nnpk'.
+    """
+    return os.path.join(container, key + PACK_EXTENSION)
+
+
+def resolve(path: str) -> Tuple[str, str]:
+    """
+    Find the container and the key of a case: either a virtual path '<container>.nnpk/<key>.nnpk', or the path to
+    a container holding a single array.
+
+    Args:
+        path (str): Path to the case.
+
+    Returns:
+        tuple: Path to the container and key of the case (None for the only array of the container).
+    """
+    if os.path.isfile(path):
+        return path, None
+    container = os.path.dirname(path)
+    if container.endswith(PACK_EXTENSION) and os.path.isfile(container):
+        return container, case_key(path)
+    raise FileNotFoundError(f'No NNPack container or case found at {path}.')
+
+
+_open_packs = {}
+
+
+def open_pack(path: str) -> NNPack:
+    """
+    Open a container, reusing the containers already opened by this process unless they were rewritten since.
+
+    Args:
+        path (str): Path to the container.
+
+    Returns:
+        NNPack: Container.
+    """
+    stat = os.stat(path)
+    signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    cached = _open_packs.get(os.path.abspath(path))
+    if cached is None or cached[0] != signature:
+        if cached is not None:
+            cached[1].close()
+        cached = (signature, NNPack(path))
+        _open_packs[os.path.abspath(path)] = cached
+    return cached[1]
+
+
+def contains_case(path: str) -> bool:
+    """
+    Check whether a case exists.
+
+    Args:
+        path (str): Virtual path to the case, or path to a single-array container.
+
+    Returns:
+        bool: Whether the case exists.
+    """
+    try:
+        container, key = resolve(path)
+        return key is None or key in open_pack(container)
+    except (FileNotFoundError, ValueError):
+        return False
+
+
+def read_case(path: str, region: tuple = None) -> np.ndarray:
+    """
+    Read a case, or a crop of it.
+
+    Args:
+        path (str): Virtual path to the case, or path to a single-array container.
+        region (tuple): (y, x, height, width) of the crop, None for the whole case.
+
+    Returns:
+        np.ndarray: Array of the case.
+    """
+    pack, key = _open_case(path)
+    return pack.read(key) if region is None else pack.read_region(key, *region)
+
+
+def _open_case(path: str) -> Tuple[NNPack, str]:
+    container, key = resolve(path)
+    pack = open_pack(container)
+    key = key if key is not None else pack.keys()[0]
+    if key not in pack:
+        raise KeyError(f'No case {key} in {container}.')
+    return pack, key
+
+
+def case_shape(path: str) -> tuple:
+    """
+    Get the shape of a case without reading it.
+
+    Args:
+        path (str): Virtual path to the case, or path to a single-array container.
+
+    Returns:
+        tuple: Shape of the case.
+    """
+    pack, key = _open_case(path)
+    return pack.shape(key)
+
+
+def hash_case(path: str) -> str:
+    """
+    Compute the SHA-256 of a case from its metadata and its compressed chunks, without decompressing them.
+
+    Args:
+        path (str): Virtual path to the case, or path to a single-array container.
+
+    Returns:
+        str: Hexadecimal digest.
+    """
+    pack, key = _open_case(path)
+    array = pack.arrays[key]
+    digest = hashlib.sha256(json.dumps({k: array[k] for k in ('shape', 'dtype', 'chunk_shape', 'compression')},
+                                       sort_keys=True).encode())
+    for index in range(len(array['chunks'])):
+        digest.update(pack.raw_chunk(key, index))
+    return digest.hexdigest()
+
+
+def list_cases(container: str) -> list:
+    """
+    List the virtual paths of the cases of a container.
+
+    Args:
+        container (str): Path to the container.
+
+    Returns:
+        list: Virtual paths '<container>/<key>.nnpk', in the order the cases were written.
+    """
+    return [virtual_path(container, key) for key in open_pack(container).keys()]
+
+
+def build_pack(path: str, entries: list, compression_level: int = 6):
+    """
+    Assemble a container from cases stored in other containers, copying their compressed chunks.
+
+    Args:
+        path (str): Path to the container. It may also be one of the sources.
+        entries (list): (source path, key) tuples, the source path being a virtual path or a single-array container.
+        compression_level (int): zlib compression level of the container (copied chunks keep their compression).
+    """
+    with NNPackWriter(path, compression_level) as writer:
+        for source, key in entries:
+            container, source_key = resolve(source)
+            pack = open_pack(container)
+            writer.copy_array(pack, source_key if source_key is not None else pack.keys()[0], key)
+
+
+class NNPackIO(BaseReaderWriter):
+    """
+    nnUNet reader/writer of 2D cases stored in NNPack containers, selected with
+    "overwrite_image_reader_writer": "NNPackIO" in dataset.json. Images and segmentations are read like
+    NaturalImage2DIO reads grayscale PNGs; predicted segmentations are written as single-array containers. Images in
+    other formats are read by NaturalImage2DIO, so that a model trained on containers also predicts on PNG images.
+    """
+
+    supported_file_endings = [PACK_EXTENSION]
+
+    def read_images(self, image_fnames: Union[List[str], Tuple[str, ...]]) -> Tuple[np.ndarray, dict]:
+        if not all(f.endswith(PACK_EXTENSION) for f in image_fnames):
+            return NaturalImage2DIO().read_images(image_fnames)
+        images = []
+        for f in image_fnames:
+            image = read_case(f)
+            # Colour channels first, then a singleton dimension for the 2D slice, as in NaturalImage2DIO
+            images.append(image.transpose((2, 0, 1))[:, None] if image.ndim == 3 else image[None, None])
+        if not self._check_all_same([i.shape for i in images]):
+            raise RuntimeError(f'Not all input images have the same shape: {[i.shape for i in images]} '
+                               f'({image_fnames}).')
+        return np.vstack(images, dtype=np.float32, casting='unsafe'), {'spacing': (999, 1, 1)}
+
+    def read_seg(self, seg_fname: str) -> Tuple[np.ndarray, dict]:
+        return self.read_images((seg_fname,))
+
+    def write_seg(self, seg: np.ndarray, output_fname: str, properties: dict) -> None:
+        if not output_fname.endswith(PACK_EXTENSION):
+            return NaturalImage2DIO().write_seg(seg, output_fname, properties)
+        with NNPackWriter(output_fname) as writer:
+            writer.write_array(case_key(output_fname), seg[0].astype(np.uint8 if np.max(seg) < 255 else np.uint16,
+                                                                     copy=False))
+
+
+def install_reader_writer() -> str:
+    """
+    Copy this module into nnunetv2.imageio, where nnUNet looks for the reader/writer named in dataset.json.
+
+    Returns:
+        str: Path to the installed module.
+    """
+    import nnunetv2
+    destination = os.path.join(os.path.dirname(nnunetv2.__file__), 'imageio', INSTALLED_MODULE_NAME)
+    shutil.copyfile(os.path.abspath(__file__), destination)
+    return destination
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage NNPack containers')
+    parser.add_argument('--install', action='store_true', default=False,
+                        help='Install the NNPackIO reader/writer in nnunetv2.imageio, so that nnUNet finds it.')
+    parser.add_argument('--list', default=None,
+                        help='Path to a container whose arrays are listed with their shape and compression ratio.')
+    args = parser.parse_args()
+
+    if args.install:
+        print('Installed the NNPackIO reader/writer as {}'.format(install_reader_writer()))
+    if args.list is not None:
+        with NNPack(args.list) as pack:
+            for key in pack.keys():
+                array = pack.arrays[key]
+                size = int(np.prod(array['shape'])) * np.dtype(array['dtype']).itemsize
+                stored = sum(length for _, length in array['chunks'])
+                print('{}: shape {}, {} chunks, {:.1f}x compression'.format(
+                    key, tuple(array['shape']), len(array['chunks']), size / max(1, stored)))
+
+if __name__ == '__main__':
+    main()
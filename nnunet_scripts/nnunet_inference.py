@@ -5,14 +5,30 @@ Author: Naga Karthik
 """
 
 import argparse
+import hashlib
+import json
 import os
+import shutil
+import sys
 import time
-from pathlib import Path
 
 import torch
 from batchgenerators.utilities.file_and_folder_operations import join
 from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
 
+from inference_backends import BACKENDS, artefact_path, use_exported_backend
+from inference_utils import (PACK_EXTENSION, get_dataset_prediction_paths, get_prediction_paths, hash_file,
+                             list_dataset_images, mask_file_ending)
+from instrumentation import PROFILERS, Instrumentation
+from mask_metrics import MaskMetrics, MetricsReport, measure_mask, measure_mask_file
+from pipelined_inference import auto_size_workers, image_memory, predict_pipelined, set_torch_threads
+from postprocessing import COLORMAPS, MASK_EXTENSIONS, PostProcessor, save_mask
+from prediction_cache import PredictionCache, hash_image
+from sharding import ShardManifest, get_shard, image_pixel_count, verify_predictions
+from system_resources import available_cpus
+from tiled_io import TIFF_EXTENSIONS
+from whole_slide_inference import predict_whole_slide
+
 if 'nnUNet_raw' not in os.environ:
         os.environ['nnUNet_raw'] = 'UNDEFINED'
 if 'nnUNet_results' not in os.environ:
@@ -20,6 +36,17 @@ if 'nnUNet_results' not in os.environ:
 if 'nnUNet_preprocessed' not in os.environ:
         os.environ['nnUNet_preprocessed'] = 'UNDEFINED'
 
+# Speed/accuracy trade-offs of the inference. On CPU the cost is roughly proportional to
+# number of folds x mirrored passes x tiles per image.
+#   - tile_step_size: step between sliding-window tiles, as a fraction of the patch size (1.0: no overlap)
+#   - mirror_axes: test-time mirroring axes, None for all the axes allowed by the model, () to disable mirroring
+#   - num_folds: number of folds ensembled, None for all the available folds (1: no ensembling)
+PRESETS = {
+    'fast': {'tile_step_size': 1.0, 'mirror_axes': (), 'num_folds': 1},
+    'balanced': {'tile_step_size': 0.75, 'mirror_axes': (), 'num_folds': None},
+    'accurate': {'tile_step_size': 0.5, 'mirror_axes': None, 'num_folds': None},
+}
+
 def get_parser() -> argparse.ArgumentParser:
     """
     Parse command line arguments.
@@ -42,68 +69,177 @@ def get_parser() -> argparse.ArgumentParser:
                         help='List of folds to use for inference. If not specified, all available folds. Default: None')
     parser.add_argument('--use-gpu', action='store_true', default=False,
                         help='Use GPU for inference. Default: False')
+    parser.add_argument('--preset', default='accurate', choices=list(PRESETS),
+                        help='Speed/accuracy preset: "fast" predicts non-overlapping tiles with the first fold only '
+                        'and without mirroring, "balanced" ensembles the folds on less overlapping tiles without '
+                        'mirroring, "accurate" is the nnUNet default. --folds overrides the folds of the preset. '
+                        'Default: accurate')
     parser.add_argument('--use-best-checkpoint', action='store_true', default=False,
                         help='Use the best checkpoint (instead of the final checkpoint) for prediction. '
                         'NOTE: nnUNet by default uses the final checkpoint. Default: False')
+    parser.add_argument('--backend', default='pytorch', choices=list(BACKENDS),
+                        help='Inference backend of the network: the eager "pytorch" model, or the "torchscript", '
+                        '"onnx", "onnx-int8-dynamic" and "onnx-int8-static" artefacts written by export_model.py '
+                        '(ONNX requires onnxruntime). The sliding window, mirroring and ensembling are unchanged. '
+                        'Default: pytorch')
+    parser.add_argument('--colormap', default=None, choices=list(COLORMAPS),
+                        help='Write the masks in their final form instead of class indices: "binary" maps 1 to 255, '
+                        '"classes" gives each class an RGB colour. Default: None (class indices)')
+    parser.add_argument('--min-component-size', default=0, type=int,
+                        help='Remove the connected components smaller than this number of pixels from the masks. '
+                        'Default: 0 (keep all)')
+    parser.add_argument('--fill-holes', action='store_true', default=False,
+                        help='Fill the holes enclosed by each class in the masks. Default: False')
+    parser.add_argument('--max-hole-size', default=None, type=int,
+                        help='Only fill the holes up to this number of pixels. Default: None (no limit)')
+    parser.add_argument('--metrics', default=None, type=str,
+                        help='Path to a CSV (or Parquet, with pyarrow) report to which the area, connected components '
+                        'and convex hull of each class are appended as each mask is produced. With --num-parts, use '
+                        'one report per part. Default: None')
+    parser.add_argument('--pixel-size', default=None, type=float,
+                        help='Size of a pixel in micrometers, to report the areas in um2. Default: None')
+    parser.add_argument('--cache-dir', default=None, type=str,
+                        help='Folder of a prediction cache keyed on the image content and the model fingerprint. '
+                        'Cached predictions are copied instead of predicted, and existing outputs are overwritten, '
+                        'so that a retrained model never leaves stale masks. Default: None (no cache)')
+    parser.add_argument('--cache-max-size', default=10.0, type=float,
+                        help='Maximum size of the prediction cache in GB, the least recently used predictions are '
+                        'evicted first. Default: 10')
+    parser.add_argument('--num-parts', default=1, type=int,
+                        help='Number of parts the images are split into, e.g. the number of tasks of a SLURM array. '
+                        'The parts have balanced total pixel counts. Default: 1')
+    parser.add_argument('--part-id', default=0, type=int,
+                        help='Index of the part segmented by this job, from 0 to --num-parts - 1, e.g. '
+                        '$SLURM_ARRAY_TASK_ID. Default: 0')
+    parser.add_argument('--chunk-size', default=32, type=int,
+                        help='Number of images predicted between two updates of the resume manifest. Default: 32')
+    parser.add_argument('--verify', action='store_true', default=False,
+                        help='Do not predict: check that every image has exactly one prediction, merge the manifests '
+                        'of the parts into <path-out>/predictions_manifest.jsonl and exit with an error if a '
+                        'prediction is missing or conflicting. Default: False')
+    parser.add_argument('--whole-slide', action='store_true', default=False,
+                        help='Segment whole-slide TIFF images out of core: the slides are predicted region by region '
+                        'and the masks are written as tiled TIFFs. In dataset mode, the .tif/.tiff files are segmented. '
+                        'Default: False')
+    parser.add_argument('--region-size', default=4096, type=int,
+                        help='Side of the square regions predicted at once in whole-slide mode. Default: 4096')
+    parser.add_argument('--region-overlap', default=256, type=int,
+                        help='Overlap in pixels between neighbouring regions in whole-slide mode. Default: 256')
+    parser.add_argument('--pipelined', action='store_true', default=False,
+                        help='Overlap the preprocessing, the network and the writing of all the images of the run: '
+                        'the preprocessing workers prefetch images ahead of the network, and a pool of writers '
+                        'resamples, post-processes and writes the masks, with back-pressure bounding the images in '
+                        'flight. Each image is recorded as soon as it is written. Not used in whole-slide mode. '
+                        'Default: False')
+    parser.add_argument('--num-processes-preprocessing', default=None, type=int,
+                        help='Number of processes preprocessing the images. Default: None (chosen from the available '
+                        'CPUs and memory)')
+    parser.add_argument('--num-processes-export', default=None, type=int,
+                        help='Number of processes resampling and writing the masks. Default: None (chosen from the '
+                        'available CPUs and memory)')
+    parser.add_argument('--torch-threads', default=None, type=int,
+                        help='Number of torch intra-op threads of the network. Default: None (the available CPUs not '
+                        'used by the workers on CPU, at most 4 on GPU)')
+    parser.add_argument('--timings', action='store_true', default=False,
+                        help='Time each stage of each image (preprocessing, prediction, export, post-processing, ...) '
+                        'and print a summary table with the CPU utilization and peak memory at the end. '
+                        'Default: False')
+    parser.add_argument('--trace', default=None, type=str,
+                        help='Path to a JSON-lines trace of the stage timings, one line per stage and image. '
+                        'Implies --timings. Default: None')
+    parser.add_argument('--profile', default=None, choices=PROFILERS,
+                        help='Profile the prediction stage: "cprofile" over all the images, "torch" (torch.profiler, '
+                        'Chrome trace) for the first image only. Implies --timings. Default: None')
+    parser.add_argument('--profile-dir', default=None, type=str,
+                        help='Folder of the profiler outputs. Default: --path-out')
 
     return parser
 
 
-def splitext(fname: str) -> tuple:
+def get_available_folds(path_model: str) -> list:
     """
-    Split a fname (folder/file + ext) into a folder/file and extension.
+    List the folds available in a model directory.
 
     Args:
-        fname (str): File name.
+        path_model (str): Path to the model directory.
 
     Returns:
-        tuple: Folder/file and extension.
+        list: Fold numbers.
     """
-    dir, filename = os.path.split(fname)
-    for special_ext in ['.nii.gz', '.tar.gz','.png']:
-        if filename.endswith(special_ext):
-            stem, ext = filename[:-len(special_ext)], special_ext
-            return os.path.join(dir, stem), ext
-    stem, ext = os.path.splitext(filename)
-    return os.path.join(dir, stem), ext
+    return [int(f.split('_')[-1]) for f in os.listdir(path_model) if f.startswith('fold_')]
 
 
-def add_suffix(fname: str, suffix: str) -> str:
+def get_preset_folds(path_model: str, folds: list = None, preset: str = 'accurate') -> list:
     """
-    Add suffix between end of file name and extension.
+    Get the folds used for inference.
 
     Args:
-        fname (str): File name.
-        suffix (str): Suffix.
+        path_model (str): Path to the model directory.
+        folds (list): Requested folds. If None, the folds of the preset.
+        preset (str): Speed/accuracy preset, one of PRESETS.
 
     Returns:
-        str: File name with suffix.
+        list: Fold numbers.
     """
-    stem, ext = splitext(fname)
-    return os.path.join(stem + suffix + ext)
+    if folds is not None:
+        return folds
+    folds = sorted(get_available_folds(path_model))
+    if PRESETS[preset]['num_folds'] is not None:
+        folds = folds[:PRESETS[preset]['num_folds']]
+    return folds
 
 
-def convert_filenames_to_nnunet_format(path_dataset: str) -> str:
+def load_predictor(path_model: str, folds: list = None, use_gpu: bool = False,
+                   use_best_checkpoint: bool = False, preset: str = 'accurate',
+                   backend: str = 'pytorch') -> nnUNetPredictor:
     """
-    Convert file names to nnunet format.
+    Build a predictor and load the trained model weights of the requested folds.
 
     Args:
-        path_dataset (str): Path to the dataset.
+        path_model (str): Path to the model directory, containing fold_0, fold_1, etc.
+        folds (list): Folds to use. If None, the folds of the preset.
+        use_gpu (bool): Run the inference on GPU.
+        use_best_checkpoint (bool): Use the best checkpoint instead of the final one.
+        preset (str): Speed/accuracy preset, one of PRESETS.
+        backend (str): Inference backend of the network, one of BACKENDS. The exported backends run the artefacts
+            written by export_model.py.
 
     Returns:
-        str: Path to the temporary folder.
+        nnUNetPredictor: Initialized predictor.
     """
-    path_tmp = os.path.join(os.path.dirname(path_dataset), 'tmp')
-    if not os.path.exists(path_tmp):
-        os.makedirs(path_tmp, exist_ok=True)
-
-    for f in os.listdir(path_dataset):
-        if f.endswith('.nii.gz') or f.endswith('.png'):
-            f = os.path.join(path_dataset, f)
-            f_new = add_suffix(f, '_0000')
-            os.system('cp {} {}'.format(f, os.path.join(path_tmp, os.path.basename(f_new))))
+    settings = PRESETS[preset]
+    folds_avail = get_preset_folds(path_model, folds, preset)
+    predictor = nnUNetPredictor(
+        tile_step_size=settings['tile_step_size'],
+        use_gaussian=True,
+        use_mirroring=True,
+        perform_everything_on_device=use_gpu,
+        device=torch.device('cuda') if use_gpu else torch.device('cpu'),
+        verbose=False,
+        verbose_preprocessing=False,
+        allow_tqdm=True
+    )
+    print('Running inference on device: {}'.format(predictor.device))
 
-    return path_tmp
+    checkpoint_name = 'checkpoint_final.pth' if not use_best_checkpoint else 'checkpoint_best.pth'
+    predictor.initialize_from_trained_model_folder(
+        join(path_model),
+        use_folds=folds_avail,
+        checkpoint_name=checkpoint_name,
+    )
+    # nnUNet writes the masks with the file ending of the dataset, and NNPackIO writes .png masks as NaturalImage2DIO
+    predictor.dataset_json['file_ending'] = mask_file_ending(predictor.dataset_json['file_ending'])
+    if backend != 'pytorch':
+        use_exported_backend(predictor, path_model, folds_avail, checkpoint_name, backend)
+    # The mirroring axes can only be restricted to those the model was trained with
+    if settings['mirror_axes'] is not None:
+        predictor.allowed_mirroring_axes = tuple(a for a in settings['mirror_axes']
+                                                 if a in (predictor.allowed_mirroring_axes or ()))
+        predictor.use_mirroring = len(predictor.allowed_mirroring_axes) > 0
+    print('Using the "{}" preset: folds {}, tile step size {}, mirroring axes {}, {} backend'.format(
+        preset, folds_avail, predictor.tile_step_size,
+        predictor.allowed_mirroring_axes if predictor.use_mirroring else None, backend))
+    return predictor
 
 
 def main():
@@ -121,68 +257,219 @@ def main():
     
     if args.path_dataset is not None:
         print('Found a dataset folder. Running inference on the whole dataset...')
-        path_data_tmp = convert_filenames_to_nnunet_format(args.path_dataset)
-        path_out = args.path_out
+        # The images are given to nnUNet as lists of files, so they are read in place (no renamed copies)
+        path_images = list_dataset_images(args.path_dataset, TIFF_EXTENSIONS if args.whole_slide else ('.nii.gz', '.png', PACK_EXTENSION))
+        path_data = [[f] for f in path_images]
+        path_out = get_dataset_prediction_paths(path_images, args.path_out)
 
     elif args.path_images is not None:
         print(f'Found {len(args.path_images)} images. Running inference on them...')
-        path_data_tmp = [[f] for f in args.path_images]
-
-        path_out = []
-        for f in args.path_images:
-            fname = Path(f).name
-            fname = fname.rstrip(''.join(Path(fname).suffixes))
-            path_pred = os.path.join(args.path_out, add_suffix(fname, '_pred')) 
-            path_out.append(path_pred)
-
-    if args.folds is not None:
-        folds_avail = args.folds
+        path_data = [[f] for f in args.path_images]
+
+        path_out = get_prediction_paths(args.path_images, args.path_out)
+
+    with open(join(args.path_model, 'dataset.json')) as f:
+        dataset_json = json.load(f)
+    file_ending = '.tif' if args.whole_slide else mask_file_ending(dataset_json['file_ending'])
+    labels = {name: value for name, value in dataset_json['labels'].items() if isinstance(value, int)}
+
+    postprocessor = None
+    if args.colormap is not None or args.min_component_size > 0 or args.fill_holes or args.metrics is not None:
+        # The metrics are computed on the segmentations in memory, hence written by the post-processing path
+        postprocessor = PostProcessor(args.colormap, args.min_component_size, args.fill_holes, args.max_hole_size)
+        if file_ending not in MASK_EXTENSIONS:
+            raise ValueError(f'Post-processing and metrics are only supported for 2D image formats, not {file_ending}.')
+        if args.whole_slide and not postprocessor.is_pointwise:
+            raise ValueError('Whole-slide masks are written tile by tile: only --colormap can be applied to them.')
+
+    folds = get_preset_folds(args.path_model, args.folds, args.preset)
+    checkpoint_name = 'checkpoint_final.pth' if not args.use_best_checkpoint else 'checkpoint_best.pth'
+    settings = {'preset': PRESETS[args.preset], 'backend': args.backend, 'use_gaussian': True,
+                'whole_slide': [args.region_size, args.region_overlap] if args.whole_slide else None,
+                'postprocessing': postprocessor.to_dict() if postprocessor is not None else None}
+    if args.backend != 'pytorch':
+        # Re-exported artefacts (e.g. calibrated on other images) give other predictions
+        artefacts = [artefact_path(args.path_model, fold, checkpoint_name, args.backend) for fold in folds]
+        settings['artefacts'] = [hash_file(f) if os.path.isfile(f) else None for f in artefacts]
+    if args.cache_dir is not None:
+        cache = PredictionCache(args.cache_dir, int(args.cache_max_size * 1024 ** 3))
+        run_id = cache.model_fingerprint(args.path_model, folds, checkpoint_name, settings)
     else:
-        folds_avail = [int(f.split('_')[-1]) for f in os.listdir(args.path_model) if f.startswith('fold_')]
+        run_id = hashlib.sha256(json.dumps({'path_model': os.path.abspath(args.path_model), 'folds': folds,
+                                            'checkpoint_name': checkpoint_name, 'settings': settings},
+                                           sort_keys=True).encode()).hexdigest()
+
+    if args.verify:
+        report = verify_predictions([f[0] for f in path_data], [o + file_ending for o in path_out], args.path_out,
+                                    args.num_parts, run_id)
+        for problem, files in report.items():
+            for f in files:
+                print('{}: {}'.format(problem, f))
+        print('Verified {} predictions: {} missing, {} conflicting, {} predicted by several parts, {} unexpected '
+              'files.'.format(len(path_data), *[len(report[k]) for k in ('missing', 'conflicting', 'several_parts',
+                                                                          'unexpected')]))
+        if report['missing'] or report['conflicting'] or report['several_parts']:
+            sys.exit(1)
+        return
+
+    if args.num_parts > 1:
+        shard = get_shard([f[0] for f in path_data], args.num_parts, args.part_id)
+        path_data, path_out = [path_data[i] for i in shard], [path_out[i] for i in shard]
+        print('Part {} of {}: {} images to segment.'.format(args.part_id, args.num_parts, len(path_data)))
 
     print('Starting inference...')
     start = time.time()
-    predictor = nnUNetPredictor(
-        tile_step_size=0.5,
-        use_gaussian=True,
-        use_mirroring=True,
-        perform_everything_on_device=args.use_gpu,
-        device=torch.device('cuda') if args.use_gpu else torch.device('cpu'),
-        verbose=False,
-        verbose_preprocessing=False,
-        allow_tqdm=True
-    )
-    print('Running inference on device: {}'.format(predictor.device))
-
-    predictor.initialize_from_trained_model_folder(
-        join(args.path_model),
-        use_folds=folds_avail,
-        checkpoint_name='checkpoint_final.pth' if not args.use_best_checkpoint else 'checkpoint_best.pth',
-    )
-    print('Model loaded successfully. Fetching test data...')
-
-    predictor.predict_from_files(
-        path_data_tmp, 
-        path_out,
-        save_probabilities=False, 
-        overwrite=False,
-        num_processes_preprocessing=2, 
-        num_processes_segmentation_export=2,
-        folder_with_segs_from_prev_stage=None, 
-        num_parts=1, 
-        part_id=0
-    )
+    instrumentation = Instrumentation(args.trace, args.timings, args.profile, args.profile_dir or args.path_out)
+    report = MetricsReport(args.metrics) if args.metrics is not None else None
+
+    def report_metrics(indices: list, masks: list = None):
+        # Masks already written (cache hits, duplicates) are read back
+        if report is None:
+            return
+        for n, i in enumerate(indices):
+            output = path_out[i] + file_ending
+            with instrumentation.stage('metrics', path_data[i][0]):
+                if masks is not None:
+                    metrics = measure_mask(masks[n], labels, args.pixel_size)
+                else:
+                    metrics = measure_mask_file(output, labels, args.pixel_size,
+                                                lambda mask: postprocessor.to_class_indices(mask, labels.values()))
+                report.write(metrics.rows(path_data[i][0], output))
+
+    # A re-queued job skips the predictions it already recorded in its manifest
+    manifest = ShardManifest(args.path_out, args.num_parts, args.part_id, run_id)
+    completed = manifest.completed()
+    todo = [i for i in range(len(path_data)) if os.path.abspath(path_out[i] + file_ending) not in completed]
+    if len(todo) < len(path_data):
+        print('{} of {} predictions already completed.'.format(len(path_data) - len(todo), len(path_data)))
+
+    if args.cache_dir is not None:
+        # The model is only loaded if some image is not in the cache
+        with instrumentation.stage('cache_lookup'):
+            keys = {i: cache.key(hash_image(path_data[i][0]), run_id) for i in todo}
+            hits = [i for i in todo if cache.get(keys[i], file_ending, path_out[i] + file_ending)]
+        manifest.record([path_data[i][0] for i in hits], [path_out[i] + file_ending for i in hits])
+        report_metrics(hits)
+        if todo:
+            print('{} of {} predictions served from the cache.'.format(len(hits), len(todo)))
+        # Duplicate images of this run are predicted once and copied afterwards
+        first_occurrences = {}
+        for i in todo:
+            if i not in hits:
+                first_occurrences.setdefault(keys[i], i)
+        duplicates = [i for i in todo if i not in hits and first_occurrences[keys[i]] != i]
+        todo = [i for i in todo if i not in hits and first_occurrences[keys[i]] == i]
+    elif args.whole_slide or postprocessor is not None or args.pipelined:
+        existing = [i for i in todo if os.path.isfile(path_out[i] + file_ending)]
+        manifest.record([path_data[i][0] for i in existing], [path_out[i] + file_ending for i in existing])
+        report_metrics(existing)
+        todo = [i for i in todo if i not in existing]
+
+    if todo:
+        with instrumentation.stage('load_model'):
+            predictor = load_predictor(args.path_model, args.folds, args.use_gpu, args.use_best_checkpoint,
+                                       args.preset, args.backend)
+        instrumentation.instrument_predictor(predictor)
+        print('Model loaded successfully. Fetching test data...')
+
+        if args.whole_slide:
+            # The slides are read and written by the main process
+            workers = {'torch_threads': args.torch_threads or available_cpus()}
+            print('Using {} torch threads.'.format(workers['torch_threads']))
+        else:
+            bytes_per_image = image_memory(max(image_pixel_count(path_data[i][0]) for i in todo),
+                                           len(predictor.dataset_json['channel_names']),
+                                           predictor.label_manager.num_segmentation_heads)
+            workers = auto_size_workers(len(todo), bytes_per_image, args.use_gpu, args.num_processes_preprocessing,
+                                        args.num_processes_export, args.torch_threads)
+            print('Using {num_processes_preprocessing} preprocessing workers, {num_processes_export} export workers '
+                  'and {torch_threads} torch threads.'.format(**workers))
+        set_torch_threads(workers['torch_threads'])
+
+        def record_completed(indices: list):
+            if args.cache_dir is not None:
+                for i in indices:
+                    with instrumentation.stage('cache_put', path_data[i][0]):
+                        cache.put(keys[i], file_ending, path_out[i] + file_ending)
+            manifest.record([path_data[i][0] for i in indices], [path_out[i] + file_ending for i in indices])
+
+    if todo and args.pipelined and not args.whole_slide:
+        # Each image is recorded in the manifest as soon as it is written
+        for n, rows in predict_pipelined(predictor, [path_data[i] for i in todo], [path_out[i] for i in todo],
+                                         file_ending, workers['num_processes_preprocessing'],
+                                         workers['num_processes_export'], postprocessor,
+                                         {'labels': labels, 'pixel_size': args.pixel_size} if report is not None else None,
+                                         instrumentation):
+            if report is not None:
+                report.write(rows)
+            record_completed([todo[n]])
+    elif todo:
+        # The images are predicted by chunks, recorded in the manifest as soon as their chunk is written
+        chunk_size = 1 if args.whole_slide else args.chunk_size
+        for chunk_start in range(0, len(todo), chunk_size):
+            chunk = todo[chunk_start:chunk_start + chunk_size]
+            if args.whole_slide:
+                for i in chunk:
+                    metrics = MaskMetrics(labels, args.pixel_size) if report is not None else None
+                    # The regions of the slide are recorded as 'predict' stages within its 'whole_slide' stage
+                    instrumentation.set_image(path_data[i][0])
+                    with instrumentation.stage('whole_slide'):
+                        predict_whole_slide(predictor, path_data[i][0], path_out[i] + file_ending, args.region_size,
+                                            args.region_overlap, postprocessor=postprocessor, metrics=metrics)
+                    if report is not None:
+                        report.write(metrics.rows(path_data[i][0], path_out[i] + file_ending))
+            elif postprocessor is not None:
+                # The segmentations are returned by the export workers and written once, post-processed
+                segmentations = predictor.predict_from_files(
+                    [path_data[i] for i in chunk],
+                    None,
+                    save_probabilities=False,
+                    overwrite=True,
+                    num_processes_preprocessing=workers['num_processes_preprocessing'],
+                    num_processes_segmentation_export=workers['num_processes_export'],
+                    folder_with_segs_from_prev_stage=None,
+                    num_parts=1,
+                    part_id=0
+                )
+                masks = []
+                for i, segmentation in zip(chunk, segmentations):
+                    with instrumentation.stage('postprocess', path_data[i][0]):
+                        masks.append(postprocessor.clean(segmentation[0]))
+                        colorized = postprocessor.colorize(masks[-1])
+                    with instrumentation.stage('write', path_data[i][0]):
+                        save_mask(colorized, path_out[i] + file_ending)
+                report_metrics(chunk, masks)
+            else:
+                predictor.predict_from_files(
+                    [path_data[i] for i in chunk],
+                    [path_out[i] for i in chunk],
+                    save_probabilities=False,
+                    overwrite=args.cache_dir is not None,
+                    num_processes_preprocessing=workers['num_processes_preprocessing'],
+                    num_processes_segmentation_export=workers['num_processes_export'],
+                    folder_with_segs_from_prev_stage=None,
+                    num_parts=1,
+                    part_id=0
+                )
+            record_completed(chunk)
+
+    if args.cache_dir is not None:
+        for i in duplicates:
+            shutil.copyfile(path_out[first_occurrences[keys[i]]] + file_ending, path_out[i] + file_ending)
+        manifest.record([path_data[i][0] for i in duplicates], [path_out[i] + file_ending for i in duplicates])
+        report_metrics(duplicates)
+    if report is not None:
+        report.close()
+        print('Metrics report written to {}'.format(args.metrics))
     end = time.time()
     print('Inference done.')
 
-    print('Deleting the temporary folder...')
-    os.system('rm -rf {}'.format(path_data_tmp))
-
     print('----------------------------------------------------')
     print('Results can be found in: {}'.format(args.path_out))
     print('----------------------------------------------------')
 
     print('Total time elapsed: {:.2f} seconds'.format(end - start))
+    instrumentation.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
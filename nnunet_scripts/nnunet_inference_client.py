@@ -0,0 +1,186 @@
+"""
+This script sends segmentation requests to a running nnunet_inference_server.py.
+
+It accepts the same arguments as nnunet_inference.py, so that it can be used as a drop-in replacement, but it
+neither imports torch nor loads the model: the server already keeps it in memory.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import time
+from urllib.parse import urlparse
+
+from inference_utils import get_dataset_prediction_paths, get_prediction_paths, list_dataset_images
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """
+    Parse command line arguments.
+
+    Returns:
+        argparse.ArgumentParser: Argument parser.
+    """
+    parser = argparse.ArgumentParser(description='Segment images using a running nnUNet inference server')
+    parser.add_argument('--path-dataset', default=None, type=str,
+                        help='Path to the test dataset folder. Use this argument only if you want '
+                        'predict on a whole dataset.')
+    parser.add_argument('--path-images', default=None, nargs='+', type=str,
+                        help='List of images to segment. Use this argument only if you want '
+                        'predict on a single image or list of invidiual images.')
+    parser.add_argument('--path-out', help='Path to output directory.', required=True)
+    parser.add_argument('--path-model', default=None,
+                        help='Path to the model directory. Only used to check that the server runs the expected model.')
+    parser.add_argument('--folds', nargs='+', type=int, default=None,
+                        help='List of folds. Only used to check that the server runs the expected folds.')
+    parser.add_argument('--use-gpu', action='store_true', default=False,
+                        help='Ignored, the device is chosen when starting the server.')
+    parser.add_argument('--use-best-checkpoint', action='store_true', default=False,
+                        help='Ignored, the checkpoint is chosen when starting the server.')
+    parser.add_argument('--preset', default=None, type=str,
+                        help='Preset. Only used to check that the server runs the expected preset.')
+    parser.add_argument('--server-url', default='http://127.0.0.1:8765', type=str,
+                        help='URL of the inference server. Default: http://127.0.0.1:8765')
+    parser.add_argument('--socket', default=None, type=str,
+                        help='Path to the Unix socket of the inference server, used instead of --server-url. Default: None')
+
+    return parser
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection over a Unix socket.
+
+    Args:
+        socket_path (str): Path to the Unix socket.
+        timeout (float): Socket timeout in seconds, None to wait indefinitely.
+    """
+
+    def __init__(self, socket_path: str, timeout: float = None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class InferenceClient:
+    """
+    Client of the nnUNet inference server.
+
+    Args:
+        server_url (str): URL of the server, used when socket_path is None.
+        socket_path (str): Path to the Unix socket of the server.
+    """
+
+    def __init__(self, server_url: str = 'http://127.0.0.1:8765', socket_path: str = None):
+        self.server_url = urlparse(server_url)
+        self.socket_path = socket_path
+
+    def _request(self, method: str, endpoint: str, body: bytes = None, content_type: str = 'application/json') -> bytes:
+        if self.socket_path is not None:
+            connection = UnixHTTPConnection(self.socket_path)
+        else:
+            connection = http.client.HTTPConnection(self.server_url.hostname, self.server_url.port)
+        try:
+            connection.request(method, endpoint, body=body, headers={'Content-Type': content_type} if body else {})
+            response = connection.getresponse()
+            content = response.read()
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise RuntimeError('Inference server error ({}): {}'.format(response.status, content.decode(errors='replace')))
+        return content
+
+    def health(self) -> dict:
+        """
+        Get the model information of the server.
+
+        Returns:
+            dict: Model path, folds, preset, device and file ending.
+        """
+        return json.loads(self._request('GET', '/health'))
+
+    def predict_files(self, path_images: list, path_out: list) -> list:
+        """
+        Segment images read from disk by the server.
+
+        Args:
+            path_images (list): Paths to the images.
+            path_out (list): Truncated output file names (without extension).
+
+        Returns:
+            list: Paths to the written masks.
+        """
+        body = json.dumps({'path_images': [os.path.abspath(f) for f in path_images],
+                           'path_out': [os.path.abspath(f) for f in path_out]}).encode()
+        return json.loads(self._request('POST', '/predict', body))['outputs']
+
+    def predict_bytes(self, image_bytes: bytes) -> bytes:
+        """
+        Segment an encoded image.
+
+        Args:
+            image_bytes (bytes): Encoded image (e.g. PNG or TIFF file content).
+
+        Returns:
+            bytes: PNG-encoded mask.
+        """
+        return self._request('POST', '/predict-bytes', image_bytes, 'application/octet-stream')
+
+
+def main():
+    """
+    Main function to run the script.
+    """
+    parser = get_parser()
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path_out):
+        os.makedirs(args.path_out, exist_ok=True)
+
+    if args.path_dataset is not None and args.path_images is not None:
+        raise ValueError('You can only specify either --path-dataset or --path-images (not both). See --help for more info.')
+
+    client = InferenceClient(args.server_url, args.socket)
+    model_info = client.health()
+    if args.path_model is not None and os.path.abspath(args.path_model) != model_info['path_model']:
+        print('WARNING: the server runs the model {} instead of {}'.format(model_info['path_model'], args.path_model))
+    if args.folds is not None and model_info['folds'] is not None and [str(f) for f in args.folds] != model_info['folds']:
+        print('WARNING: the server runs the folds {} instead of {}'.format(model_info['folds'], args.folds))
+    if args.preset is not None and args.preset != model_info['preset']:
+        print('WARNING: the server runs the preset {} instead of {}'.format(model_info['preset'], args.preset))
+
+    if args.path_dataset is not None:
+        print('Found a dataset folder. Running inference on the whole dataset...')
+        path_images = list_dataset_images(args.path_dataset)
+        path_out = get_dataset_prediction_paths(path_images, args.path_out)
+    elif args.path_images is not None:
+        print(f'Found {len(args.path_images)} images. Running inference on them...')
+        path_images = args.path_images
+        path_out = get_prediction_paths(args.path_images, args.path_out)
+    else:
+        raise ValueError('Specify either --path-dataset or --path-images. See --help for more info.')
+
+    # Like nnunet_inference.py, do not predict images that already have a prediction
+    todo = [(f, o) for f, o in zip(path_images, path_out) if not os.path.isfile(o + model_info['file_ending'])]
+
+    print('Starting inference...')
+    start = time.time()
+    if todo:
+        client.predict_files(*map(list, zip(*todo)))
+    end = time.time()
+    print('Inference done.')
+
+    print('----------------------------------------------------')
+    print('Results can be found in: {}'.format(args.path_out))
+    print('----------------------------------------------------')
+
+    print('Total time elapsed: {:.2f} seconds'.format(end - start))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,399 @@
+"""
+This script runs a long-lived inference server that keeps a trained nnUNetv2 model loaded between requests.
+
+The model and its folds are loaded once at startup. Requests are served over HTTP, either on a TCP port or on a
+Unix socket, and the requests queued together are predicted as one batch, whose sliding-window patches are
+passed to the network together across images:
+    - POST /predict with a JSON body {"path_images": [...], "path_out": [...]} segments images read from disk and
+      writes the masks to the given truncated output paths (the file ending of the model is appended).
+    - POST /predict-bytes with a raw encoded image as body returns the mask as a PNG.
+    - GET /health returns the model information.
+
+Use nnunet_inference_client.py to send requests with the same arguments as nnunet_inference.py.
+"""
+
+import argparse
+import io
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+from acvl_utils.cropping_and_padding.padding import pad_nd_image
+from nnunetv2.configuration import default_num_processes
+from nnunetv2.inference.export_prediction import convert_predicted_logits_to_segmentation_with_correct_shape
+from nnunetv2.inference.sliding_window_prediction import compute_gaussian
+from nnunetv2.utilities.helpers import dummy_context, empty_cache
+from PIL import Image
+from torch._dynamo import OptimizedModule
+
+from nnunet_inference import PRESETS, load_predictor
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """
+    Parse command line arguments.
+
+    Returns:
+        argparse.ArgumentParser: Argument parser.
+    """
+    parser = argparse.ArgumentParser(description='Serve nnUNet segmentations from a model kept in memory')
+    parser.add_argument('--path-model', required=True,
+                        help='Path to the model directory. This folder should contain individual folders '
+                        'like fold_0, fold_1, etc.',)
+    parser.add_argument('--folds', nargs='+', type=int, default=None,
+                        help='List of folds to use for inference. If not specified, all available folds. Default: None')
+    parser.add_argument('--use-gpu', action='store_true', default=False,
+                        help='Use GPU for inference. Default: False')
+    parser.add_argument('--use-best-checkpoint', action='store_true', default=False,
+                        help='Use the best checkpoint (instead of the final checkpoint) for prediction. '
+                        'NOTE: nnUNet by default uses the final checkpoint. Default: False')
+    parser.add_argument('--preset', default='accurate', choices=list(PRESETS),
+                        help='Speed/accuracy preset of the inference (see nnunet_inference.py). Default: accurate')
+    parser.add_argument('--host', default='127.0.0.1', type=str,
+                        help='Host to listen on. Default: 127.0.0.1')
+    parser.add_argument('--port', default=8765, type=int,
+                        help='Port to listen on. Default: 8765')
+    parser.add_argument('--socket', default=None, type=str,
+                        help='Path to a Unix socket to listen on instead of a TCP port. Default: None')
+    parser.add_argument('--max-batch-size', default=8, type=int,
+                        help='Maximum number of queued images predicted as one batch. Default: 8')
+    parser.add_argument('--batch-timeout', default=0.05, type=float,
+                        help='Time in seconds to wait for more queued requests before predicting a batch. Default: 0.05')
+    parser.add_argument('--num-threads-preprocessing', default=2, type=int,
+                        help='Number of threads used for preprocessing the images of a batch. Default: 2')
+    parser.add_argument('--patch-batch-size', default=8, type=int,
+                        help='Number of sliding-window patches, taken across the images of a batch, passed to the '
+                        'network at once. Default: 8')
+
+    return parser
+
+
+def image_to_nnunet_array(npy_img: np.ndarray) -> np.ndarray:
+    """
+    Reshape a decoded 2D image the way nnUNet's NaturalImage2DIO does.
+
+    Args:
+        npy_img (np.ndarray): Image of shape (H, W) or (H, W, C).
+
+    Returns:
+        np.ndarray: float32 array of shape (C, 1, H, W).
+    """
+    if npy_img.ndim == 3:
+        npy_img = npy_img.transpose((2, 0, 1))[:, None]
+    else:
+        npy_img = npy_img[None, None]
+    return npy_img.astype(np.float32)
+
+
+class PredictionJob:
+    """
+    A request waiting in the batching queue.
+
+    Args:
+        images (list): Images as (C, 1, H, W) arrays.
+        properties (list): nnUNet properties of the images.
+    """
+
+    def __init__(self, images: list, properties: list):
+        self.images = images
+        self.properties = properties
+        self.segmentations = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchingPredictor:
+    """
+    Run the predictions of queued requests in batches, on a single background thread owning the predictor.
+    The images of a batch are preprocessed concurrently by a thread pool that lives as long as the server, then
+    the sliding-window patches of all of them are passed to the network together, in batches of patch_batch_size.
+
+    Args:
+        predictor (nnUNetPredictor): Initialized predictor.
+        max_batch_size (int): Maximum number of images predicted together.
+        batch_timeout (float): Time in seconds to wait for more requests before predicting a batch.
+        num_threads_preprocessing (int): Number of threads used for preprocessing.
+        patch_batch_size (int): Number of sliding-window patches passed to the network at once.
+    """
+
+    def __init__(self, predictor, max_batch_size: int = 8, batch_timeout: float = 0.05,
+                 num_threads_preprocessing: int = 2, patch_batch_size: int = 8):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.patch_batch_size = patch_batch_size
+        self.batch_timeout = batch_timeout
+        self.preprocessor = predictor.configuration_manager.preprocessor_class(verbose=False)
+        self._preprocessing_pool = ThreadPoolExecutor(max_workers=num_threads_preprocessing)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def predict(self, images: list, properties: list) -> list:
+        """
+        Queue images for prediction and wait for their segmentations.
+
+        Args:
+            images (list): Images as (C, 1, H, W) arrays.
+            properties (list): nnUNet properties of the images.
+
+        Returns:
+            list: Segmentations as (1, H, W) arrays.
+        """
+        job = PredictionJob(images, properties)
+        self._queue.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.segmentations
+
+    def _next_batch(self) -> list:
+        jobs = [self._queue.get()]
+        num_images = len(jobs[0].images)
+        deadline = time.monotonic() + self.batch_timeout
+        while num_images < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                job = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            jobs.append(job)
+            num_images += len(job.images)
+        return jobs
+
+    def _preprocess(self, image: np.ndarray, properties: dict) -> tuple:
+        predictor = self.predictor
+        data, _, properties = self.preprocessor.run_case_npy(image, None, deepcopy(properties), predictor.plans_manager,
+                                                             predictor.configuration_manager, predictor.dataset_json)
+        return torch.from_numpy(data).to(dtype=torch.float32, memory_format=torch.contiguous_format), properties
+
+    @torch.inference_mode()
+    def _predict_logits(self, images: list) -> list:
+        """
+        Predict the logits of preprocessed images, averaged over the folds, like nnUNet's
+        predict_logits_from_preprocessed_data. The sliding-window patches of all the images are gathered and passed
+        to the network in batches of patch_batch_size patches, so that small images share network calls.
+
+        Args:
+            images (list): Preprocessed images as (C, X, Y, Z) tensors.
+
+        Returns:
+            list: Logits of the images as (K, X, Y, Z) tensors on the CPU.
+        """
+        predictor = self.predictor
+        n_threads = torch.get_num_threads()
+        torch.set_num_threads(min(default_num_processes, n_threads))
+        network = predictor.network.to(predictor.device)
+        network.eval()
+        results_device = predictor.device if predictor.perform_everything_on_device else torch.device('cpu')
+        patch_size = predictor.configuration_manager.patch_size
+
+        padded, revert_slicers, patches = [], [], []
+        for i, image in enumerate(images):
+            data, slicer_revert_padding = pad_nd_image(image, patch_size, 'constant', {'value': 0}, True, None)
+            padded.append(data.to(results_device))
+            revert_slicers.append(slicer_revert_padding)
+            patches += [(i, sl) for sl in predictor._internal_get_sliding_window_slicers(data.shape[1:])]
+
+        if predictor.use_gaussian:
+            gaussian = compute_gaussian(tuple(patch_size), sigma_scale=1. / 8, value_scaling_factor=10,
+                                        device=results_device)
+        else:
+            gaussian = 1
+        n_predictions = [torch.zeros(data.shape[1:], dtype=torch.half, device=results_device) for data in padded]
+        for i, sl in patches:
+            n_predictions[i][sl[1:]] += gaussian
+
+        prediction = None
+        for params in predictor.list_of_parameters:
+            # nnUNet compiles the network into an OptimizedModule when nnUNet_compile is set
+            if isinstance(network, OptimizedModule):
+                network._orig_mod.load_state_dict(params)
+            else:
+                network.load_state_dict(params)
+
+            logits = [torch.zeros((predictor.label_manager.num_segmentation_heads, *data.shape[1:]),
+                                  dtype=torch.half, device=results_device) for data in padded]
+            with torch.autocast(predictor.device.type) if predictor.device.type == 'cuda' else dummy_context():
+                for start in range(0, len(patches), self.patch_batch_size):
+                    batch = patches[start:start + self.patch_batch_size]
+                    x = torch.stack([padded[i][sl] for i, sl in batch]).to(predictor.device)
+                    output = predictor._internal_maybe_mirror_and_predict(x).to(results_device)
+                    if predictor.use_gaussian:
+                        output *= gaussian
+                    for (i, sl), patch_logits in zip(batch, output):
+                        logits[i][sl] += patch_logits
+
+            for i, revert in enumerate(revert_slicers):
+                torch.div(logits[i], n_predictions[i], out=logits[i])
+                if torch.any(torch.isinf(logits[i])):
+                    raise RuntimeError('Encountered inf in predicted array.')
+                logits[i] = logits[i][(slice(None), *revert[1:])].to('cpu')
+            if prediction is None:
+                prediction = logits
+            else:
+                for i, fold_logits in enumerate(logits):
+                    prediction[i] += fold_logits
+
+        if len(predictor.list_of_parameters) > 1:
+            for fold_logits in prediction:
+                fold_logits /= len(predictor.list_of_parameters)
+        empty_cache(predictor.device)
+        torch.set_num_threads(n_threads)
+        return prediction
+
+    def _run(self):
+        while True:
+            jobs = self._next_batch()
+            preprocessed = [[self._preprocessing_pool.submit(self._preprocess, image, props)
+                             for image, props in zip(job.images, job.properties)] for job in jobs]
+            ready = []
+            for job, job_preprocessed in zip(jobs, preprocessed):
+                try:
+                    ready.append((job, [future.result() for future in job_preprocessed]))
+                except Exception as e:
+                    job.error = e
+                    job.done.set()
+
+            predictor = self.predictor
+            try:
+                logits = self._predict_logits([data for _, job_preprocessed in ready for data, _ in job_preprocessed])
+            except Exception as e:
+                for job, _ in ready:
+                    job.error = e
+                    job.done.set()
+                continue
+            start = 0
+            for job, job_preprocessed in ready:
+                job_logits = logits[start:start + len(job_preprocessed)]
+                start += len(job_preprocessed)
+                try:
+                    job.segmentations = [convert_predicted_logits_to_segmentation_with_correct_shape(
+                        image_logits, predictor.plans_manager, predictor.configuration_manager,
+                        predictor.label_manager, properties
+                    ) for image_logits, (_, properties) in zip(job_logits, job_preprocessed)]
+                except Exception as e:
+                    job.error = e
+                job.done.set()
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler forwarding the requests to the server's BatchingPredictor.
+    """
+
+    def address_string(self) -> str:
+        return self.client_address[0] if self.client_address else 'unix-socket'
+
+    def _send(self, code: int, body: bytes, content_type: str = 'application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, code: int, content: dict):
+        self._send(code, json.dumps(content).encode())
+
+    def do_GET(self):
+        if self.path != '/health':
+            self._send_json(404, {'error': f'Unknown endpoint {self.path}'})
+            return
+        self._send_json(200, self.server.model_info)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            if self.path == '/predict':
+                self._predict_files(json.loads(body))
+            elif self.path == '/predict-bytes':
+                self._predict_bytes(body)
+            else:
+                self._send_json(404, {'error': f'Unknown endpoint {self.path}'})
+        except Exception as e:
+            self._send_json(500, {'error': f'{type(e).__name__}: {e}'})
+
+    def _predict_files(self, request: dict):
+        path_images, path_out = request['path_images'], request['path_out']
+        if len(path_images) != len(path_out):
+            self._send_json(400, {'error': 'path_images and path_out must have the same length.'})
+            return
+        reader_writer = self.server.reader_writer
+        images, properties = zip(*[reader_writer.read_images([f]) for f in path_images]) if path_images else ((), ())
+        segmentations = self.server.batching_predictor.predict(list(images), list(properties))
+        outputs = []
+        for segmentation, props, truncated in zip(segmentations, properties, path_out):
+            output_fname = truncated + self.server.file_ending
+            os.makedirs(os.path.dirname(os.path.abspath(output_fname)), exist_ok=True)
+            reader_writer.write_seg(segmentation, output_fname, props)
+            outputs.append(output_fname)
+        self._send_json(200, {'outputs': outputs})
+
+    def _predict_bytes(self, body: bytes):
+        image = image_to_nnunet_array(np.array(Image.open(io.BytesIO(body))))
+        segmentation, = self.server.batching_predictor.predict([image], [{'spacing': (999, 1, 1)}])
+        buffer = io.BytesIO()
+        Image.fromarray(segmentation[0].astype(np.uint8)).save(buffer, format='PNG')
+        self._send(200, buffer.getvalue(), 'image/png')
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    HTTP server listening on a Unix socket.
+    """
+    daemon_threads = True
+
+
+def main():
+    """
+    Main function to run the script.
+    """
+    parser = get_parser()
+    args = parser.parse_args()
+
+    start = time.time()
+    predictor = load_predictor(args.path_model, args.folds, args.use_gpu, args.use_best_checkpoint, args.preset)
+    print('Model loaded successfully in {:.2f} seconds.'.format(time.time() - start))
+
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, InferenceRequestHandler)
+        address = args.socket
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), InferenceRequestHandler)
+        address = 'http://{}:{}'.format(args.host, args.port)
+
+    server.batching_predictor = BatchingPredictor(predictor, args.max_batch_size, args.batch_timeout,
+                                                  args.num_threads_preprocessing, args.patch_batch_size)
+    server.reader_writer = predictor.plans_manager.image_reader_writer_class()
+    server.file_ending = predictor.dataset_json['file_ending']
+    server.model_info = {
+        'path_model': os.path.abspath(args.path_model),
+        'folds': [str(f) for f in args.folds] if args.folds is not None else None,
+        'preset': args.preset,
+        'device': str(predictor.device),
+        'file_ending': server.file_ending,
+    }
+
+    print('Serving inference requests on {}'.format(address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Shutting down the inference server...')
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+if __name__ == '__main__':
+    main()
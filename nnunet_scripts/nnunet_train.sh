@@ -5,12 +5,30 @@
 #SBATCH --cpus-per-task=10  
 #SBATCH --mem=100G           
 #SBATCH --gpus-per-node=v100:1  
+#SBATCH --array=0-4
 
 DATASET_ID="030"
 
-for FOLD in 0 1 2 3 4 
-do
-    echo "Entrainement du modele pour le FOLD $FOLD"
-    nnUNetv2_train $DATASET_ID 2d $FOLD --npz
-done
+# sbatch runs a copy of this script from its spool folder: the path of the submitted script is read from the job,
+# so that train_folds.py is found whatever the folder the job was submitted from
+if [ -n "$SLURM_JOB_ID" ]; then
+    SCRIPT_PATH=$(scontrol show job "$SLURM_JOB_ID" | awk -F'Command=' 'NF > 1 {split($2, a, " "); print a[1]; exit}')
+else
+    SCRIPT_PATH="$0"
+fi
+SCRIPTS_DIR=$(cd "$(dirname "$SCRIPT_PATH")" 2>/dev/null && pwd)
+if [ ! -f "$SCRIPTS_DIR/train_folds.py" ]; then
+    echo "Erreur : train_folds.py introuvable a cote de '$SCRIPT_PATH'" >&2
+    exit 1
+fi
+
+# Each task of the array trains one fold, so the five folds train concurrently, each on the GPU of its task.
+# train_folds.py skips a fold already trained, resumes an interrupted fold from its checkpoint and retries a failed one.
+# Outside of a job array, all the folds are trained on this node.
+FOLDS=${SLURM_ARRAY_TASK_ID:-"0 1 2 3 4"}
+
+echo "Entrainement du modele pour le(s) FOLD(S) $FOLDS"
+python "$SCRIPTS_DIR/train_folds.py" --dataset-id $DATASET_ID --configuration 2d --folds $FOLDS --npz
+STATUS=$?
 echo "Entrainement termine"
+exit $STATUS
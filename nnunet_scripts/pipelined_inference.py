@@ -0,0 +1,215 @@
+"""
+Pipelined inference with nnUNetv2, and automatic sizing of the worker processes and torch threads.
+
+nnUNet's predict_from_files preprocesses, predicts and exports a list of images with pools of worker processes that
+are started and joined at every call, and returns the segmentations only once all of them are done. In the pipelined
+mode, all the images of a run flow through three overlapped stages:
+    - preprocessing workers decode and normalize the images ahead of the network, each holding at most one finished
+      image in its bounded queue (nnUNet's preprocessing iterator),
+    - the network predicts the images one after another in the main process, with all the torch threads,
+    - a pool of writer processes resamples the logits, post-processes, writes and measures the masks.
+The number of predictions handed to the writers is bounded: the network waits for the oldest one when the writers
+fall behind, so that the memory stays bounded. Each image is reported as soon as its mask is written.
+
+The numbers of workers and torch threads are derived from the CPUs this process may run on and from the available
+memory (including the limit of the cgroup of a SLURM job or container), unless given explicitly.
+"""
+
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+import nnunetv2.inference.predict_from_raw_data as predict_from_raw_data
+from nnunetv2.inference.export_prediction import (convert_predicted_logits_to_segmentation_with_correct_shape,
+                                                  export_prediction_from_logits)
+
+from instrumentation import Instrumentation
+from mask_metrics import measure_mask
+from postprocessing import save_mask
+from system_resources import available_cpus, available_memory
+
+# Predictions handed to the writers beyond one per writer, as in nnUNet's predict_from_data_iterator
+MAX_QUEUED_EXPORTS = 2
+
+# Fraction of the available memory the images in flight may use
+MEMORY_FRACTION = 0.5
+
+# Maximum number of preprocessing or export workers chosen automatically
+MAX_AUTO_WORKERS = 16
+
+
+def image_memory(num_pixels: int, num_channels: int, num_classes: int) -> int:
+    """
+    Estimate the memory held by one image in flight: its normalized float32 channels, and the float32 logits of
+    every class with their resampled copy.
+
+    Args:
+        num_pixels (int): Number of pixels of the image.
+        num_channels (int): Number of input channels.
+        num_classes (int): Number of predicted classes.
+
+    Returns:
+        int: Memory in bytes.
+    """
+    return num_pixels * 4 * (num_channels + 2 * num_classes)
+
+
+def auto_size_workers(num_images: int, bytes_per_image: int = None, use_gpu: bool = False,
+                      num_processes_preprocessing: int = None, num_processes_export: int = None,
+                      torch_threads: int = None) -> dict:
+    """
+    Choose the numbers of preprocessing and export workers and of torch intra-op threads. On CPU, a quarter of the
+    available CPUs preprocess the images, a quarter export them and the rest run the network. On GPU, the CPUs are
+    shared by the workers and the network only needs a few threads. The workers are then reduced until the images
+    in flight fit in half of the available memory.
+
+    Args:
+        num_images (int): Number of images to predict, no more workers are started.
+        bytes_per_image (int): Memory held by the largest image in flight, see image_memory. None to ignore memory.
+        use_gpu (bool): Whether the network runs on GPU.
+        num_processes_preprocessing (int): Number of preprocessing workers, None to choose it.
+        num_processes_export (int): Number of export workers, None to choose it.
+        torch_threads (int): Number of torch intra-op threads, None to choose it.
+
+    Returns:
+        dict: 'num_processes_preprocessing', 'num_processes_export' and 'torch_threads'.
+    """
+    cpus = available_cpus()
+    workers = max(1, (cpus - 1) // 2) if use_gpu else max(1, cpus // 4)
+    workers = max(1, min(workers, num_images, MAX_AUTO_WORKERS))
+    preprocessing = num_processes_preprocessing or workers
+    export = num_processes_export or workers
+
+    memory = available_memory()
+    if memory is not None and bytes_per_image:
+        # Back-pressure bounds the images in flight: two per preprocessing worker (in its queue and in progress),
+        # the one being predicted, and the predictions handed to the writers
+        def in_flight(p, e):
+            return (2 * p + 1 + e + MAX_QUEUED_EXPORTS) * bytes_per_image
+
+        while in_flight(preprocessing, export) > MEMORY_FRACTION * memory:
+            if num_processes_preprocessing is None and preprocessing > 1 and preprocessing >= export:
+                preprocessing -= 1
+            elif num_processes_export is None and export > 1:
+                export -= 1
+            elif num_processes_preprocessing is None and preprocessing > 1:
+                preprocessing -= 1
+            else:
+                break
+
+    if torch_threads is None:
+        torch_threads = max(1, cpus - preprocessing - export)
+        if use_gpu:
+            torch_threads = min(4, torch_threads)
+    return {'num_processes_preprocessing': preprocessing, 'num_processes_export': export,
+            'torch_threads': torch_threads}
+
+
+def set_torch_threads(num_threads: int):
+    """
+    Set the number of torch intra-op threads of the network.
+
+    Args:
+        num_threads (int): Number of threads.
+    """
+    torch.set_num_threads(num_threads)
+    # nnUNet caps the threads of each prediction to nnUNet_def_n_proc (8 by default), read when it is imported
+    predict_from_raw_data.default_num_processes = num_threads
+
+
+_writer = {}
+
+
+def _init_writer(plans_manager, configuration_manager, dataset_json: dict):
+    # The model description is sent once per writer rather than with every prediction
+    torch.set_num_threads(1)
+    _writer.update(plans_manager=plans_manager, configuration_manager=configuration_manager,
+                   dataset_json=dataset_json, label_manager=plans_manager.get_label_manager(dataset_json))
+
+
+def write_prediction(logits: np.ndarray, properties: dict, output_truncated: str, file_ending: str,
+                     postprocessor=None, metrics: dict = None, image: str = None) -> list:
+    """
+    Resample predicted logits to the shape of the image and write the mask, in a writer process.
+
+    Args:
+        logits (np.ndarray): Logits predicted for the preprocessed image.
+        properties (dict): Properties of the image, from the preprocessing.
+        output_truncated (str): Path to the output, without extension.
+        file_ending (str): Extension of the output.
+        postprocessor (PostProcessor): Post-processing applied before writing, None to write the class indices
+            with nnUNet's writer.
+        metrics (dict): Keyword arguments of measure_mask ('labels', 'pixel_size') to measure the mask, None to
+            skip the metrics.
+        image (str): Path to the image, for the metrics report.
+
+    Returns:
+        list: Rows of the metrics report, empty without metrics.
+    """
+    if postprocessor is None:
+        export_prediction_from_logits(logits, properties, _writer['configuration_manager'],
+                                      _writer['plans_manager'], _writer['dataset_json'], output_truncated,
+                                      num_threads_torch=1)
+        return []
+    segmentation = convert_predicted_logits_to_segmentation_with_correct_shape(
+        logits, _writer['plans_manager'], _writer['configuration_manager'], _writer['label_manager'], properties,
+        num_threads_torch=1)
+    mask = postprocessor.clean(segmentation[0])
+    save_mask(postprocessor.colorize(mask), output_truncated + file_ending)
+    if metrics is None:
+        return []
+    return measure_mask(mask, **metrics).rows(image, output_truncated + file_ending)
+
+
+def predict_pipelined(predictor, path_data: list, outputs_truncated: list, file_ending: str,
+                      num_processes_preprocessing: int, num_processes_export: int, postprocessor=None,
+                      metrics: dict = None, instrumentation=None):
+    """
+    Predict images through the preprocessing, network and writer stages overlapped. The results are yielded as
+    soon as the masks are written, in the order of the images.
+
+    Args:
+        predictor (nnUNetPredictor): Initialized predictor.
+        path_data (list): Lists of the files of each image (one per channel).
+        outputs_truncated (list): Paths to the outputs, without extension.
+        file_ending (str): Extension of the outputs.
+        num_processes_preprocessing (int): Number of preprocessing workers.
+        num_processes_export (int): Number of writer processes.
+        postprocessor (PostProcessor): Post-processing applied before writing, None to write the class indices.
+        metrics (dict): Keyword arguments of measure_mask ('labels', 'pixel_size') to measure the masks in the
+            writers, None to skip the metrics. Requires a postprocessor.
+        instrumentation (Instrumentation): Instrumentation timing the waits for the writers, None for none.
+
+    Yields:
+        tuple: Index of an image in path_data and rows of its metrics report.
+    """
+    instrumentation = instrumentation or Instrumentation()
+    data_iterator = predictor._internal_get_data_iterator_from_lists_of_filenames(
+        path_data, None, outputs_truncated, num_processes_preprocessing)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=num_processes_export, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_writer,
+                             initargs=(predictor.plans_manager, predictor.configuration_manager,
+                                       predictor.dataset_json)) as writers:
+        for i, preprocessed in enumerate(data_iterator):
+            data = preprocessed['data']
+            if isinstance(data, str):
+                path_npy = data
+                data = torch.from_numpy(np.load(path_npy))
+                os.remove(path_npy)
+            # Back-pressure: the network waits for the writers rather than piling up predictions in memory
+            while len(pending) >= num_processes_export + MAX_QUEUED_EXPORTS:
+                with instrumentation.stage('export_wait', path_data[pending[0][0]][0]):
+                    rows = pending[0][1].result()
+                yield pending.popleft()[0], rows
+            logits = predictor.predict_logits_from_preprocessed_data(data).cpu().numpy()
+            pending.append((i, writers.submit(write_prediction, logits, preprocessed['data_properties'],
+                                              outputs_truncated[i], file_ending, postprocessor, metrics,
+                                              path_data[i][0])))
+        while pending:
+            with instrumentation.stage('export_wait', path_data[pending[0][0]][0]):
+                rows = pending[0][1].result()
+            yield pending.popleft()[0], rows
@@ -0,0 +1,267 @@
+"""
+Vectorized post-processing of predicted masks.
+
+The class indices predicted by nnUNet are cleaned (small connected components removed, holes filled) and mapped to
+their final intensities or colours through a lookup table, in a few NumPy/SciPy passes over the whole mask. Folders
+of masks are processed by a pool of processes.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+from scipy import ndimage
+
+# The masks of whole slides are larger than PIL's decompression bomb limit, and they are our own outputs
+Image.MAX_IMAGE_PIXELS = None
+
+MASK_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp')
+
+# Lossy formats would alter the class values, masks with these extensions are written as PNG
+LOSSY_EXTENSIONS = ('.jpg', '.jpeg')
+
+# Colours of the classes 1, 2, ... in the 'classes' colormap (the background stays black)
+CLASS_COLORS = [
+    (255, 255, 255), (255, 0, 0), (0, 255, 0), (0, 0, 255),
+    (255, 255, 0), (255, 0, 255), (0, 255, 255), (255, 128, 0),
+]
+
+
+def binary_lut() -> np.ndarray:
+    """
+    Lookup table mapping the foreground value 1 to 255 and leaving the other values unchanged.
+
+    Returns:
+        np.ndarray: uint8 array of shape (256,).
+    """
+    lut = np.arange(256, dtype=np.uint8)
+    lut[1] = 255
+    return lut
+
+
+def classes_lut() -> np.ndarray:
+    """
+    Lookup table mapping each class to an RGB colour.
+
+    Returns:
+        np.ndarray: uint8 array of shape (256, 3).
+    """
+    lut = np.zeros((256, 3), dtype=np.uint8)
+    for label in range(1, 256):
+        lut[label] = CLASS_COLORS[(label - 1) % len(CLASS_COLORS)]
+    return lut
+
+
+COLORMAPS = {
+    'binary': binary_lut,
+    'classes': classes_lut,
+}
+
+
+def remove_small_components(mask: np.ndarray, min_size: int) -> np.ndarray:
+    """
+    Set to background the connected components of each class smaller than a minimum size.
+
+    Args:
+        mask (np.ndarray): 2D mask of class indices, modified in place.
+        min_size (int): Minimum number of pixels of a component.
+
+    Returns:
+        np.ndarray: The mask.
+    """
+    for label in np.unique(mask):
+        if label == 0:
+            continue
+        components, _ = ndimage.label(mask == label)
+        small = np.bincount(components.ravel()) < min_size
+        small[0] = False
+        mask[small[components]] = 0
+    return mask
+
+
+def fill_holes(mask: np.ndarray, max_size: int = None) -> np.ndarray:
+    """
+    Fill the background holes enclosed by each class with that class.
+
+    Args:
+        mask (np.ndarray): 2D mask of class indices, modified in place.
+        max_size (int): Maximum number of pixels of a filled hole. If None, all the holes are filled.
+
+    Returns:
+        np.ndarray: The mask.
+    """
+    for label in np.unique(mask):
+        if label == 0:
+            continue
+        holes = ndimage.binary_fill_holes(mask == label) & (mask == 0)
+        if max_size is not None:
+            components, _ = ndimage.label(holes)
+            small = np.bincount(components.ravel()) <= max_size
+            small[0] = False
+            holes = small[components]
+        mask[holes] = label
+    return mask
+
+
+class PostProcessor:
+    """
+    Post-processing applied to predicted masks: cleaning of the class indices, then mapping through a lookup table.
+
+    Args:
+        colormap (str): Name of the lookup table in COLORMAPS, None to keep the class indices.
+        min_component_size (int): Connected components smaller than this are removed. 0 to keep all of them.
+        fill_holes (bool): Fill the holes enclosed by each class.
+        max_hole_size (int): Maximum size of the filled holes, None for no limit.
+    """
+
+    def __init__(self, colormap: str = 'binary', min_component_size: int = 0, fill_holes: bool = False,
+                 max_hole_size: int = None):
+        self.colormap = colormap
+        self.min_component_size = min_component_size
+        self.fill_holes = fill_holes
+        self.max_hole_size = max_hole_size
+        self.lut = COLORMAPS[colormap]() if colormap is not None else None
+
+    @property
+    def is_pointwise(self) -> bool:
+        """
+        bool: Whether each pixel is processed independently of its neighbours, so that the masks can be processed
+        tile by tile.
+        """
+        return self.min_component_size <= 0 and not self.fill_holes
+
+    def to_dict(self) -> dict:
+        """
+        Describe the post-processing.
+
+        Returns:
+            dict: Settings of the post-processing.
+        """
+        return {'colormap': self.colormap, 'min_component_size': self.min_component_size,
+                'fill_holes': self.fill_holes, 'max_hole_size': self.max_hole_size}
+
+    def clean(self, mask: np.ndarray) -> np.ndarray:
+        """
+        Remove the small components and fill the holes of a mask.
+
+        Args:
+            mask (np.ndarray): 2D mask of class indices.
+
+        Returns:
+            np.ndarray: Cleaned uint8 mask of class indices.
+        """
+        mask = mask.astype(np.uint8)
+        if self.min_component_size > 0:
+            remove_small_components(mask, self.min_component_size)
+        if self.fill_holes:
+            fill_holes(mask, self.max_hole_size)
+        return mask
+
+    def colorize(self, mask: np.ndarray) -> np.ndarray:
+        """
+        Map a mask of class indices through the lookup table.
+
+        Args:
+            mask (np.ndarray): uint8 mask of class indices.
+
+        Returns:
+            np.ndarray: uint8 mask of shape (H, W), or (H, W, 3) for an RGB colormap.
+        """
+        return self.lut[mask] if self.lut is not None else mask
+
+    def to_class_indices(self, mask: np.ndarray, labels: list) -> np.ndarray:
+        """
+        Map a written mask, read in grayscale, back to class indices.
+
+        Args:
+            mask (np.ndarray): uint8 grayscale mask.
+            labels (list): Class indices the mask may contain.
+
+        Returns:
+            np.ndarray: uint8 mask of class indices.
+        """
+        if self.lut is None:
+            return mask
+        gray_lut = self.lut if self.lut.ndim == 1 else np.array(Image.fromarray(self.lut[:, None]).convert('L'))[:, 0]
+        inverse = np.zeros(256, dtype=np.uint8)
+        for label in sorted(labels, reverse=True):
+            inverse[gray_lut[label]] = label
+        return inverse[mask]
+
+    def __call__(self, mask: np.ndarray) -> np.ndarray:
+        """
+        Post-process a mask.
+
+        Args:
+            mask (np.ndarray): 2D mask of class indices.
+
+        Returns:
+            np.ndarray: uint8 mask of shape (H, W), or (H, W, 3) for an RGB colormap.
+        """
+        return self.colorize(self.clean(mask))
+
+
+def read_mask(path: str) -> np.ndarray:
+    """
+    Read a mask as a 2D uint8 array.
+
+    Args:
+        path (str): Path to the mask.
+
+    Returns:
+        np.ndarray: Mask of shape (H, W).
+    """
+    with Image.open(path) as image:
+        return np.asarray(image.convert('L'))
+
+
+def save_mask(mask: np.ndarray, output_fname: str):
+    """
+    Write a post-processed mask, in the format given by the file extension. Masks with a lossy extension (.jpg,
+    .jpeg) are written as PNG, as convert_pixels.py always did, so that their values are kept exactly.
+
+    Args:
+        mask (np.ndarray): uint8 mask of shape (H, W) or (H, W, 3).
+        output_fname (str): Path to the output file.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(output_fname)), exist_ok=True)
+    file_format = 'PNG' if output_fname.lower().endswith(LOSSY_EXTENSIONS) else None
+    Image.fromarray(mask).save(output_fname, format=file_format)
+
+
+def postprocess_file(input_fname: str, output_fname: str, postprocessor: PostProcessor) -> str:
+    """
+    Post-process a mask file.
+
+    Args:
+        input_fname (str): Path to the mask of class indices.
+        output_fname (str): Path to the output mask.
+        postprocessor (PostProcessor): Post-processing to apply.
+
+    Returns:
+        str: Path to the output mask.
+    """
+    save_mask(postprocessor(read_mask(input_fname)), output_fname)
+    return output_fname
+
+
+def postprocess_files(input_fnames: list, output_fnames: list, postprocessor: PostProcessor,
+                      workers: int = 1) -> list:
+    """
+    Post-process mask files, in parallel processes if workers > 1.
+
+    Args:
+        input_fnames (list): Paths to the masks of class indices.
+        output_fnames (list): Paths to the output masks.
+        postprocessor (PostProcessor): Post-processing to apply.
+        workers (int): Number of processes.
+
+    Returns:
+        list: Paths to the output masks.
+    """
+    postprocessors = [postprocessor] * len(input_fnames)
+    if workers <= 1:
+        return list(map(postprocess_file, input_fnames, output_fnames, postprocessors))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(postprocess_file, input_fnames, output_fnames, postprocessors))
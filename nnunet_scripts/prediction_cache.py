@@ -0,0 +1,193 @@
+"""
+Content-addressed cache of nnUNet predictions.
+
+A prediction is stored under a key combining the hash of the image content and the fingerprint of the model that
+produced it (checkpoint hashes, plans, folds and predictor settings). A duplicate image is thus served from the
+cache whatever its name, and retraining the model or changing the inference settings invalidates the entries.
+The cache is bounded in size: the least recently used entries are evicted first. This module does not import torch.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+from inference_utils import PACK_EXTENSION, hash_file
+
+CHECKPOINT_HASHES_FILENAME = 'checkpoint_hashes.json'
+
+
+def hash_image(path: str) -> str:
+    """
+    Compute the hash of the content of an image to segment: the file, or the case of an NNPack container.
+
+    Args:
+        path (str): Path to the image, or virtual path to the case of a container.
+
+    Returns:
+        str: Hexadecimal digest.
+    """
+    if path.endswith(PACK_EXTENSION):
+        # nnpack imports nnunetv2, so it is only imported for packed datasets
+        from nnpack import hash_case
+        return hash_case(path)
+    return hash_file(path)
+
+
+class PredictionCache:
+    """
+    Size-bounded cache of prediction files, with least-recently-used eviction. The access time of an entry is
+    tracked by its modification time, so that it survives between runs. The entries are listed once per instance,
+    then their order and total size are kept up to date in memory, so that storing a prediction does not rescan
+    the cache. Entries stored meanwhile by other processes are only accounted for by the next instance.
+
+    Args:
+        cache_dir (str): Folder of the cache.
+        max_size (int): Maximum total size of the entries in bytes.
+    """
+
+    def __init__(self, cache_dir: str, max_size: int):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+        # Paths of the entries mapped to their size, least recently used first. Listed on first use.
+        self._entries = None
+        self._size = 0
+
+    def model_fingerprint(self, path_model: str, folds: list, checkpoint_name: str, settings: dict) -> str:
+        """
+        Compute the fingerprint of a model and of the settings of its predictor.
+
+        Args:
+            path_model (str): Path to the model directory.
+            folds (list): Folds used for the prediction.
+            checkpoint_name (str): Name of the checkpoint files.
+            settings (dict): JSON-serializable settings affecting the predictions.
+
+        Returns:
+            str: Hexadecimal fingerprint.
+        """
+        files = ['plans.json', 'dataset.json'] + [os.path.join(f'fold_{fold}', checkpoint_name) for fold in folds]
+        content = {
+            'files': {f: self._checkpoint_hash(os.path.join(path_model, f)) for f in files},
+            'folds': [str(fold) for fold in folds],
+            'settings': settings,
+        }
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def _checkpoint_hash(self, path: str) -> str:
+        # Checkpoints weigh hundreds of MB: their hashes are reused as long as their size and mtime are unchanged
+        path = os.path.abspath(path)
+        path_hashes = os.path.join(self.cache_dir, CHECKPOINT_HASHES_FILENAME)
+        hashes = {}
+        if os.path.isfile(path_hashes):
+            with open(path_hashes) as f:
+                hashes = json.load(f)
+        stat = os.stat(path)
+        known = hashes.get(path)
+        if known is not None and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['sha256']
+        hashes[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': hash_file(path)}
+        self._write_atomic(path_hashes, json.dumps(hashes, indent=2).encode())
+        return hashes[path]['sha256']
+
+    @staticmethod
+    def key(image_hash: str, fingerprint: str) -> str:
+        """
+        Build the key of a prediction.
+
+        Args:
+            image_hash (str): Hash of the image content.
+            fingerprint (str): Fingerprint of the model.
+
+        Returns:
+            str: Hexadecimal key.
+        """
+        return hashlib.sha256(f'{fingerprint}:{image_hash}'.encode()).hexdigest()
+
+    def _entry_path(self, key: str, file_ending: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + file_ending)
+
+    def get(self, key: str, file_ending: str, output_fname: str) -> bool:
+        """
+        Copy a cached prediction to an output file, if present.
+
+        Args:
+            key (str): Key of the prediction.
+            file_ending (str): File ending of the prediction.
+            output_fname (str): Path to the output file.
+
+        Returns:
+            bool: Whether the prediction was found.
+        """
+        entry = self._entry_path(key, file_ending)
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            return False
+        if self._entries is not None and entry in self._entries:
+            self._entries.move_to_end(entry)
+        os.makedirs(os.path.dirname(os.path.abspath(output_fname)), exist_ok=True)
+        shutil.copyfile(entry, output_fname)
+        return True
+
+    def put(self, key: str, file_ending: str, fname: str):
+        """
+        Store a prediction in the cache, then evict the least recently used entries beyond the maximum size.
+
+        Args:
+            key (str): Key of the prediction.
+            file_ending (str): File ending of the prediction.
+            fname (str): Path to the prediction file.
+        """
+        entries = self._list_entries()
+        entry = self._entry_path(key, file_ending)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        fd, path_tmp = tempfile.mkstemp(dir=os.path.dirname(entry), prefix='.tmp_')
+        os.close(fd)
+        shutil.copyfile(fname, path_tmp)
+        os.replace(path_tmp, entry)
+        size = os.path.getsize(entry)
+        self._size += size - entries.pop(entry, 0)
+        entries[entry] = size
+        if self._size > self.max_size:
+            self.evict()
+
+    def _list_entries(self) -> OrderedDict:
+        if self._entries is None:
+            entries = []
+            for folder in os.listdir(self.cache_dir):
+                path_folder = os.path.join(self.cache_dir, folder)
+                if not os.path.isdir(path_folder):
+                    continue
+                for f in os.listdir(path_folder):
+                    if f.startswith('.tmp_'):
+                        continue
+                    stat = os.stat(os.path.join(path_folder, f))
+                    entries.append((stat.st_mtime_ns, os.path.join(path_folder, f), stat.st_size))
+            self._entries = OrderedDict((path, size) for _, path, size in sorted(entries))
+            self._size = sum(self._entries.values())
+        return self._entries
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in its maximum size.
+        """
+        entries = self._list_entries()
+        while entries and self._size > self.max_size:
+            path, size = entries.popitem(last=False)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Already evicted by another process sharing the cache
+                pass
+            self._size -= size
+
+    @staticmethod
+    def _write_atomic(path: str, content: bytes):
+        fd, path_tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(path_tmp, path)
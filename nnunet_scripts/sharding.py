@@ -0,0 +1,214 @@
+"""
+Sharding of the inference over several jobs (e.g. the tasks of a SLURM array), with resumable work manifests.
+
+The images are split deterministically into parts of balanced total pixel count, so that every job computes the
+same split without communicating. Each part records its completed predictions in an append-only JSON-lines
+manifest under '<output folder>/.shards', so that a re-queued job skips the images it already predicted. Once all
+the parts are done, the manifests can be merged and checked so that every input has exactly one prediction.
+"""
+
+import json
+import os
+
+from PIL import Image
+
+from inference_utils import PACK_EXTENSION
+from tiled_io import is_tiff, slide_shape
+
+SHARDS_FOLDER = '.shards'
+MERGED_MANIFEST_FILENAME = 'predictions_manifest.jsonl'
+
+
+def image_pixel_count(path: str) -> int:
+    """
+    Get the number of pixels of an image from its header, without decoding it. Formats that cannot be read this
+    way are weighted by their file size.
+
+    Args:
+        path (str): Path to the image.
+
+    Returns:
+        int: Number of pixels.
+    """
+    if is_tiff(path):
+        height, width = slide_shape(path)
+        return height * width
+    if path.endswith(PACK_EXTENSION):
+        # nnpack imports nnunetv2, so it is only imported for packed datasets
+        from nnpack import case_shape
+        height, width = case_shape(path)[:2]
+        return height * width
+    try:
+        with Image.open(path) as image:
+            return image.width * image.height
+    except OSError:
+        return os.path.getsize(path)
+
+
+def assign_parts(weights: list, num_parts: int) -> list:
+    """
+    Split weighted items into parts of balanced total weight, with the longest-processing-time-first heuristic:
+    the heaviest remaining item goes to the lightest part. Ties are broken by item and part index, so that the
+    split is deterministic.
+
+    Args:
+        weights (list): Weight of each item.
+        num_parts (int): Number of parts.
+
+    Returns:
+        list: Part of each item.
+    """
+    loads = [0] * num_parts
+    parts = [0] * len(weights)
+    for i in sorted(range(len(weights)), key=lambda i: (-weights[i], i)):
+        part = min(range(num_parts), key=lambda p: (loads[p], p))
+        parts[i] = part
+        loads[part] += weights[i]
+    return parts
+
+
+def get_shard(path_images: list, num_parts: int, part_id: int) -> list:
+    """
+    Get the images predicted by one part.
+
+    Args:
+        path_images (list): Paths to all the images, in the same order for every part.
+        num_parts (int): Number of parts.
+        part_id (int): Index of the part, from 0 to num_parts - 1.
+
+    Returns:
+        list: Indices of the images of the part.
+    """
+    if not 0 <= part_id < num_parts:
+        raise ValueError(f'part_id must be between 0 and {num_parts - 1}, got {part_id}.')
+    parts = assign_parts([image_pixel_count(f) for f in path_images], num_parts)
+    return [i for i, part in enumerate(parts) if part == part_id]
+
+
+def manifest_filename(num_parts: int, part_id: int) -> str:
+    """
+    Get the file name of the manifest of a part.
+
+    Args:
+        num_parts (int): Number of parts.
+        part_id (int): Index of the part.
+
+    Returns:
+        str: File name, in the shards folder of the output folder.
+    """
+    return f'part_{part_id}_of_{num_parts}.jsonl'
+
+
+class ShardManifest:
+    """
+    Append-only record of the predictions completed by a part.
+
+    Args:
+        path_out (str): Output folder of the predictions.
+        num_parts (int): Number of parts.
+        part_id (int): Index of the part.
+        run_id (str): Identifier of the model and settings. Records of other runs are not considered completed.
+    """
+
+    def __init__(self, path_out: str, num_parts: int, part_id: int, run_id: str = None):
+        self.path = os.path.join(path_out, SHARDS_FOLDER, manifest_filename(num_parts, part_id))
+        self.part_id = part_id
+        self.run_id = run_id
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    def completed(self) -> set:
+        """
+        List the outputs recorded by this part for the current run and still present on disk.
+
+        Returns:
+            set: Absolute paths to the completed outputs.
+        """
+        return {record['output'] for record in read_manifest(self.path)
+                if record.get('run_id') == self.run_id and os.path.isfile(record['output'])}
+
+    def record(self, path_images: list, outputs: list):
+        """
+        Record completed predictions. The records are flushed to disk before returning.
+
+        Args:
+            path_images (list): Paths to the images.
+            outputs (list): Paths to their predictions.
+        """
+        with open(self.path, 'a') as f:
+            for path_image, output in zip(path_images, outputs):
+                f.write(json.dumps({'image': os.path.abspath(path_image), 'output': os.path.abspath(output),
+                                    'part_id': self.part_id, 'run_id': self.run_id}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def read_manifest(path: str) -> list:
+    """
+    Read the records of a manifest. A truncated last line, left by a job killed while writing, is ignored.
+
+    Args:
+        path (str): Path to the manifest.
+
+    Returns:
+        list: Records.
+    """
+    if not os.path.isfile(path):
+        return []
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def verify_predictions(path_images: list, outputs: list, path_out: str, num_parts: int, run_id: str = None) -> dict:
+    """
+    Check that every input has exactly one prediction, and merge the manifests of the parts into
+    '<output folder>/predictions_manifest.jsonl'. Only the manifests of the current split into num_parts parts,
+    and their records of the current run, are considered.
+
+    Args:
+        path_images (list): Paths to all the images.
+        outputs (list): Paths to their expected predictions.
+        path_out (str): Output folder of the predictions.
+        num_parts (int): Number of parts of the run.
+        run_id (str): Identifier of the model and settings of the run, see ShardManifest.
+
+    Returns:
+        dict: Lists of 'missing' predictions, 'conflicting' outputs shared by several images, images predicted
+        by 'several_parts', and 'unexpected' prediction files matching no image.
+    """
+    path_images = [os.path.abspath(f) for f in path_images]
+    outputs = [os.path.abspath(f) for f in outputs]
+    path_shards = os.path.join(path_out, SHARDS_FOLDER)
+    records = []
+    for part_id in range(num_parts):
+        records += [record for record in read_manifest(os.path.join(path_shards, manifest_filename(num_parts, part_id)))
+                    if record.get('run_id') == run_id]
+
+    parts_by_image = {}
+    for record in records:
+        parts_by_image.setdefault(record['image'], set()).add(record['part_id'])
+    images_by_output = {}
+    for path_image, output in zip(path_images, outputs):
+        images_by_output.setdefault(output, []).append(path_image)
+
+    file_endings = {os.path.splitext(f)[1] for f in outputs}
+    report = {
+        'missing': [f for f, output in zip(path_images, outputs) if not os.path.isfile(output)],
+        'conflicting': sorted(output for output, images in images_by_output.items() if len(images) > 1),
+        'several_parts': sorted(f for f in path_images if len(parts_by_image.get(f, ())) > 1),
+        'unexpected': sorted(os.path.join(os.path.abspath(path_out), f) for f in os.listdir(path_out)
+                             if f.endswith(tuple(file_endings))
+                             and os.path.join(os.path.abspath(path_out), f) not in images_by_output),
+    }
+
+    with open(os.path.join(path_out, MERGED_MANIFEST_FILENAME), 'w') as f:
+        for path_image, output in zip(path_images, outputs):
+            if os.path.isfile(output):
+                parts = sorted(parts_by_image.get(path_image, ()))
+                f.write(json.dumps({'image': path_image, 'output': output, 'parts': parts}) + '\n')
+    return report
@@ -0,0 +1,54 @@
+"""
+CPUs and memory available to the current process, which are lower than those of the node in SLURM jobs and
+containers. Shared by the inference and training scripts, this module only depends on the standard library.
+"""
+
+import os
+
+
+def available_cpus() -> int:
+    """
+    Get the number of CPUs this process may run on, which is lower than the CPU count in containers and jobs
+    restricted to some cores.
+
+    Returns:
+        int: Number of CPUs.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def available_memory() -> int:
+    """
+    Get the memory available to this process: the available system memory, further limited by the memory limit of
+    its cgroup (SLURM jobs, containers).
+
+    Returns:
+        int: Available memory in bytes, None if unknown.
+    """
+    available = None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+    for limit_file, usage_file in [('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+                                    '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        try:
+            with open(limit_file) as f:
+                limit = f.read().strip()
+            with open(usage_file) as f:
+                usage = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        # Unlimited cgroups report 'max', or a huge number in cgroup v1
+        if limit.isdigit() and int(limit) < 2 ** 60:
+            cgroup_available = max(0, int(limit) - usage)
+            available = cgroup_available if available is None else min(available, cgroup_available)
+        break
+    return available
@@ -0,0 +1,302 @@
+"""
+Memory-bounded reading and writing of whole-slide images.
+
+Large TIFF slides are accessed lazily, either memory-mapped (uncompressed, contiguous data) or through the
+tile/strip index of the file, so that only the requested region is ever decoded.
+"""
+
+import struct
+import zlib
+
+import numpy as np
+import tifffile
+from PIL import Image
+
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+
+def is_tiff(path: str) -> bool:
+    """
+    Check whether a file is a TIFF image, based on its extension.
+
+    Args:
+        path (str): Path to the image.
+
+    Returns:
+        bool: True for .tif/.tiff files.
+    """
+    return path.lower().endswith(TIFF_EXTENSIONS)
+
+
+def rgb_to_gray(region: np.ndarray) -> np.ndarray:
+    """
+    Convert an image region to 8-bit grayscale, with the same rounding as PIL's convert('L').
+
+    Args:
+        region (np.ndarray): Region of shape (H, W) or (H, W, C).
+
+    Returns:
+        np.ndarray: uint8 array of shape (H, W).
+    """
+    if region.dtype != np.uint8:
+        region = np.clip(region, 0, 255).astype(np.uint8)
+    if region.ndim == 2:
+        return region
+    if region.shape[-1] < 3:
+        return np.ascontiguousarray(region[..., 0])
+    rgb = region[..., :3].astype(np.uint32)
+    gray = (rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 0x8000) >> 16
+    return gray.astype(np.uint8)
+
+
+class SlideReader:
+    """
+    Lazy reader for the full-resolution level of a TIFF slide.
+
+    Args:
+        path (str): Path to the TIFF file.
+        chunk_width (int): Width of the column chunks used to convert a region to grayscale, which bounds
+            the size of the temporary buffers.
+    """
+
+    def __init__(self, path: str, chunk_width: int = 4096):
+        if not is_tiff(path):
+            raise ValueError(f'Tiled reading is only supported for TIFF files, got {path}.')
+        self.path = path
+        self.chunk_width = chunk_width
+        self._tiff = tifffile.TiffFile(path)
+        series = self._tiff.series[0]
+        self.axes = series.levels[0].axes if series.levels else series.axes
+        try:
+            self._array = tifffile.memmap(path, series=0, mode='r')
+        except ValueError:
+            try:
+                import zarr
+            except ImportError as e:
+                raise ImportError(f'{path} is compressed or tiled and cannot be memory-mapped: '
+                                  'reading it lazily requires the zarr package.') from e
+            self._array = zarr.open(series.aszarr(level=0), mode='r')
+        if 'Y' not in self.axes or 'X' not in self.axes:
+            raise ValueError(f'Unsupported axes {self.axes} in {path}.')
+        self._y_axis = self.axes.index('Y')
+        self._x_axis = self.axes.index('X')
+        self.shape = (self._array.shape[self._y_axis], self._array.shape[self._x_axis])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """
+        Close the underlying TIFF file.
+        """
+        self._array = None
+        self._tiff.close()
+
+    def _read(self, y: int, x: int, height: int, width: int) -> np.ndarray:
+        index = []
+        kept_axes = []
+        for axis in self.axes:
+            if axis == 'Y':
+                index.append(slice(y, y + height))
+            elif axis == 'X':
+                index.append(slice(x, x + width))
+            elif axis in 'SC' and not set(kept_axes) & set('SC'):
+                index.append(slice(None))
+            else:
+                index.append(0)
+                continue
+            kept_axes.append(axis)
+        region = np.asarray(self._array[tuple(index)])
+        order = [kept_axes.index('Y'), kept_axes.index('X')] + [i for i, axis in enumerate(kept_axes) if axis not in 'YX']
+        return np.transpose(region, order)
+
+    def read_region(self, y: int, x: int, height: int, width: int, gray: bool = True) -> np.ndarray:
+        """
+        Read a region of the slide as 8-bit values, in grayscale by default.
+
+        Args:
+            y (int): Top row of the region.
+            x (int): Left column of the region.
+            height (int): Height of the region.
+            width (int): Width of the region.
+            gray (bool): Convert the region to grayscale. If False, the channels of the slide are kept.
+
+        Returns:
+            np.ndarray: uint8 array of shape (height, width), or (height, width, C) if gray is False.
+        """
+        if not gray:
+            region = self._read(y, x, height, width)
+            return region if region.dtype == np.uint8 else np.clip(region, 0, 255).astype(np.uint8)
+        gray = np.empty((height, width), dtype=np.uint8)
+        for x0 in range(0, width, self.chunk_width):
+            chunk_width = min(self.chunk_width, width - x0)
+            gray[:, x0:x0 + chunk_width] = rgb_to_gray(self._read(y, x + x0, height, chunk_width))
+        return gray
+
+    def iter_bands(self, band_height: int, gray: bool = True):
+        """
+        Iterate over full-width bands of rows, as 8-bit values in grayscale by default.
+
+        Args:
+            band_height (int): Number of rows per band.
+            gray (bool): Convert the bands to grayscale. If False, the channels of the slide are kept.
+
+        Yields:
+            tuple: Top row of the band and uint8 array of shape (rows, width), or (rows, width, C).
+        """
+        height, width = self.shape
+        for y in range(0, height, band_height):
+            yield y, self.read_region(y, 0, min(band_height, height - y), width, gray)
+
+
+class ImageReader(SlideReader):
+    """
+    Reader with the interface of SlideReader for images that cannot be read lazily, such as the PNG annotations
+    of TIFF slides. The image is decoded once in grayscale with PIL, with the same conversion as the untiled
+    conversion, then read by regions or bands like a slide. Its regions are grayscale whatever the gray argument.
+
+    Args:
+        path (str): Path to the image.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with Image.open(path) as image:
+            self._image = np.array(image.convert('L'))
+        self.shape = self._image.shape
+
+    def close(self):
+        """
+        Release the decoded image.
+        """
+        self._image = None
+
+    def read_region(self, y: int, x: int, height: int, width: int, gray: bool = True) -> np.ndarray:
+        """
+        Read a region of the image, see SlideReader.read_region.
+        """
+        return self._image[y:y + height, x:x + width]
+
+
+def open_slide(path: str):
+    """
+    Open an image for reading by regions or bands: TIFF files lazily, other images decoded with PIL.
+
+    Args:
+        path (str): Path to the image.
+
+    Returns:
+        SlideReader: Reader of the image, to be closed after use.
+    """
+    return SlideReader(path) if is_tiff(path) else ImageReader(path)
+
+
+def slide_shape(path: str) -> tuple:
+    """
+    Read the (height, width) of the full-resolution level of a TIFF slide from its header.
+
+    Args:
+        path (str): Path to the TIFF file.
+
+    Returns:
+        tuple: Height and width in pixels.
+    """
+    with tifffile.TiffFile(path) as tiff:
+        series = tiff.series[0]
+        level = series.levels[0] if series.levels else series
+        return level.shape[level.axes.index('Y')], level.shape[level.axes.index('X')]
+
+
+def crop_windows(height: int, width: int, crop_size: int, overlap: int = 0) -> list:
+    """
+    List fixed-size windows covering an image, with the last row/column of windows aligned on the image border.
+
+    Args:
+        height (int): Height of the image.
+        width (int): Width of the image.
+        crop_size (int): Side of the square windows. Images smaller than a window give a single, smaller window.
+        overlap (int): Number of pixels shared by neighbouring windows.
+
+    Returns:
+        list: Windows as (y, x, height, width) tuples.
+    """
+    step = crop_size - overlap
+    if step <= 0:
+        raise ValueError(f'The crop overlap ({overlap}) must be smaller than the crop size ({crop_size}).')
+
+    def starts(length):
+        if length <= crop_size:
+            return [0]
+        positions = list(range(0, length - crop_size + 1, step))
+        if positions[-1] + crop_size < length:
+            positions.append(length - crop_size)
+        return positions
+
+    return [(y, x, min(crop_size, height), min(crop_size, width)) for y in starts(height) for x in starts(width)]
+
+
+class PNGStreamWriter:
+    """
+    Write an 8-bit grayscale PNG row band by row band, without holding the whole image in memory.
+
+    Args:
+        path (str): Destination path.
+        width (int): Width of the image.
+        height (int): Height of the image.
+        compression_level (int): zlib compression level.
+    """
+
+    def __init__(self, path: str, width: int, height: int, compression_level: int = 6):
+        self.width = width
+        self.height = height
+        self._rows_written = 0
+        self._compressor = zlib.compressobj(compression_level)
+        self._file = open(path, 'wb')
+        self._file.write(b'\x89PNG\r\n\x1a\n')
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+
+    def _write_chunk(self, chunk_type: bytes, data: bytes):
+        self._file.write(struct.pack('>I', len(data)))
+        self._file.write(chunk_type)
+        self._file.write(data)
+        self._file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type)) & 0xFFFFFFFF))
+
+    def write_rows(self, rows: np.ndarray):
+        """
+        Append rows to the image.
+
+        Args:
+            rows (np.ndarray): uint8 array of shape (n, width).
+        """
+        if rows.shape[1] != self.width:
+            raise ValueError(f'Expected rows of width {self.width}, got {rows.shape[1]}.')
+        filtered = np.zeros((rows.shape[0], self.width + 1), dtype=np.uint8)
+        filtered[:, 1:] = rows
+        data = self._compressor.compress(filtered.tobytes())
+        if data:
+            self._write_chunk(b'IDAT', data)
+        self._rows_written += rows.shape[0]
+
+    def close(self):
+        """
+        Flush the compressed stream and close the file.
+        """
+        if self._rows_written != self.height:
+            self._file.close()
+            raise ValueError(f'Expected {self.height} rows, {self._rows_written} were written.')
+        self._write_chunk(b'IDAT', self._compressor.flush())
+        self._write_chunk(b'IEND', b'')
+        self._file.close()
+
@@ -0,0 +1,101 @@
+"""
+nnUNet trainer timing where each epoch spends its time: waiting for the data augmentation workers, or computing.
+
+nnUNetTrainerTimed is nnUNet's default trainer with timers around its training and validation steps. The time between
+two steps is the time spent waiting for the next batch of the data loader. Each epoch is appended as a JSON line to
+'epoch_timings.jsonl' in the fold folder, which train_folds.py summarizes as iterations per second and data wait time.
+
+nnUNet only looks for trainers in its nnunetv2.training.nnUNetTrainer package, where this module must be installed
+with 'python timed_trainer.py --install'. The installed copy therefore only depends on nnUNet: the name of the
+timings file, defined by train_folds.py, is written into it.
+"""
+
+import argparse
+import json
+import os
+import time
+
+from nnunetv2.training.nnUNetTrainer.nnUNetTrainer import nnUNetTrainer
+
+from train_folds import TIMINGS_FILENAME
+
+# Import replaced by the value of TIMINGS_FILENAME in the installed copy, where train_folds cannot be imported
+TIMINGS_IMPORT = 'from train_folds import TIMINGS_FILENAME'
+
+# Name of this module once installed in nnunetv2.training.nnUNetTrainer
+INSTALLED_MODULE_NAME = 'nnUNetTrainerTimed.py'
+
+
+class nnUNetTrainerTimed(nnUNetTrainer):
+    """
+    nnUNetTrainer recording the data wait and compute time of the training and validation steps of each epoch.
+    """
+
+    def _start_phase(self, phase: str):
+        self._timings.update({f'{phase}_iterations': 0, f'{phase}_data_wait': 0.0, f'{phase}_compute': 0.0})
+        self._last_step_end = time.perf_counter()
+
+    def _timed_step(self, phase: str, step, batch: dict) -> dict:
+        # The batch was fetched from the data loader since the end of the previous step
+        start = time.perf_counter()
+        self._timings[f'{phase}_data_wait'] += start - self._last_step_end
+        result = step(batch)
+        self._last_step_end = time.perf_counter()
+        self._timings[f'{phase}_compute'] += self._last_step_end - start
+        self._timings[f'{phase}_iterations'] += 1
+        return result
+
+    def on_train_epoch_start(self):
+        super().on_train_epoch_start()
+        self._timings = {'epoch': self.current_epoch}
+        self._start_phase('train')
+
+    def train_step(self, batch: dict) -> dict:
+        return self._timed_step('train', super().train_step, batch)
+
+    def on_validation_epoch_start(self):
+        super().on_validation_epoch_start()
+        self._start_phase('val')
+
+    def validation_step(self, batch: dict) -> dict:
+        return self._timed_step('val', super().validation_step, batch)
+
+    def on_epoch_end(self):
+        self._timings['epoch_time'] = time.time() - self.logger.get_value('epoch_start_timestamps', step=-1)
+        super().on_epoch_end()
+        if self.local_rank == 0:
+            with open(os.path.join(self.output_folder, TIMINGS_FILENAME), 'a') as f:
+                f.write(json.dumps(self._timings) + '\n')
+            wait = self._timings['train_data_wait']
+            self.print_to_log_file('Train data wait: {:.2f} s of {:.2f} s'.format(
+                wait, wait + self._timings['train_compute']))
+
+
+def install_trainer() -> str:
+    """
+    Copy this module into nnunetv2.training.nnUNetTrainer, where nnUNet looks for the trainer given with -tr, with
+    the name of the timings file written in place of its import.
+
+    Returns:
+        str: Path to the installed module.
+    """
+    import nnunetv2.training.nnUNetTrainer as trainers
+    destination = os.path.join(os.path.dirname(trainers.__file__), INSTALLED_MODULE_NAME)
+    with open(os.path.abspath(__file__)) as f:
+        source = f.read()
+    with open(destination, 'w') as f:
+        f.write(source.replace(TIMINGS_IMPORT + '\n', f'TIMINGS_FILENAME = {TIMINGS_FILENAME!r}\n', 1))
+    return destination
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the nnUNetTrainerTimed trainer')
+    parser.add_argument('--install', action='store_true', default=False,
+                        help='Install the trainer in nnunetv2.training.nnUNetTrainer, so that nnUNet finds it.')
+    args = parser.parse_args()
+
+    if args.install:
+        print('Installed the nnUNetTrainerTimed trainer as {}'.format(install_trainer()))
+
+if __name__ == '__main__':
+    main()
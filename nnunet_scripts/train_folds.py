@@ -0,0 +1,520 @@
+"""
+Train the cross-validation folds of an nnUNet model concurrently.
+
+The folds are either run as concurrent nnUNetv2_train processes sharing the node (local mode), spread over its GPUs,
+or submitted as a SLURM job array with one fold per task (slurm mode), each task running this script in local mode
+for its fold. In both modes:
+    - the number of data augmentation workers of each fold (nnUNet_n_proc_DA) is derived from the CPUs and memory
+      available to the folds running together, unless given,
+    - a fold that already has its final checkpoint is skipped, and a fold with an intermediate checkpoint resumes
+      from it (nnUNetv2_train --c), including after a failure, which is retried,
+    - each fold writes a record of its attempts, summarized in a report with its training throughput. With the
+      nnUNetTrainerTimed trainer (--timed, see timed_trainer.py), the report shows the iterations per second and the
+      share of time spent waiting for the data loader, to tell whether training is limited by I/O or by compute.
+"""
+
+import argparse
+import json
+import os
+import re
+import shlex
+import signal
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from system_resources import available_cpus, available_memory
+
+# Epoch timings written by nnUNetTrainerTimed in the fold folder (see timed_trainer.py)
+TIMINGS_FILENAME = 'epoch_timings.jsonl'
+
+# Memory reserved for the main training process of each fold (network, optimizer, CUDA context)
+MAIN_PROCESS_MEMORY = 4 * 1024 ** 3
+
+# Memory of a data augmentation worker besides its cached batches (interpreter, libraries, loaded cases)
+WORKER_BASE_MEMORY = 1024 ** 3
+
+# Maximum number of data augmentation workers chosen automatically
+MAX_AUTO_DA_WORKERS = 24
+
+# Share of the training time spent waiting for the data loader above which a fold is reported as I/O bound
+DATA_BOUND_FRACTION = 0.2
+
+# Record of the attempts of a fold, written in its folder
+RUN_RECORD_FILENAME = 'train_folds_run.json'
+
+POLL_INTERVAL = 5
+
+
+def batch_memory(dataset_name: str, configuration: str, plans: str) -> int:
+    """
+    Estimate the memory of one training batch of a configuration: its float32 images and segmentation, and the
+    downsampled segmentations of deep supervision.
+
+    Args:
+        dataset_name (str): Name of the dataset, e.g. 'Dataset030_axones'.
+        configuration (str): nnUNet configuration, e.g. '2d'.
+        plans (str): Plans identifier, e.g. 'nnUNetPlans'.
+
+    Returns:
+        int: Memory in bytes, None if the dataset is not preprocessed.
+    """
+    folder = os.path.join(os.environ.get('nnUNet_preprocessed', ''), dataset_name)
+    try:
+        with open(os.path.join(folder, plans + '.json')) as f:
+            configurations = json.load(f)['configurations']
+        with open(os.path.join(folder, 'dataset.json')) as f:
+            num_channels = len(json.load(f)['channel_names'])
+        settings = dict(configurations[configuration])
+        # Configurations may inherit their batch and patch sizes from another one
+        while 'inherits_from' in settings:
+            parent = configurations[settings.pop('inherits_from')]
+            settings = {**parent, **settings}
+    except (OSError, KeyError):
+        return None
+    pixels = settings['batch_size'] * int(np.prod(settings['patch_size']))
+    return 2 * pixels * (num_channels + 1) * 4
+
+
+def size_da_workers(num_parallel: int, bytes_per_batch: int = None) -> int:
+    """
+    Choose the number of data augmentation workers of each fold, for num_parallel folds sharing the CPUs and memory
+    available to this process. nnUNet starts that many training workers plus half as many validation workers next
+    to the main process of the fold, and each training worker caches several batches.
+
+    Args:
+        num_parallel (int): Number of folds running together.
+        bytes_per_batch (int): Memory of one training batch, see batch_memory. None to ignore memory.
+
+    Returns:
+        int: Number of data augmentation workers per fold.
+    """
+    cpus_per_fold = max(1, available_cpus() // num_parallel)
+    workers = max(1, min(MAX_AUTO_DA_WORKERS, 2 * (cpus_per_fold - 1) // 3))
+
+    memory = available_memory()
+    if memory is not None and bytes_per_batch:
+        memory_per_fold = memory / num_parallel - MAIN_PROCESS_MEMORY
+        # A training worker caches max(6, n // 2) batches, a validation worker max(3, n // 4) for n // 2 workers
+        def fold_memory(n):
+            return 1.5 * n * WORKER_BASE_MEMORY + (max(6, n // 2) + max(3, n // 4)) * 2 * bytes_per_batch
+
+        while workers > 1 and fold_memory(workers) > memory_per_fold:
+            workers -= 1
+    return workers
+
+
+def fold_folder(dataset_name: str, trainer: str, plans: str, configuration: str, fold: int) -> str:
+    """
+    Get the output folder of a fold in nnUNet_results.
+
+    Args:
+        dataset_name (str): Name of the dataset.
+        trainer (str): Name of the trainer.
+        plans (str): Plans identifier.
+        configuration (str): nnUNet configuration.
+        fold (int): Fold number.
+
+    Returns:
+        str: Path to the fold folder.
+    """
+    return os.path.join(os.environ.get('nnUNet_results', ''), dataset_name, f'{trainer}__{plans}__{configuration}',
+                        f'fold_{fold}')
+
+
+def load_run_record(folder: str) -> dict:
+    """
+    Load the record of the attempts of a fold.
+
+    Args:
+        folder (str): Fold folder.
+
+    Returns:
+        dict: Record with the 'fold' and its 'attempts', empty if the fold was never run by this script.
+    """
+    try:
+        with open(os.path.join(folder, RUN_RECORD_FILENAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_run_record(folder: str, record: dict):
+    """
+    Atomically write the record of the attempts of a fold.
+
+    Args:
+        folder (str): Fold folder.
+        record (dict): Record of the fold.
+    """
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, RUN_RECORD_FILENAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(record, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+class FoldRun:
+    """
+    Training of one fold with nnUNetv2_train, retried from its latest checkpoint when it fails.
+
+    Args:
+        fold (int): Fold number.
+        folder (str): Output folder of the fold.
+        command (list): nnUNetv2_train command of the fold, without --c.
+        env (dict): Environment of the training processes.
+        max_retries (int): Number of times a failed training is resumed.
+    """
+
+    def __init__(self, fold: int, folder: str, command: list, env: dict, max_retries: int):
+        self.fold = fold
+        self.folder = folder
+        self.command = command
+        self.env = env
+        self.max_retries = max_retries
+        self.record = load_run_record(folder) or {'fold': fold, 'attempts': []}
+        self.retries = 0
+        self.process = None
+        self.log = None
+
+    @property
+    def finished(self) -> bool:
+        return os.path.isfile(os.path.join(self.folder, 'checkpoint_final.pth'))
+
+    def start(self, device: str = None):
+        """
+        Start an attempt, resuming from the latest checkpoint of the fold if there is one.
+
+        Args:
+            device (str): GPU made visible to the training, None to keep the visible devices.
+        """
+        resume = any(os.path.isfile(os.path.join(self.folder, name))
+                     for name in ('checkpoint_latest.pth', 'checkpoint_best.pth'))
+        env = dict(self.env)
+        if device is not None:
+            env['CUDA_VISIBLE_DEVICES'] = device
+        os.makedirs(self.folder, exist_ok=True)
+        attempt = len(self.record['attempts'])
+        self.log = open(os.path.join(self.folder, f'train_folds_attempt_{attempt}.log'), 'w')
+        self.process = subprocess.Popen(self.command + (['--c'] if resume else []), env=env, stdout=self.log,
+                                        stderr=subprocess.STDOUT)
+        self.record['attempts'].append({'start': time.time(), 'end': None, 'returncode': None, 'resumed': resume,
+                                        'device': device, 'num_processes_da': int(env['nnUNet_n_proc_DA'])})
+        save_run_record(self.folder, self.record)
+        print('Fold {}: attempt {} started{}{}'.format(self.fold, attempt, ' from its checkpoint' if resume else '',
+                                                       f' on GPU {device}' if device is not None else ''))
+
+    def poll(self) -> bool:
+        """
+        Check whether the current attempt has ended, and record it.
+
+        Returns:
+            bool: True if the attempt has ended.
+        """
+        returncode = self.process.poll()
+        if returncode is None:
+            return False
+        self.log.close()
+        self.record['attempts'][-1].update(end=time.time(), returncode=returncode)
+        save_run_record(self.folder, self.record)
+        return True
+
+    def retry(self) -> bool:
+        """
+        Decide whether to resume the fold after its attempt ended without the final checkpoint.
+
+        Returns:
+            bool: True if the fold is to be resumed, counting the retry.
+        """
+        # A successful nnUNetv2_train always ends with the final checkpoint
+        if self.finished or self.retries >= self.max_retries:
+            return False
+        self.retries += 1
+        return True
+
+    def stop(self):
+        """
+        Stop the current attempt.
+        """
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+            self.poll()
+
+
+def train_local(runs: list, devices: list, num_parallel: int) -> bool:
+    """
+    Train folds as concurrent processes, each fold running on the GPU of its slot.
+
+    Args:
+        runs (list): FoldRun of each fold to train.
+        devices (list): GPUs the slots are spread over, empty to keep the visible devices.
+        num_parallel (int): Number of folds trained at the same time.
+
+    Returns:
+        bool: True if all the folds have their final checkpoint.
+    """
+    pending = [run for run in runs if not run.finished]
+    for run in runs:
+        if run.finished:
+            print(f'Fold {run.fold}: already trained, skipped')
+    slots = [None] * num_parallel
+    try:
+        while pending or any(slots):
+            for i, run in enumerate(slots):
+                if run is not None and run.poll():
+                    slots[i] = None
+                    if run.retry():
+                        print(f'Fold {run.fold}: failed (exit code {run.process.returncode}), '
+                              f'retry {run.retries} of {run.max_retries}')
+                        pending.insert(0, run)
+                    else:
+                        print('Fold {}: {}'.format(run.fold, 'done' if run.finished else 'failed, no retry left'))
+            for i in range(num_parallel):
+                if slots[i] is None and pending:
+                    slots[i] = pending.pop(0)
+                    slots[i].start(devices[i % len(devices)] if devices else None)
+            time.sleep(POLL_INTERVAL if any(slots) else 0)
+    finally:
+        for run in slots:
+            if run is not None:
+                run.stop()
+    return all(run.finished for run in runs)
+
+
+def sbatch_script(args, folds: list) -> str:
+    """
+    Write the SLURM job array script training one fold per task with this script.
+
+    Args:
+        args (argparse.Namespace): Arguments of this script.
+        folds (list): Folds to train.
+
+    Returns:
+        str: Content of the script.
+    """
+    command = [sys.executable, os.path.abspath(__file__), '--dataset-id', args.dataset_id,
+               '--configuration', args.configuration, '--trainer', args.trainer, '--plans', args.plans,
+               '--device', args.device, '--max-retries', str(args.max_retries)]
+    if args.timed:
+        command.append('--timed')
+    if args.npz:
+        command.append('--npz')
+    if args.num_processes_da is not None:
+        command += ['--num-processes-da', str(args.num_processes_da)]
+    array = ','.join(str(fold) for fold in folds)
+    if args.parallel is not None:
+        array += f'%{args.parallel}'
+    lines = ['#!/bin/bash',
+             '#SBATCH --job-name=nnunet-train',
+             f'#SBATCH --account={args.slurm_account}',
+             f'#SBATCH --time={args.slurm_time}',
+             f'#SBATCH --cpus-per-task={args.slurm_cpus}',
+             f'#SBATCH --mem={args.slurm_mem}',
+             f'#SBATCH --gpus-per-node={args.slurm_gpus}',
+             f'#SBATCH --array={array}',
+             '#SBATCH --output=nnunet-train-%A_%a.out',
+             '',
+             ' '.join(shlex.quote(c) for c in command) + ' --folds $SLURM_ARRAY_TASK_ID']
+    return '\n'.join(lines) + '\n'
+
+
+def summarize_fold(folder: str, fold: int) -> dict:
+    """
+    Summarize the attempts and the throughput of a fold.
+
+    Args:
+        folder (str): Fold folder.
+        fold (int): Fold number.
+
+    Returns:
+        dict: Summary of the fold.
+    """
+    record = load_run_record(folder)
+    attempts = record.get('attempts', [])
+    summary = {'fold': fold, 'finished': os.path.isfile(os.path.join(folder, 'checkpoint_final.pth')),
+               'attempts': len(attempts),
+               # Attempts whose process is still running, or was killed externally (e.g. SLURM time limit), have no end
+               'wall_time': sum(a['end'] - a['start'] for a in attempts if a['end'] is not None),
+               'num_processes_da': attempts[-1]['num_processes_da'] if attempts else None}
+
+    # Epoch times logged by nnUNet, for any trainer
+    epoch_times = []
+    for name in sorted(os.listdir(folder)) if os.path.isdir(folder) else []:
+        if name.startswith('training_log_'):
+            with open(os.path.join(folder, name)) as f:
+                epoch_times += [float(t) for t in re.findall(r'Epoch time: ([0-9.]+) s', f.read())]
+    summary['epochs'] = len(epoch_times)
+    summary['mean_epoch_time'] = float(np.mean(epoch_times)) if epoch_times else None
+
+    timings = []
+    if os.path.isfile(os.path.join(folder, TIMINGS_FILENAME)):
+        with open(os.path.join(folder, TIMINGS_FILENAME)) as f:
+            timings = [json.loads(line) for line in f if line.strip()]
+    if timings:
+        iterations = sum(t['train_iterations'] for t in timings)
+        wait = sum(t['train_data_wait'] for t in timings)
+        compute = sum(t['train_compute'] for t in timings)
+        summary.update(iterations_per_second=iterations / max(wait + compute, 1e-9),
+                       data_wait_fraction=wait / max(wait + compute, 1e-9),
+                       val_data_wait_fraction=sum(t.get('val_data_wait', 0) for t in timings) / max(
+                           sum(t.get('val_data_wait', 0) + t.get('val_compute', 0) for t in timings), 1e-9))
+        summary['bound'] = 'I/O' if summary['data_wait_fraction'] > DATA_BOUND_FRACTION else 'compute'
+    return summary
+
+
+def print_report(summaries: list):
+    """
+    Print the report of the folds as a table.
+
+    Args:
+        summaries (list): Summaries of the folds, see summarize_fold.
+    """
+    def fmt(value, pattern):
+        return pattern.format(value) if value is not None else '-'
+
+    print('{:>4}  {:>8}  {:>8}  {:>10}  {:>6}  {:>9}  {:>4}  {:>7}  {:>9}  {:>7}'.format(
+        'fold', 'status', 'attempts', 'wall time', 'epochs', 'epoch (s)', 'DA', 'it/s', 'data wait', 'bound'))
+    for s in summaries:
+        print('{:>4}  {:>8}  {:>8}  {:>10}  {:>6}  {:>9}  {:>4}  {:>7}  {:>9}  {:>7}'.format(
+            s['fold'], 'done' if s['finished'] else 'pending', s['attempts'],
+            time.strftime('%H:%M:%S', time.gmtime(s['wall_time'])) if s['wall_time'] < 86400
+            else '{:.1f} d'.format(s['wall_time'] / 86400),
+            s['epochs'], fmt(s['mean_epoch_time'], '{:.1f}'), fmt(s['num_processes_da'], '{}'),
+            fmt(s.get('iterations_per_second'), '{:.2f}'), fmt(s.get('data_wait_fraction'), '{:.0%}'),
+            s.get('bound', '-')))
+
+
+def get_parser():
+    """
+    Get the argument parser of the script.
+
+    Returns:
+        argparse.ArgumentParser: Parser.
+    """
+    parser = argparse.ArgumentParser(description='Train the folds of an nnUNet model concurrently, on the node or '
+                                                 'as a SLURM job array')
+    parser.add_argument('--dataset-id', default='030', help='Dataset ID or name. Default: 030')
+    parser.add_argument('--configuration', default='2d', help='nnUNet configuration. Default: 2d')
+    parser.add_argument('--folds', nargs='+', default=['0', '1', '2', '3', '4'],
+                        help='Folds to train. Default: 0 1 2 3 4')
+    parser.add_argument('--trainer', default='nnUNetTrainer', help='nnUNet trainer. Default: nnUNetTrainer')
+    parser.add_argument('--plans', default='nnUNetPlans', help='Plans identifier. Default: nnUNetPlans')
+    parser.add_argument('--device', default='cuda', choices=['cuda', 'cpu', 'mps'],
+                        help='Device of the training. Default: cuda')
+    parser.add_argument('--npz', action='store_true', default=False,
+                        help='Save the softmax outputs of the validation (nnUNetv2_train --npz), needed to find the '
+                             'best configuration.')
+    parser.add_argument('--timed', action='store_true', default=False,
+                        help='Train with nnUNetTrainerTimed, which records the data loader wait time of each epoch '
+                             'for the report. Install it first with "python timed_trainer.py --install".')
+    parser.add_argument('--mode', default='local', choices=['local', 'slurm'],
+                        help='"local" trains the folds as concurrent processes on this node, "slurm" submits a job '
+                             'array with one fold per task. Default: local')
+    parser.add_argument('--parallel', type=int, default=None,
+                        help='Number of folds trained at the same time. Default: one per visible GPU in local mode '
+                             '(one on CPU), no limit on the job array in slurm mode.')
+    parser.add_argument('--gpus', nargs='+', default=None,
+                        help='GPUs the concurrent folds are spread over in local mode. Default: all visible GPUs')
+    parser.add_argument('--num-processes-da', type=int, default=None,
+                        help='Number of data augmentation workers per fold (nnUNet_n_proc_DA). Default: derived from '
+                             'the CPUs and memory shared by the concurrent folds')
+    parser.add_argument('--max-retries', type=int, default=2,
+                        help='Number of times a failed fold is resumed from its latest checkpoint. Default: 2')
+    parser.add_argument('--path-report', default=None,
+                        help='Path to the JSON report of the folds. Default: train_folds_report.json in the folder '
+                             'of the trained model')
+    parser.add_argument('--report', action='store_true', default=False,
+                        help='Only print the report of the folds, e.g. once a job array is done.')
+    parser.add_argument('--dry-run', action='store_true', default=False,
+                        help='In slurm mode, write the job array script without submitting it.')
+    parser.add_argument('--slurm-account', default='def-jcohen', help='SLURM account. Default: def-jcohen')
+    parser.add_argument('--slurm-time', default='3-00:00:00', help='Time limit of each fold. Default: 3-00:00:00')
+    parser.add_argument('--slurm-cpus', type=int, default=10, help='CPUs of each fold. Default: 10')
+    parser.add_argument('--slurm-mem', default='100G', help='Memory of each fold. Default: 100G')
+    parser.add_argument('--slurm-gpus', default='v100:1', help='GPUs of each fold. Default: v100:1')
+    return parser
+
+
+def main():
+    """
+    Main function to run the script.
+    """
+    parser = get_parser()
+    args = parser.parse_args()
+    from nnunetv2.utilities.dataset_name_id_conversion import maybe_convert_to_dataset_name
+
+    dataset_name = maybe_convert_to_dataset_name(args.dataset_id)
+    trainer = 'nnUNetTrainerTimed' if args.timed else args.trainer
+    if args.timed and args.trainer != 'nnUNetTrainer':
+        raise ValueError('--timed trains with nnUNetTrainerTimed and cannot be combined with another --trainer.')
+    folds = [int(fold) for fold in args.folds]
+    folders = {fold: fold_folder(dataset_name, trainer, args.plans, args.configuration, fold) for fold in folds}
+    model_folder = os.path.dirname(folders[folds[0]])
+    path_report = args.path_report or os.path.join(model_folder, 'train_folds_report.json')
+
+    if args.mode == 'slurm' and not args.report:
+        pending = [fold for fold in folds if not os.path.isfile(os.path.join(folders[fold], 'checkpoint_final.pth'))]
+        if not pending:
+            # An empty job array is rejected by sbatch
+            print(f'All folds {folds} are trained, no job array to submit.')
+            return
+        os.makedirs(model_folder, exist_ok=True)
+        path_script = os.path.join(model_folder, 'train_folds.sbatch')
+        with open(path_script, 'w') as f:
+            f.write(sbatch_script(args, pending))
+        if args.dry_run:
+            print(f'Job array script written to {path_script}')
+        else:
+            print(subprocess.run(['sbatch', path_script], check=True, capture_output=True, text=True).stdout.strip())
+            print(f'Print the report once the folds are trained with: {" ".join(sys.argv)} --report')
+        return
+
+    success = True
+    if not args.report:
+        if args.device == 'cuda':
+            import torch
+            devices = args.gpus
+            if devices is None and os.environ.get('CUDA_VISIBLE_DEVICES'):
+                # SLURM and containers restrict the visible GPUs, which keep their IDs
+                devices = os.environ['CUDA_VISIBLE_DEVICES'].split(',')
+            elif devices is None:
+                devices = [str(i) for i in range(torch.cuda.device_count())]
+            num_parallel = args.parallel or max(1, len(devices))
+        else:
+            devices = []
+            num_parallel = args.parallel or 1
+        num_parallel = min(num_parallel, len(folds))
+        num_processes_da = args.num_processes_da
+        if num_processes_da is None:
+            num_processes_da = size_da_workers(num_parallel, batch_memory(dataset_name, args.configuration,
+                                                                          args.plans))
+        print(f'Training folds {folds}, {num_parallel} at a time, with {num_processes_da} data augmentation '
+              f'workers each')
+
+        env = dict(os.environ, nnUNet_n_proc_DA=str(num_processes_da))
+        runs = []
+        for fold in folds:
+            command = ['nnUNetv2_train', args.dataset_id, args.configuration, str(fold), '-tr', trainer,
+                       '-p', args.plans, '-device', args.device] + (['--npz'] if args.npz else [])
+            runs.append(FoldRun(fold, folders[fold], command, env, args.max_retries))
+        # SLURM (at the time limit) and timeout stop this script with SIGTERM: the trainings are stopped with it
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+        success = train_local(runs, devices, num_parallel)
+
+    summaries = [summarize_fold(folders[fold], fold) for fold in folds]
+    print_report(summaries)
+    if 'SLURM_ARRAY_TASK_ID' in os.environ and not args.report:
+        # The tasks of a job array each train one fold, the report of all the folds is written with --report
+        sys.exit(0 if success else 1)
+    os.makedirs(os.path.dirname(os.path.abspath(path_report)), exist_ok=True)
+    with open(path_report, 'w') as f:
+        json.dump(summaries, f, indent=2)
+    if not success:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
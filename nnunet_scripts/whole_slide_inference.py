@@ -0,0 +1,131 @@
+"""
+Out-of-core inference on whole-slide images with a trained nnUNetv2 predictor.
+
+The slide is read lazily and split into overlapping regions. Each region is normalized with the statistics of the
+whole slide and segmented by the predictor (sliding window and fold ensembling included), and its Gaussian-weighted
+softmax is accumulated into a disk-backed memmap. The final mask is then written as a tiled TIFF, band by band.
+The peak memory is set by the region size, not by the slide size.
+"""
+
+import os
+import shutil
+import tempfile
+
+import nnunetv2
+import numpy as np
+import tifffile
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join
+from nnunetv2.inference.sliding_window_prediction import compute_gaussian
+from nnunetv2.preprocessing.normalization.default_normalization_schemes import ZScoreNormalization
+from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
+
+from tiled_io import SlideReader, crop_windows
+
+OUTPUT_TILE_SIZE = 256
+
+
+def get_slide_normalization(predictor, reader: SlideReader, region_size: int):
+    """
+    Build the function normalizing the regions of a slide the way nnUNet's preprocessing normalizes a whole image.
+    Z-score statistics are computed over the whole slide in a streaming pass, from the histogram of its regions, the
+    other schemes only depend on the dataset fingerprint and are applied to each region directly.
+
+    Args:
+        predictor (nnUNetPredictor): Initialized predictor.
+        reader (SlideReader): Reader of the slide.
+        region_size (int): Side of the square regions read at once to compute the statistics.
+
+    Returns:
+        callable: Function mapping a (H, W) uint8 region to a normalized (H, W) float32 array.
+    """
+    configuration_manager = predictor.configuration_manager
+    if len(configuration_manager.normalization_schemes) != 1:
+        raise ValueError('Whole-slide inference only supports single-channel models.')
+    scheme_class = recursive_find_python_class(join(nnunetv2.__path__[0], 'preprocessing', 'normalization'),
+                                               configuration_manager.normalization_schemes[0],
+                                               'nnunetv2.preprocessing.normalization')
+    if scheme_class is ZScoreNormalization and not configuration_manager.use_mask_for_norm[0]:
+        # The regions are uint8, so their histogram gives exact sums without float temporaries
+        height, width = reader.shape
+        histogram = np.zeros(256, dtype=np.int64)
+        for y in range(0, height, region_size):
+            for x in range(0, width, region_size):
+                region = reader.read_region(y, x, min(region_size, height - y), min(region_size, width - x))
+                histogram += np.bincount(region.ravel(), minlength=256)
+        values = np.arange(256, dtype=np.float64)
+        count = histogram.sum()
+        mean = float(np.dot(histogram, values) / count)
+        std = max(float(np.sqrt(np.dot(histogram, (values - mean) ** 2) / count)), 1e-8)
+        return lambda region: ((region.astype(np.float32) - mean) / std).astype(np.float32)
+
+    intensity_properties = predictor.plans_manager.foreground_intensity_properties_per_channel['0']
+    normalizer = scheme_class(use_mask_for_norm=configuration_manager.use_mask_for_norm[0],
+                              intensityproperties=intensity_properties)
+    return lambda region: normalizer.run(region.astype(np.float32), None)
+
+
+def predict_whole_slide(predictor, path_slide: str, output_fname: str, region_size: int = 4096,
+                        region_overlap: int = 256, path_tmp: str = None, postprocessor=None, metrics=None) -> str:
+    """
+    Segment a whole-slide TIFF region by region and write the mask as a tiled TIFF.
+
+    Args:
+        predictor (nnUNetPredictor): Initialized predictor of a 2D model.
+        path_slide (str): Path to the TIFF slide.
+        output_fname (str): Path to the output mask (.tif).
+        region_size (int): Side of the square regions given to the predictor.
+        region_overlap (int): Number of pixels shared by neighbouring regions, blended with Gaussian weights.
+        path_tmp (str): Folder in which the logit memmap is created. Default: the output folder.
+        postprocessor (PostProcessor): Pointwise post-processing (colormap) applied to the mask tiles. Default: None.
+        metrics (MaskMetrics): Metrics fed with the bands of the mask as they are written. Default: None.
+
+    Returns:
+        str: Path to the output mask.
+    """
+    if predictor.label_manager.has_regions:
+        raise ValueError('Whole-slide inference does not support region-based models.')
+    if list(predictor.configuration_manager.spacing) != [1, 1]:
+        raise ValueError('Whole-slide inference requires a 2D configuration without resampling.')
+    if postprocessor is not None and not postprocessor.is_pointwise:
+        raise ValueError('Only pointwise post-processing can be applied to whole-slide masks.')
+    num_classes = predictor.label_manager.num_segmentation_heads
+    lut = postprocessor.lut if postprocessor is not None else None
+    samples = lut.shape[1:] if lut is not None else ()
+
+    path_tmp = tempfile.mkdtemp(prefix='whole_slide_', dir=path_tmp or os.path.dirname(os.path.abspath(output_fname)))
+    try:
+        with SlideReader(path_slide) as reader:
+            height, width = reader.shape
+            normalize = get_slide_normalization(predictor, reader, region_size)
+            accumulated = np.lib.format.open_memmap(os.path.join(path_tmp, 'softmax.npy'), mode='w+',
+                                                    dtype=np.float32, shape=(num_classes, height, width))
+            windows = crop_windows(height, width, region_size, region_overlap)
+            for i, (y, x, h, w) in enumerate(windows):
+                print(f'Predicting region {i + 1}/{len(windows)} at ({y}, {x}) of {os.path.basename(path_slide)}')
+                data = torch.from_numpy(normalize(reader.read_region(y, x, h, w))[None, None])
+                logits = predictor.predict_logits_from_preprocessed_data(data).float()
+                weights = compute_gaussian((h, w), sigma_scale=1. / 8, value_scaling_factor=1, dtype=torch.float32,
+                                           device=torch.device('cpu'))
+                accumulated[:, y:y + h, x:x + w] += (torch.softmax(logits[:, 0], 0) * weights).numpy()
+            accumulated.flush()
+
+        # The Gaussian weights are shared by all classes, so the argmax of the weighted sum needs no normalization
+        def mask_tiles(softmax):
+            for y in range(0, height, OUTPUT_TILE_SIZE):
+                band = np.argmax(softmax[:, y:y + OUTPUT_TILE_SIZE], axis=0).astype(np.uint8)
+                if metrics is not None:
+                    metrics.update(band)
+                for x in range(0, width, OUTPUT_TILE_SIZE):
+                    tile = np.zeros((OUTPUT_TILE_SIZE, OUTPUT_TILE_SIZE), dtype=np.uint8)
+                    tile_band = band[:, x:x + OUTPUT_TILE_SIZE]
+                    tile[:tile_band.shape[0], :tile_band.shape[1]] = tile_band
+                    yield lut[tile] if lut is not None else tile
+
+        tifffile.imwrite(output_fname, mask_tiles(accumulated), shape=(height, width, *samples), dtype=np.uint8,
+                         tile=(OUTPUT_TILE_SIZE, OUTPUT_TILE_SIZE), compression='zlib',
+                         photometric='rgb' if samples else 'minisblack')
+        del accumulated
+    finally:
+        shutil.rmtree(path_tmp, ignore_errors=True)
+    return output_fname
@@ -1,53 +1,273 @@
-import cv2
-import os
 import argparse
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
 
-def main(images_folder, masks_folder, output_folder):
-    # Créer le dossier de sortie s'il n'existe pas
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
+import cv2
+import numpy as np
+import tifffile
+from PIL import Image
 
-    # Parcourir les fichiers dans le dossier des images
-    for filename in os.listdir(images_folder):
-        if filename.endswith(".tif"):  # Assurez-vous que seuls les fichiers d'image TIFF sont traités
-            # Charger l'image
-            image_path = os.path.join(images_folder, filename)
-            image = cv2.imread(image_path)
+from nnunet_scripts.tiled_io import SlideReader, is_tiff, slide_shape
+
+IMAGE_EXTENSIONS = ('.tif', '.tiff', '.png', '.jpg', '.jpeg')
+# Suffixes des masques, par ordre de priorité : annotations, puis prédictions de nnunet_inference.py
+# (mode --path-images puis mode --path-dataset, en PNG ou en TIFF pour les lames entières)
+MASK_SUFFIXES = ('_annotee.png', '_pred.png', '_pred.tif', '.png', '.tif')
+FILL_COLOR = np.array([0, 255, 0], dtype=np.float32)  # BGR
+CONTOUR_COLOR = (0, 0, 0)
+BAND_HEIGHT = 1024
+
+
+def to_bgr(region):
+    # Convertir une région (niveaux de gris, RGB ou RGBA) en BGR pour OpenCV
+    if region.ndim == 2 or region.shape[2] == 1:
+        return cv2.cvtColor(region.reshape(region.shape[:2]), cv2.COLOR_GRAY2BGR)
+    return np.ascontiguousarray(region[..., 2::-1])
 
-            # Vérifier si l'image a été chargée correctement
-            if image is None:
-                print(f"Erreur : impossible de charger l'image {filename}.")
-                continue
 
-            # Construire le chemin vers le masque binaire correspondant
-            # Supposer que le nom du masque correspond au nom de l'image avec un suffixe différent
-            mask_filename = filename.replace(".tif", "_annotee.png")
-            mask_path = os.path.join(masks_folder, mask_filename)
-            mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+class FullResolutionReader:
+    # Lecture par bandes d'une image en pleine résolution : paresseuse pour les TIFF, en mémoire sinon
 
-            # Vérifier si le masque a été chargé correctement
-            if mask is None:
-                print(f"Erreur : impossible de charger le masque pour {filename}.")
+    def __init__(self, path, color=True):
+        self.color = color
+        self._slide, self._array = None, None
+        if is_tiff(path):
+            self._slide = SlideReader(path)
+            self.shape = self._slide.shape
+        else:
+            self._array = cv2.imread(path, cv2.IMREAD_COLOR if color else cv2.IMREAD_GRAYSCALE)
+            if self._array is None:
+                raise IOError(f"impossible de charger {path}")
+            self.shape = self._array.shape[:2]
+
+    def read(self, y, height):
+        y0, y1 = max(0, y), min(self.shape[0], y + height)
+        if self._slide is None:
+            return self._array[y0:y1]
+        region = self._slide.read_region(y0, 0, y1 - y0, self.shape[1], gray=not self.color)
+        return to_bgr(region) if self.color else region
+
+    def close(self):
+        if self._slide is not None:
+            self._slide.close()
+
+
+def read_pyramid_level(path, preview_size, color):
+    # Lire le plus petit niveau de la pyramide d'un TIFF qui reste plus grand que l'aperçu, s'il en existe un
+    with tifffile.TiffFile(path) as tiff:
+        levels = tiff.series[0].levels
+        if len(levels) < 2:
+            return None
+        for level in reversed(levels[1:]):
+            if level.axes not in ('YX', 'YXS') or max(level.shape[:2]) < preview_size:
                 continue
+            region = level.asarray()
+            if region.dtype != np.uint8:
+                region = np.clip(region, 0, 255).astype(np.uint8)
+            if color:
+                return to_bgr(region)
+            return region if region.ndim == 2 else cv2.cvtColor(to_bgr(region), cv2.COLOR_BGR2GRAY)
+    return None
+
+
+def read_preview(path, preview_shape, color):
+    # Réduire l'image à la taille de l'aperçu, bande par bande, sans la charger entièrement en mémoire
+    height, width = preview_shape
+    region = read_pyramid_level(path, max(preview_shape), color) if is_tiff(path) else None
+    if region is not None:
+        return cv2.resize(region, (width, height), interpolation=cv2.INTER_AREA)
+
+    reader = FullResolutionReader(path, color)
+    try:
+        full_height = reader.shape[0]
+        preview = np.zeros((height, width, 3) if color else (height, width), dtype=np.uint8)
+        for y in range(0, full_height, BAND_HEIGHT):
+            top, bottom = round(y * height / full_height), round(min(y + BAND_HEIGHT, full_height) * height / full_height)
+            if bottom > top:
+                preview[top:bottom] = cv2.resize(reader.read(y, BAND_HEIGHT), (width, bottom - top),
+                                                 interpolation=cv2.INTER_AREA)
+        return preview
+    finally:
+        reader.close()
+
+
+def read_preview_mask(mask_path, preview_shape):
+    # Réduire le masque binaire (et non ses valeurs, qui peuvent être 1, 255 ou des couleurs) à la taille de l'aperçu :
+    # un pixel de l'aperçu appartient au masque si la majorité des pixels qu'il couvre y appartient
+    height, width = preview_shape
+    reader = FullResolutionReader(mask_path, color=False)
+    try:
+        full_height = reader.shape[0]
+        mask = np.zeros(preview_shape, dtype=bool)
+        for y in range(0, full_height, BAND_HEIGHT):
+            top, bottom = round(y * height / full_height), round(min(y + BAND_HEIGHT, full_height) * height / full_height)
+            if bottom > top:
+                band = (reader.read(y, BAND_HEIGHT) > 0).astype(np.uint8) * 255
+                mask[top:bottom] = cv2.resize(band, (width, bottom - top), interpolation=cv2.INTER_AREA) >= 128
+        return mask
+    finally:
+        reader.close()
+
 
-            # Trouver les contours dans le masque binaire
-            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+def image_shape(path):
+    # Lire la taille de l'image dans son en-tête, sans la décoder
+    if is_tiff(path):
+        return slide_shape(path)
+    with Image.open(path) as image:
+        return image.height, image.width
+
+
+def draw_overlay(image, mask, alpha, thickness):
+    # Remplissage semi-transparent du masque, puis contours (bords du masque d'épaisseur `thickness`)
+    result = image.copy()
+    if alpha > 0:
+        result[mask] = ((1 - alpha) * image[mask] + alpha * FILL_COLOR).astype(np.uint8)
+    if thickness > 0:
+        kernel = np.ones((2 * thickness + 1, 2 * thickness + 1), dtype=np.uint8)
+        edges = mask & ~cv2.erode(mask.astype(np.uint8), kernel).astype(bool)
+        result[edges] = CONTOUR_COLOR
+    return result
+
+
+def write_deepzoom(output_path, image_path, mask_path, tile_size, jpeg_quality, alpha, thickness):
+    # Écrire une pyramide de tuiles Deep Zoom (.dzi), lisible par OpenSeadragon, à partir de la pleine résolution
+    image_reader = FullResolutionReader(image_path, color=True)
+    mask_reader = FullResolutionReader(mask_path, color=False)
+    try:
+        height, width = image_reader.shape
+        if mask_reader.shape != image_reader.shape:
+            raise ValueError(f"le masque ({mask_reader.shape}) et l'image ({image_reader.shape}) n'ont pas la même taille")
+        tiles_folder = output_path[:-len('.dzi')] + '_files'
+        max_level = math.ceil(math.log2(max(height, width))) if max(height, width) > 1 else 0
+        params = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality]
+
+        # Niveau de pleine résolution : les bandes sont lues avec une marge pour que les contours soient continus
+        os.makedirs(os.path.join(tiles_folder, str(max_level)), exist_ok=True)
+        for row, y in enumerate(range(0, height, tile_size)):
+            top = max(0, y - thickness)
+            band = draw_overlay(image_reader.read(top, tile_size + y - top + thickness),
+                                mask_reader.read(top, tile_size + y - top + thickness) > 0, alpha, thickness)
+            band = band[y - top:y - top + tile_size]
+            for col, x in enumerate(range(0, width, tile_size)):
+                cv2.imwrite(os.path.join(tiles_folder, str(max_level), f'{col}_{row}.jpeg'),
+                            band[:, x:x + tile_size], params)
+
+        # Niveaux inférieurs : chaque tuile est la réduction des 4 tuiles du niveau supérieur
+        level_height, level_width = height, width
+        for level in range(max_level - 1, -1, -1):
+            previous = os.path.join(tiles_folder, str(level + 1))
+            level_height, level_width = math.ceil(level_height / 2), math.ceil(level_width / 2)
+            os.makedirs(os.path.join(tiles_folder, str(level)), exist_ok=True)
+            for row in range(math.ceil(level_height / tile_size)):
+                for col in range(math.ceil(level_width / tile_size)):
+                    # Les tuiles du bord droit et du bord bas n'ont pas toujours de voisine
+                    children = [[cv2.imread(child) if os.path.isfile(child) else None
+                                 for child in (os.path.join(previous, f'{2 * col + dx}_{2 * row + dy}.jpeg')
+                                               for dx in (0, 1))] for dy in (0, 1)]
+                    rows = [np.hstack([c for c in children_row if c is not None])
+                            for children_row in children if children_row[0] is not None]
+                    merged = np.vstack(rows)
+                    tile = cv2.resize(merged, (math.ceil(merged.shape[1] / 2), math.ceil(merged.shape[0] / 2)),
+                                      interpolation=cv2.INTER_AREA)
+                    cv2.imwrite(os.path.join(tiles_folder, str(level), f'{col}_{row}.jpeg'), tile, params)
+
+        with open(output_path, 'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="jpeg" Overlap="0" '
+                    f'TileSize="{tile_size}"><Size Width="{width}" Height="{height}"/></Image>\n')
+    finally:
+        image_reader.close()
+        mask_reader.close()
+
+
+def find_mask(masks_folder, image_path):
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    for suffix in MASK_SUFFIXES:
+        mask_path = os.path.join(masks_folder, stem + suffix)
+        if os.path.isfile(mask_path) and not os.path.samefile(mask_path, image_path):
+            return mask_path
+    return None
+
+
+def process_image(image_path, mask_path, output_folder, preview_size=2048, alpha=0.3, thickness=2,
+                  jpeg_quality=85, pyramid=False, tile_size=512):
+    filename = os.path.basename(image_path)
+    try:
+        # Aperçu sous-échantillonné : la plus grande dimension vaut au plus preview_size pixels
+        height, width = image_shape(image_path)
+        scale = min(1.0, preview_size / max(height, width))
+        preview_shape = (max(1, round(height * scale)), max(1, round(width * scale)))
+        image = read_preview(image_path, preview_shape, color=True)
+        mask = read_preview_mask(mask_path, preview_shape)
+        overlay = draw_overlay(image, mask, alpha, thickness)
+
+        output_image_path = os.path.join(output_folder, f"{os.path.splitext(filename)[0]}_contours.jpeg")
+        cv2.imwrite(output_image_path, overlay, [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality])
+        message = f"L'image avec contours {output_image_path} a été enregistrée avec succès."
+
+        if pyramid:
+            output_dzi_path = os.path.join(output_folder, f"{os.path.splitext(filename)[0]}_contours.dzi")
+            write_deepzoom(output_dzi_path, image_path, mask_path, tile_size, jpeg_quality, alpha, thickness)
+            message += f" Pyramide de tuiles : {output_dzi_path}."
+        return message
+    except Exception as e:
+        return f"Erreur : impossible de traiter l'image {filename} ({e})."
+
+
+def init_worker():
+    # Chaque processus utilise un seul thread OpenCV, le parallélisme est assuré par les processus
+    cv2.setNumThreads(1)
+
+
+def main(images_folder, masks_folder, output_folder, workers=1, preview_size=2048, alpha=0.3, thickness=2,
+         jpeg_quality=85, pyramid=False, tile_size=512):
+    # Créer le dossier de sortie s'il n'existe pas
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
 
-            # Dessiner les contours sur l'image originale en noir et avec une épaisseur plus grande
-            image_with_contours = cv2.drawContours(image.copy(), contours, -1, (0, 0, 0), 10)
-            jpeg_quality = 10
-            # Enregistrer l'image avec les contours sur le disque
-            output_image_path = os.path.join(output_folder, f"{os.path.splitext(filename)[0]}_contours.jpeg")
-            cv2.imwrite(output_image_path, image_with_contours, [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality])
+    # Associer chaque image à son masque (annotation ou prédiction)
+    jobs = []
+    for filename in sorted(os.listdir(images_folder)):
+        if not filename.lower().endswith(IMAGE_EXTENSIONS) or filename.endswith(MASK_SUFFIXES[:3]):
+            continue
+        image_path = os.path.join(images_folder, filename)
+        mask_path = find_mask(masks_folder, image_path)
+        if mask_path is None:
+            print(f"Erreur : impossible de trouver le masque pour {filename}.")
+            continue
+        jobs.append((image_path, mask_path))
 
-            print(f"L'image avec contours {output_image_path} a été enregistrée avec succès.")
+    options = [output_folder, preview_size, alpha, thickness, jpeg_quality, pyramid, tile_size]
+    arguments = [[job[0] for job in jobs], [job[1] for job in jobs]] + [[option] * len(jobs) for option in options]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            for message in executor.map(process_image, *arguments):
+                print(message)
+    else:
+        for message in map(process_image, *arguments):
+            print(message)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process some images and masks.')
     parser.add_argument('--images_folder', type=str, required=True, help='Path to the folder containing images')
-    parser.add_argument('--masks_folder', type=str, required=True, help='Path to the folder containing masks')
+    parser.add_argument('--masks_folder', type=str, required=True,
+                        help='Path to the folder containing masks (<image>_annotee.png annotations, or predictions '
+                        'of nnunet_inference.py)')
     parser.add_argument('--output_folder', type=str, required=True, help='Path to the output folder')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of images processed in parallel. Default: number of CPUs')
+    parser.add_argument('--preview_size', type=int, default=2048,
+                        help='Largest dimension of the preview in pixels. Default: 2048')
+    parser.add_argument('--alpha', type=float, default=0.3,
+                        help='Opacity of the mask fill, 0 for contours only. Default: 0.3')
+    parser.add_argument('--thickness', type=int, default=2, help='Thickness of the contours in pixels. Default: 2')
+    parser.add_argument('--jpeg_quality', type=int, default=85, help='JPEG quality of the outputs. Default: 85')
+    parser.add_argument('--pyramid', action='store_true',
+                        help='Also write a Deep Zoom tile pyramid (.dzi) of the full-resolution overlay for zooming')
+    parser.add_argument('--tile_size', type=int, default=512, help='Size of the pyramid tiles. Default: 512')
 
     args = parser.parse_args()
 
-    main(args.images_folder, args.masks_folder, args.output_folder)
\ No newline at end of file
+    main(args.images_folder, args.masks_folder, args.output_folder, args.workers, args.preview_size, args.alpha,
+         args.thickness, args.jpeg_quality, args.pyramid, args.tile_size)